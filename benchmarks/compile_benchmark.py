@@ -0,0 +1,259 @@
+"""
+Times the compile of synthetic menu trees on both backends.
+
+The Linux backend is timed by generating the extension code, the Windows backend by compiling
+into the registry mocked by context_menu.pytest_plugin, so both run on any platform. Every run
+is appended as one JSON line to the output file and compared with the previous run there.
+
+    python benchmarks/compile_benchmark.py --sizes 10 1000 100000 --mix python=1 vars=1 plain=2
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from context_menu import menus, windows_menus
+from context_menu.pytest_plugin import MockedWinReg
+
+if TYPE_CHECKING:
+    from typing import Any, Callable
+
+DEFAULT_OUTPUT = os.path.join(HERE, "results.jsonl")
+KINDS = ["python", "vars", "plain"]
+
+
+def target(filenames, params):
+    """
+    The function of the python commands.
+    """
+
+
+def parse_mix(values: list[str]) -> dict[str, int]:
+    """
+    Parses kind=weight pairs into the weights of the command kinds.
+    """
+    mix = {}
+    for value in values:
+        kind, _, weight = value.partition("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown command kind {kind!r}")
+        mix[kind] = int(weight or 1)
+    return mix
+
+
+def build_tree(size: int, width: int, depth: int, mix: dict[str, int]) -> menus.ContextMenu:
+    """
+    Builds a menu with size items in total, filled breadth first.
+
+    Every menu holds up to width items. Above depth, half of them are submenus and the
+    others are commands, whose kind follows the weights of mix.
+    """
+    kinds = itertools.cycle([kind for kind in KINDS for _ in range(mix.get(kind, 0))])
+    root = menus.ContextMenu("Benchmark", "FILES")
+    queue = deque([(root, 0)])
+    count = 0
+
+    while queue and count < size:
+        menu, level = queue.popleft()
+        items = []
+        for position in range(min(width, size - count)):
+            count += 1
+            if level + 1 < depth and position < width // 2:
+                submenu = menus.ContextMenu(f"Menu {count}")
+                queue.append((submenu, level + 1))
+                items.append(submenu)
+                continue
+
+            kind = next(kinds)
+            if kind == "python":
+                items.append(menus.ContextCommand(f"Python {count}", python=target, params=str(count)))
+            elif kind == "vars":
+                items.append(
+                    menus.ContextCommand(f"Vars {count}", command=f"echo {count} ?", command_vars=["FILENAME"])
+                )
+            else:
+                items.append(menus.ContextCommand(f"Plain {count}", command=f"echo {count}"))
+        menu.add_items(items)
+
+    return root
+
+
+def count_nodes(menu: menus.ContextMenu) -> int:
+    """
+    Returns the number of items below menu.
+    """
+    total = 0
+    stack = [menu]
+    while stack:
+        items = stack.pop().sub_items
+        total += len(items)
+        stack.extend(item for item in items if item.isMenu)
+    return total
+
+
+def measure(operation: Callable[[], Any], repeat: int) -> dict[str, Any]:
+    """
+    Times operation repeat times, then runs it once more under tracemalloc for the memory peak.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        operation()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {"best": min(times), "median": statistics.median(times), "peak_memory": peak}
+
+
+def linux_build(tree: menus.ContextMenu) -> None:
+    tree.get_linux_menu().build_script()
+
+
+def windows_compile(tree: menus.ContextMenu) -> dict[str, int]:
+    """
+    Compiles into an empty mocked registry, returns the registry calls.
+    """
+    with MockedWinReg() as winreg:
+        tree.get_windows_menu().compile()
+    return dict(winreg.calls)
+
+
+def windows_incremental(tree: menus.ContextMenu) -> dict[str, int]:
+    """
+    Compiles incrementally into a registry that already has the menu, returns the registry calls of that compile.
+    """
+    with MockedWinReg() as winreg:
+        tree.get_windows_menu().compile()
+        winreg.calls.clear()
+        tree.get_windows_menu().compile(incremental=True)
+    return dict(winreg.calls)
+
+
+OPERATIONS = {
+    "linux_build_script": linux_build,
+    "windows_compile": windows_compile,
+    "windows_incremental": windows_incremental,
+}
+
+
+def git_commit() -> str | None:
+    """
+    Returns the commit of the working tree, if it is a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes: list[int], width: int, depth: int, mix: dict[str, int], repeat: int, operations: list[str]) -> dict[str, Any]:
+    """
+    Runs the benchmarks and returns the record of the run.
+    """
+    results = []
+    for size in sizes:
+        tree = build_tree(size, width, depth, mix)
+        for name in operations:
+            operation = OPERATIONS[name]
+            result = {"operation": name, "size": size, "nodes": count_nodes(tree)}
+            result.update(measure(lambda: operation(tree), repeat))
+            if name.startswith("windows"):
+                result["registry_calls"] = operation(tree)
+            results.append(result)
+            print(
+                f"{name:<22} {size:>7} nodes  best {result['best'] * 1000:10.2f} ms"
+                f"  median {result['median'] * 1000:10.2f} ms  peak {result['peak_memory'] / 2**20:8.2f} MiB"
+            )
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {"width": width, "depth": depth, "mix": mix, "repeat": repeat},
+        "results": results,
+    }
+
+
+def previous_run(path: str, parameters: dict[str, Any]) -> dict[str, Any] | None:
+    """
+    Returns the last run in the output file that used the same parameters.
+    """
+    if not os.path.exists(path):
+        return None
+
+    previous = None
+    with open(path, encoding="utf-8") as results_file:
+        for line in results_file:
+            record = json.loads(line)
+            if record["parameters"] == parameters:
+                previous = record
+    return previous
+
+
+def compare(previous: dict[str, Any], current: dict[str, Any]) -> None:
+    """
+    Prints the best times of current relative to previous.
+    """
+    before = {(result["operation"], result["size"]): result for result in previous["results"]}
+    print(f"\ncompared with {previous['timestamp']} ({previous['commit']}):")
+    for result in current["results"]:
+        old = before.get((result["operation"], result["size"]))
+        if old is None:
+            continue
+        ratio = result["best"] / old["best"] if old["best"] else float("inf")
+        memory = result["peak_memory"] / old["peak_memory"] if old["peak_memory"] else float("inf")
+        print(f"{result['operation']:<22} {result['size']:>7} nodes  time x{ratio:.2f}  memory x{memory:.2f}")
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--width", type=int, default=10, help="items per menu")
+    parser.add_argument("--depth", type=int, default=6, help="levels of submenus")
+    parser.add_argument("--mix", nargs="+", default=["python=1", "vars=1", "plain=1"], help="weights of the command kinds")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--operations", nargs="+", choices=list(OPERATIONS), default=list(OPERATIONS))
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON lines file the run is appended to")
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    if args.width < 2 or not any(mix.values()):
+        parser.error("width must be at least 2 and mix must contain a command kind")
+
+    record = run(args.sizes, args.width, args.depth, mix, args.repeat, args.operations)
+
+    previous = previous_run(args.output, record["parameters"])
+    if previous is not None:
+        compare(previous, record)
+
+    with open(args.output, "a", encoding="utf-8") as results_file:
+        results_file.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Times how long the registry commands of python functions take to run, for every launch mode.
+
+The commands are generated like for Windows and run with the current interpreter in place of
+python.exe and pythonw.exe, so the difference between the launch modes can be measured on any
+platform. The selected file is a temporary file.
+
+    python benchmarks/launch_benchmark.py --repeat 20
+"""
+from __future__ import annotations
+import argparse
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from context_menu import menus, windows_menus
+
+from launch_target import target
+
+
+def registry_command(launch: str) -> str:
+    """
+    Returns the command FastCommand writes to the registry for target.
+    """
+    command = menus.FastCommand("Launch", "FILES", python=target, launch=launch)
+    keys = command.get_windows_menu().build_keys()
+    return next(values[""] for key, values in keys.items() if key.endswith("\\command"))
+
+
+def command_argv(command: str, selection: str) -> list[str]:
+    """
+    Splits a registry command into the arguments of the current interpreter.
+    """
+    for python in windows_menus.COMMAND_PRESETS.values():
+        command = command.replace(f'"{python}"', f'"{sys.executable}"')
+    return shlex.split(command.replace("%1", selection))
+
+
+def measure(arguments: list[str], repeat: int) -> dict[str, float]:
+    """
+    Runs the command repeat times after a first untimed run, which writes the bytecode of the console mode.
+    """
+    subprocess.run(arguments, check=True)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(arguments, check=True)
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times)}
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    with tempfile.NamedTemporaryFile(suffix=".txt") as selection:
+        for launch in menus.LAUNCH_MODES:
+            arguments = command_argv(registry_command(launch), selection.name)
+            result = measure(arguments, args.repeat)
+            print(
+                f"{launch:<12} best {result['best'] * 1000:8.2f} ms"
+                f"  median {result['median'] * 1000:8.2f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+"""
+The function of the commands timed by launch_benchmark.py, in a module of its own so the commands can import it.
+"""
+
+
+def target(filenames, params):
+    pass
@@ -0,0 +1,131 @@
+"""
+Packs the module of a python function and the modules it imports from its directory into a zip archive.
+
+Commands compiled with archive=True import their function from the archive instead of its directory: a
+single file, opened once, with the bytecode already compiled. The archives are kept in the archives cache
+directory of context_menu and named after their directory and their content, so a menu keeps running the
+version it was compiled with until it's compiled again. Building the archive of a changed module removes its
+previous archives, the other menus using it have to be compiled again as well. The sources are stored too,
+for interpreters of another version than the one that compiled the menu. They are stored uncompressed, so
+importing from the archive doesn't inflate anything.
+"""
+from __future__ import annotations
+import ast
+import hashlib
+import os
+import sys
+import tempfile
+import zipfile
+
+from context_menu.paths import cache_dir
+
+
+def module_path(directory: str, name: str) -> str | None:
+    """
+    Returns the file of a module or the directory of a package directly in directory, None if there is neither.
+    """
+    package = os.path.join(directory, name)
+    if os.path.isfile(os.path.join(package, "__init__.py")):
+        return package
+    module = package + ".py"
+    return module if os.path.isfile(module) else None
+
+
+def source_files(path: str) -> list[str]:
+    """
+    Returns the python files of a module or a package.
+    """
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(path)
+        for name in names
+        if name.endswith(".py")
+    )
+
+
+def imported_names(source: str) -> set[str]:
+    """
+    Returns the top-level names of the absolute imports of a python file.
+    """
+    with open(source, "rb") as file:
+        try:
+            tree = ast.parse(file.read(), source)
+        except SyntaxError:
+            return set()
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split(".")[0])
+    return names
+
+
+def local_modules(directory: str, module: str) -> list[str]:
+    """
+    Returns the paths of module and of the modules and packages of directory it imports, directly or not.
+    """
+    paths: list[str] = []
+    pending = [module]
+    seen = {module}
+    while pending:
+        path = module_path(directory, pending.pop())
+        if path is None:
+            continue
+        paths.append(path)
+        for source in source_files(path):
+            for name in imported_names(source) - seen:
+                seen.add(name)
+                pending.append(name)
+    return paths
+
+
+def build_archive(directory: str, module: str) -> str:
+    """
+    Returns the path of the archive of module from directory, building it if this content wasn't archived yet.
+    """
+    paths = local_modules(directory, module)
+    sources = [source for path in paths for source in source_files(path)]
+
+    # Modules with the same name from other directories have archives of their own
+    prefix = f"{module}-{hashlib.sha1(directory.encode('utf-8')).hexdigest()[:8]}-"
+    digest = hashlib.sha1(sys.implementation.cache_tag.encode("utf-8"))
+    for source in sources:
+        digest.update(os.path.relpath(source, directory).encode("utf-8") + b"\0")
+        with open(source, "rb") as file:
+            digest.update(file.read())
+
+    archives = cache_dir("archives")
+    archive = os.path.join(archives, f"{prefix}{digest.hexdigest()[:16]}.zip")
+    if os.path.exists(archive):
+        return archive
+
+    # Replaced atomically, so a command never imports from a half-written archive
+    fd, tmp_archive = tempfile.mkstemp(prefix=f".{module}.", suffix=".tmp", dir=archives)
+    os.close(fd)
+    try:
+        with zipfile.PyZipFile(tmp_archive, "w", zipfile.ZIP_STORED) as zip_file:
+            for path in paths:
+                zip_file.writepy(path)
+            names = set(zip_file.namelist())
+            for source in sources:
+                name = os.path.relpath(source, directory).replace(os.sep, "/")
+                if name not in names:
+                    zip_file.write(source, name)
+        os.replace(tmp_archive, archive)
+    except BaseException:
+        if os.path.exists(tmp_archive):
+            os.remove(tmp_archive)
+        raise
+
+    for name in os.listdir(archives):
+        if name.startswith(prefix) and name.endswith(".zip") and name != os.path.basename(archive):
+            try:
+                os.remove(os.path.join(archives, name))
+            except OSError:
+                # Still open by a command on Windows, removed by a later build
+                pass
+    return archive
@@ -0,0 +1,179 @@
+"""
+Merges the invocations Explorer starts for a multi-file selection into a single call.
+
+Explorer runs the command of a verb once per selected file. In coalesce mode the first
+process becomes the leader: it collects the paths the other processes send it through a
+pipe until no new path arrived for WINDOW seconds, and calls the function once with all
+of them. The other processes exit as soon as the leader has their path.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import hashlib
+import sys
+import threading
+import time
+from multiprocessing.connection import Client
+
+from context_menu.worker import (
+    CONNECTION_ERRORS,
+    authkey,
+    default_address,
+    listen,
+    load_function,
+    send,
+)
+
+if TYPE_CHECKING:
+    from typing import Iterable
+    from multiprocessing.connection import Listener
+
+# Seconds to wait for more paths after the last one arrived
+WINDOW = 0.3
+# Attempts to either reach or become the leader before running alone
+ATTEMPTS = 20
+# Seconds to wait after the first failed attempt, doubled after every other one up to WINDOW
+BACKOFF = 0.005
+
+
+def command_address(path: str, module: str, function: str, params: str) -> str:
+    """
+    Returns the address the leader of a command listens on.
+
+    Different commands never share a leader, even if they run the same function.
+    """
+    command_id = "|".join((path, module, function, params)).encode("utf-8")
+    return default_address("coalesce_" + hashlib.sha1(command_id).hexdigest()[:16])
+
+
+def forward(address: str, key: bytes, filenames: list[str]) -> bool:
+    """
+    Hands the paths to the leader, returns False if there is no leader accepting them.
+    """
+    try:
+        return send(address, key, {"filenames": filenames}) == "ok"
+    except CONNECTION_ERRORS:
+        return False
+
+
+class Leader:
+    """
+    Collects the paths sent by the other invocations of a command.
+    """
+
+    def __init__(self, listener: Listener, address: str, key: bytes, window: float) -> None:
+        self.listener = listener
+        self.address = address
+        self.key = key
+        self.window = window
+        self.filenames: list[str] = []
+        self.last_arrival = time.monotonic()
+        self.closing = False
+        self.lock = threading.Lock()
+
+    def collect(self) -> list[str]:
+        """
+        Returns the received paths once none arrived for window seconds.
+        """
+        thread = threading.Thread(target=self.accept_loop, daemon=True)
+        thread.start()
+        while True:
+            time.sleep(self.window / 4)
+            with self.lock:
+                if time.monotonic() - self.last_arrival >= self.window:
+                    self.closing = True
+                    break
+
+        try:
+            # Wakes up the pending accept()
+            Client(self.address, authkey=self.key).close()
+        except CONNECTION_ERRORS:
+            pass
+        # The accept() isn't woken up if the address was taken over meanwhile, the thread
+        # is a daemon and refuses every path from now on, so it doesn't need to finish
+        thread.join(self.window)
+        self.listener.close()
+        with self.lock:
+            return list(self.filenames)
+
+    def accept_loop(self) -> None:
+        """
+        Accepts paths until collect() decides the selection is complete.
+        """
+        while True:
+            try:
+                conn = self.listener.accept()
+            except CONNECTION_ERRORS:
+                if self.closing:
+                    return
+                continue
+
+            with conn:
+                try:
+                    request = conn.recv()
+                except CONNECTION_ERRORS:
+                    request = None
+                with self.lock:
+                    if request is not None:
+                        if self.closing:
+                            # Too late, the sender will start a new group
+                            conn.send("closed")
+                        else:
+                            self.filenames.extend(request["filenames"])
+                            self.last_arrival = time.monotonic()
+                            conn.send("ok")
+                    if self.closing:
+                        return
+
+
+def invoke(
+    path: str,
+    module: str,
+    function: str,
+    filenames: Iterable[str],
+    params: str,
+    worker: bool = False,
+    window: float = WINDOW,
+    parallel: str | None = None,
+    ordered: bool = True,
+) -> None:
+    """
+    Calls module.function(filenames, params) once for all the invocations arriving within window seconds.
+
+    Only the leader calls the function, every other invocation returns right after handing over its paths.
+    If worker is True, the leader forwards the merged selection to the resident worker. If parallel is
+    set, the leader spreads the merged selection over a pool of processes (see context_menu.parallel),
+    collecting the results in the order of the selection unless ordered is False.
+    """
+    address = command_address(path, module, function, params)
+    key = authkey()
+    filenames = list(filenames)
+
+    # Imported by the commands of menus compiled with telemetry, which record the merged selection in the leader only
+    telemetry = sys.modules.get("context_menu.telemetry")
+
+    delay = BACKOFF
+    for _ in range(ATTEMPTS):
+        if forward(address, key, filenames):
+            if telemetry is not None:
+                telemetry.discard()
+            return
+        listener = listen(address, key)
+        if listener is not None:
+            filenames += Leader(listener, address, key, window).collect()
+            break
+        # The leader is starting or closing, give it time instead of spinning through the attempts
+        time.sleep(delay)
+        delay = min(delay * 2, window)
+    if telemetry is not None:
+        telemetry.set_selection(len(filenames))
+
+    if parallel is not None:
+        from context_menu.parallel import call
+
+        call(path, module, function, filenames, params, parallel, ordered=ordered)
+    elif worker:
+        from context_menu import worker as resident_worker
+
+        resident_worker.call(path, module, function, filenames, params)
+    else:
+        load_function(path, module, function)(filenames, params)
@@ -0,0 +1,259 @@
+"""
+The platform independent form of a menu, which the backends compile.
+
+Lowering resolves what doesn't depend on the platform once: where the python functions
+live, the normalized command variables and the type. The nodes are immutable and hashed by
+their content, so they can be used as cache keys, for example by the backends to reuse the
+commands they created. Menus keep the hash of their content, so it isn't recomputed for every lookup.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING, NamedTuple
+import functools
+import os
+
+if TYPE_CHECKING:
+    from typing import Iterable, Union
+    from types import FunctionType
+
+    from context_menu.menus import ItemType
+
+    Node = Union["Menu", "Command"]
+
+
+class Function(NamedTuple):
+    """
+    The location of a python function, unpacks like the tuple of get_method_info.
+    """
+
+    name: str
+    module: str
+    directory: str
+
+
+class Command(NamedTuple):
+    """
+    A lowered ContextCommand.
+    """
+
+    name: str
+    command: str | None
+    function: Function | None
+    params: str
+    command_vars: tuple[str, ...] | None
+    icon_path: str | None
+    worker: bool
+    coalesce: bool
+    notify_exit: bool
+    execution: str
+    parallel: str | None
+    profile: str | None
+    launch: str
+    ordered: bool
+
+    isMenu = False
+
+
+class Menu(NamedTuple):
+    """
+    A lowered ContextMenu, type is only set for the top-level menu.
+    """
+
+    name: str
+    items: tuple[Node, ...]
+    icon_path: str | None
+    type: str | tuple[str, ...] | None
+    content_hash: int
+
+    isMenu = True
+
+    @property
+    def sub_items(self) -> tuple[Node, ...]:
+        return self.items
+
+    def __hash__(self) -> int:
+        return self.content_hash
+
+    def __eq__(self, other: object) -> bool:
+        """
+        Compares the menus with a stack instead of tuple equality, which recurses into every submenu.
+        """
+        stack: list[tuple[object, object]] = [(self, other)]
+        # Submenus repeated in both trees are compared once
+        compared: set[tuple[int, int]] = set()
+        while stack:
+            left, right = stack.pop()
+            if left is right:
+                continue
+            if not isinstance(left, Menu) or not isinstance(right, Menu):
+                if isinstance(left, Menu) or isinstance(right, Menu) or left != right:
+                    return False
+                continue
+            if (id(left), id(right)) in compared:
+                continue
+            compared.add((id(left), id(right)))
+            if (
+                left.content_hash != right.content_hash
+                or (left.name, left.icon_path, left.type) != (right.name, right.icon_path, right.type)
+                or len(left.items) != len(right.items)
+            ):
+                return False
+            stack.extend(zip(left.items, right.items))
+        return True
+
+    def __ne__(self, other: object) -> bool:
+        return not self == other
+
+
+@functools.lru_cache(maxsize=None)
+def locate(function: FunctionType) -> Function:
+    """
+    Returns where function lives. Cached, as inspect.getfile is the slowest part of a compile.
+    """
+    # inspect imports half of the standard library, menus that are only imported don't need it
+    import inspect
+
+    func_file_path = os.path.abspath(inspect.getfile(function))
+
+    func_dir_path = os.path.dirname(func_file_path).replace("\\", "/")
+    func_file_name = os.path.splitext(os.path.basename(func_file_path))[0]
+
+    return Function(function.__name__, func_file_name, func_dir_path)
+
+
+@functools.lru_cache(maxsize=65536)
+def make_command(
+    name: str,
+    command: str | None,
+    python: FunctionType | None,
+    params: str,
+    command_vars: tuple[str, ...] | None,
+    icon_path: str | None,
+    worker: bool,
+    coalesce: bool,
+    notify_exit: bool = False,
+    execution: str = "inline",
+    parallel: str | None = None,
+    profile: str | None = None,
+    launch: str = "console",
+    archive: str | None = None,
+    ordered: bool = True,
+) -> Command:
+    """
+    Returns the Command for the fields of a ContextCommand, commands used in several menus are lowered once.
+
+    archive is the path of the archive the function is imported from (see archive_path).
+    """
+    function = locate(python) if python is not None else None
+    if function is not None and archive is not None:
+        function = Function(function.name, function.module, archive)
+    if command_vars is not None:
+        command_vars = tuple(var.upper() for var in command_vars)
+    return Command(
+        name,
+        command,
+        function,
+        params,
+        command_vars,
+        icon_path,
+        worker,
+        coalesce,
+        notify_exit,
+        execution,
+        parallel,
+        profile,
+        launch,
+        ordered,
+    )
+
+
+def archive_path(python: FunctionType | None, archive: bool) -> str | None:
+    """
+    Returns the path of the archive of the module of python if archive is True, building it if its sources changed.
+
+    Not cached, the path changes with the content of the archive (see context_menu.archive).
+    """
+    if python is None or not archive:
+        return None
+    from context_menu.archive import build_archive
+
+    function = locate(python)
+    return build_archive(function.directory, function.module).replace("\\", "/")
+
+
+def make_menu(
+    name: str,
+    items: tuple[Node, ...],
+    icon_path: str | None,
+    type: str | Iterable[str] | None = None,
+) -> Menu:
+    """
+    Returns the Menu for the given items, type can also be a list of types.
+    """
+    if isinstance(type, str):
+        type = type.upper()
+    elif type is not None:
+        type = tuple(item.upper() for item in type)
+    # The hashes of menu items are stored, so this doesn't go through the whole tree
+    content_hash = hash((name, icon_path, type, tuple(map(hash, items))))
+    return Menu(name, items, icon_path, type, content_hash)
+
+
+def lower_command(item: ItemType) -> Command:
+    """
+    Lowers a ContextCommand.
+    """
+    return make_command(
+        item.name,
+        item.command,
+        item.python,
+        item.params,
+        tuple(item.command_vars) if item.command_vars is not None else None,
+        item.icon_path,
+        item.worker,
+        item.coalesce,
+        item.notify_exit,
+        item.execution,
+        item.parallel,
+        item.profile,
+        item.launch,
+        archive_path(item.python, item.archive),
+        item.ordered,
+    )
+
+
+def lower_items(items: Iterable[ItemType | Node]) -> tuple[Node, ...]:
+    """
+    Lowers the items of a menu. Items that are already lowered are kept.
+
+    Like context_menu.tree.walk, this doesn't recurse, so deep menus don't hit the recursion limit.
+    """
+    lowered_items: list[Node] = []
+    # The items left to lower, the lowered ones and the menu they belong to, for every open menu
+    stack: list[tuple[Iterable, list[Node], ItemType | None]] = [
+        (iter(items), lowered_items, None)
+    ]
+    while stack:
+        children, lowered, menu = stack[-1]
+        for item in children:
+            if isinstance(item, (Menu, Command)):
+                lowered.append(item)
+            elif item.isMenu:
+                stack.append((iter(item.sub_items), [], item))
+                break
+            else:
+                lowered.append(lower_command(item))
+        else:
+            stack.pop()
+            if menu is not None:
+                stack[-1][1].append(make_menu(menu.name, tuple(lowered), menu.icon_path))
+
+    return tuple(lowered_items)
+
+
+def lower(menu: ItemType | Menu) -> Menu:
+    """
+    Lowers a top-level ContextMenu.
+    """
+    if isinstance(menu, Menu):
+        return menu
+    return make_menu(menu.name, lower_items(menu.sub_items), menu.icon_path, menu.type)
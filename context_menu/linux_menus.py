@@ -1,14 +1,31 @@
 # imports -------------------------------------------------
 from __future__ import annotations
 from typing import TYPE_CHECKING
+import hashlib
+import importlib.util
+import io
 import os
+import py_compile
+import sys
+import tempfile
 from enum import Enum
 
+from context_menu.ir import lower_items
+from context_menu.tree import walk
+
 if TYPE_CHECKING:
+    from typing import BinaryIO, Callable, Iterable, TextIO
+
+    from context_menu.ir import Node
     from context_menu.menus import ContextMenu, ItemType, ActivationType, CommandVar
 
 # code_preset.py -------------------------------------
 
+# Types whose menus are shown on the background of a folder instead of on files
+BACKGROUND_TYPES = ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND", "DESKTOP"]
+# Types the generated providers match besides extensions and MIME types
+NAMED_TYPES = ["FILES", "DIRECTORY", "DRIVE"] + BACKGROUND_TYPES
+
 
 class ExistingCode(Enum):
     """
@@ -25,7 +42,7 @@ try:
 except:
 \tgi.require_version('Nautilus', '4.0')
 
-from gi.repository import Nautilus, GObject
+from gi.repository import Nautilus, GObject, GLib, Gio
 
 # -------------------------------------------- #
 
@@ -33,34 +50,510 @@ try:
 \tfrom urllib import unquote
 except ImportError:
 \tfrom urllib.parse import unquote
-    """
 
+# Set by the extensions compiled with telemetry
+telemetry = None
+
+
+def current_activation():
+\treturn telemetry.current if telemetry is not None else None
+
+
+def selection_path(subFile):
+\turi = subFile.get_uri()
+\tif uri.startswith("file://"):
+\t\treturn unquote(uri[7:])
+\t# Remote locations are passed as they are, resolving them could block on the network
+\treturn uri
+
+
+# The paths of the selected files, only decoded when they are accessed
+class LazySelection(object):
+\tdef __init__(self, files):
+\t\tif not isinstance(files, (list, tuple)):
+\t\t\tfiles = [files]
+\t\tself.files = files
+
+\tdef __len__(self):
+\t\treturn len(self.files)
+
+\tdef __getitem__(self, index):
+\t\tif isinstance(index, slice):
+\t\t\treturn [selection_path(subFile) for subFile in self.files[index]]
+\t\treturn selection_path(self.files[index])
+
+\tdef __iter__(self):
+\t\tfor subFile in self.files:
+\t\t\tyield selection_path(subFile)
+
+
+# Nautilus can't tell the background of a folder from the desktop, so both get the same menus
+BACKGROUND_KINDS = ("DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND", "DESKTOP")
+
+
+# The types a file matches, only from what Nautilus already knows about it, nothing is read from the disk
+def file_kinds(subFile, match_mime):
+\tif subFile.is_directory():
+\t\tif subFile.get_mount() is not None:
+\t\t\treturn {"DIRECTORY", "DRIVE"}
+\t\treturn {"DIRECTORY"}
+
+\tkinds = {"FILES"}
+\tname = subFile.get_name()
+\tif "." in name:
+\t\tkinds.add(name[name.rindex("."):].lower())
+\tif match_mime:
+\t\tmime_type = subFile.get_mime_type()
+\t\tkinds.add(mime_type)
+\t\tkinds.add(mime_type.split("/")[0] + "/*")
+\treturn kinds
+
+
+# The types every selected file matches
+def selection_kinds(files, match_mime):
+\tkinds = None
+\tfor subFile in files:
+\t\tif kinds is None:
+\t\t\tkinds = file_kinds(subFile, match_mime)
+\t\telse:
+\t\t\tkinds &= file_kinds(subFile, match_mime)
+\t\tif not kinds:
+\t\t\tbreak
+\treturn kinds or ()
+"""
+
+    # The runtime helpers after CODE_HEAD are only emitted when a compiled item needs them, see RUNTIME_CODE
+
+    # Loads the modules of the python functions, for every handler calling one
+    MODULES_CODE = """
+import importlib
+import importlib.machinery
+import importlib.util
+import threading
+import zipimport
+
+
+# The modules of the python functions, imported when a handler first needs them
+loaded_modules = {}
+# The (name, directory) of the modules of the python functions, by the key the handlers load them with
+module_files = {}
+# A lock per module, so a click waits for the prewarm or a pool thread importing the same module
+module_locks = {}
+module_locks_lock = threading.Lock()
+
+
+def load_module(name):
+\tmodule = loaded_modules.get(name)
+\tif module is None:
+\t\twith module_locks_lock:
+\t\t\tlock = module_locks.setdefault(name, threading.Lock())
+\t\twith lock:
+\t\t\tmodule = loaded_modules.get(name)
+\t\t\tif module is None:
+\t\t\t\tlocation = module_files.get(name)
+\t\t\t\tmodule = importlib.import_module(name) if location is None else import_file(name, *location)
+\t\t\t\tloaded_modules[name] = module
+\treturn module
+
+
+# Imports a module from its file under a key of its own, so the modules with the same name from other
+# directories, of this extension or of another one, don't replace each other. See context_menu.worker.import_file
+def import_file(key, name, directory):
+\tmodule = sys.modules.get(key)
+\tif module is not None:
+\t\treturn module
+\tspec = importlib.machinery.PathFinder.find_spec(name, [directory])
+\tif spec is None or spec.origin is None:
+\t\traise ImportError("No module named {!r} in {}".format(name, directory), name=name)
+\tcode = None
+\tif isinstance(spec.loader, zipimport.zipimporter):
+\t\t# A zipimporter only loads the modules under their own name, its code is run in a module named key
+\t\tcode = spec.loader.get_code(name)
+\t\tlocations = spec.submodule_search_locations
+\t\tspec = importlib.machinery.ModuleSpec(key, spec.loader, origin=spec.origin, is_package=locations is not None)
+\t\tspec.submodule_search_locations = locations
+\t\tspec.has_location = True
+\telse:
+\t\tspec = importlib.util.spec_from_file_location(key, spec.origin, submodule_search_locations=spec.submodule_search_locations)
+\tmodule = importlib.util.module_from_spec(spec)
+\tsys.modules[key] = module
+\ttry:
+\t\tif code is None:
+\t\t\tspec.loader.exec_module(module)
+\t\telse:
+\t\t\texec(code, module.__dict__)
+\texcept BaseException:
+\t\tdel sys.modules[key]
+\t\traise
+\treturn module
+
+
+# Finds the modules the python functions import from their directories, after everything on sys.path
+class MenuModuleFinder(object):
+\tdef __init__(self, directories):
+\t\tself.directories = directories
+
+\tdef find_spec(self, name, path=None, target=None):
+\t\tif path is not None or not self.directories:
+\t\t\treturn None
+\t\treturn importlib.machinery.PathFinder.find_spec(name, self.directories, target)
+
+
+# The directories of the python functions of the extension
+menu_directories = []
+
+
+# Nothing is added to sys.path or in front of the finders Nautilus shares with the other extensions
+def install_finders(files, directories):
+\tmodule_files.update(files)
+\tmenu_directories.extend(directories)
+\tsys.meta_path.append(MenuModuleFinder(directories))
+"""
+
+    # With prewarm
+    PREWARM_CODE = """
+import threading
+import traceback
+
+
+# Imports the modules in the background once Nautilus is idle, so the first click is fast as well
+def prewarm(names):
+\tdef run():
+\t\tfor name in names:
+\t\t\ttry:
+\t\t\t\tload_module(name)
+\t\t\texcept Exception:
+\t\t\t\ttraceback.print_exc()
+
+\tthreading.Thread(target=run, daemon=True).start()
+\treturn False
+"""
+
+    # With telemetry
+    TELEMETRY_CODE = """
+import time
+
+
+# Appends records to the telemetry store of the menu, in the format read by context_menu.telemetry
+class Telemetry(object):
+\tdef __init__(self, path):
+\t\ttry:
+\t\t\tself.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+\t\texcept OSError:
+\t\t\tself.fd = None
+\t\t# The (command, start, selection size) of the handler being run, kept by the commands it starts
+\t\tself.current = None
+
+\t# A single write per record, so the records of the threads and of other processes don't mix
+\tdef record(self, event, command, start, size, status):
+\t\tif self.fd is None:
+\t\t\treturn
+\t\tline = "{:.6f}\\t{}\\t{}\\t{:.3f}\\t{}\\t{}\\n".format(
+\t\t\ttime.time(), event, command, (time.perf_counter() - start) * 1000, size, status
+\t\t)
+\t\ttry:
+\t\t\tos.write(self.fd, line.encode("utf-8"))
+\t\texcept OSError:
+\t\t\tpass
+
+\tdef finished(self, activation, status):
+\t\tif activation is not None:
+\t\t\tcommand, start, size = activation
+\t\t\tself.record("exit", command, start, size, status)
+
+
+# Records how long a handler blocks Nautilus, the commands it starts record their exit once they finish
+def timed(command, handler):
+\tdef run(menu, files):
+\t\tstart = time.perf_counter()
+\t\tsize = len(files) if isinstance(files, (list, tuple)) else 1
+\t\ttelemetry.current = (command, start, size)
+\t\tstatus = 1
+\t\ttry:
+\t\t\thandler(menu, files)
+\t\t\tstatus = 0
+\t\tfinally:
+\t\t\ttelemetry.current = None
+\t\t\ttelemetry.record("activate", command, start, size, status)
+
+\treturn run
+"""
+
+    # For the commands and the pools reporting their failures
+    NOTIFY_CODE = """
+# Shows a notification through Nautilus, only call it from the main loop
+def notify_failure(title, body):
+\tapplication = Gio.Application.get_default()
+\tif application is not None:
+\t\tnotification = Gio.Notification.new(title)
+\t\tnotification.set_body(body)
+\t\tapplication.send_notification(None, notification)
+\treturn False
+"""
+
+    # For the shell commands
+    COMMAND_CODE = """
+# Runs a shell command without blocking Nautilus, the child is reaped on the main loop once it exits
+def run_command(command, notify=False):
+\tpid = GLib.spawn_async(["/bin/sh", "-c", command], flags=GLib.SpawnFlags.DO_NOT_REAP_CHILD)[0]
+\tGLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid, command_exited, command, notify, current_activation())
+
+
+def command_exited(pid, status, command, notify, activation=None):
+\tGLib.spawn_close_pid(pid)
+\tif os.WIFSIGNALED(status):
+\t\tcode = -os.WTERMSIG(status)
+\t\tmessage = "killed by signal {}".format(os.WTERMSIG(status))
+\telse:
+\t\tcode = os.WEXITSTATUS(status)
+\t\tmessage = "exited with status {}".format(code)
+\tif activation is not None:
+\t\ttelemetry.finished(activation, code)
+\tif code == 0:
+\t\treturn
+
+\tsys.stderr.write("{}: {}\\n".format(command, message))
+\tif notify:
+\t\tnotify_failure("Command failed", "{}\\n{}".format(command, message))
+"""
+
+    # For the python functions run in a thread or process pool
+    POOL_CODE = """
+import traceback
+
+
+# The pools running python functions off the main loop, shared by all the handlers and created on first use
+executors = {}
+
+
+# multiprocessing reads sys.argv whenever it starts a process, which the python embedded in Nautilus may not set.
+# It is only added when missing, Nautilus and the other extensions never see a value change. It isn't removed
+# afterwards, as the pools start their processes on later submits too
+def ensure_argv():
+\tif not hasattr(sys, "argv"):
+\t\tsys.argv = [""]
+
+
+def get_executor(mode, python):
+\texecutor = executors.get(mode)
+\tif executor is None:
+\t\tfrom concurrent import futures
+\t\tpool_size = max(1, min(4, os.cpu_count() or 1))
+\t\tif mode == "process":
+\t\t\timport multiprocessing
+\t\t\t# Nautilus isn't a python interpreter, the processes run the one the menu was compiled with
+\t\t\tcontext = multiprocessing.get_context("spawn")
+\t\t\tcontext.set_executable(python)
+\t\t\tensure_argv()
+\t\t\t# The processes import context_menu.worker by name, which loads the functions from their files
+\t\t\tsetup = "import sys; sys.path.extend({!r})".format(menu_directories)
+\t\t\texecutor = futures.ProcessPoolExecutor(pool_size, mp_context=context, initializer=exec, initargs=(setup, {}))
+\t\telse:
+\t\t\texecutor = futures.ThreadPoolExecutor(pool_size, thread_name_prefix="context_menu")
+\t\texecutors[mode] = executor
+\treturn executor
+
+
+def call_function(module, function, filenames, params):
+\treturn getattr(load_module(module), function)(filenames, params)
+
+
+# Runs a python function in the thread or process pool, the selection is resolved before, on the main loop
+def run_function(mode, module, function, filenames, params, notify=False, python=None):
+\tdef submit():
+\t\tif mode == "process":
+\t\t\t# The function is only imported by the process running it
+\t\t\tname, directory = module_files[module]
+\t\t\trun = load_module("context_menu.worker").run
+\t\t\treturn get_executor(mode, python).submit(run, directory, name, function, filenames, params)
+\t\treturn get_executor(mode, python).submit(call_function, module, function, filenames, params)
+
+\ttry:
+\t\tfuture = submit()
+\texcept RuntimeError:
+\t\t# The pool is broken, for example because one of its processes was killed
+\t\texecutors.pop(mode, None)
+\t\tfuture = submit()
+\tactivation = current_activation()
+\tfuture.add_done_callback(lambda future: function_done(future, module.split("@")[0] + "." + function, notify, activation))
+\treturn future
+
+
+def function_done(future, name, notify, activation=None):
+\tif future.cancelled():
+\t\treturn
+\tif activation is not None:
+\t\ttelemetry.finished(activation, 0 if future.exception() is None else 1)
+\tif future.exception() is None:
+\t\treturn
+\terror = future.exception()
+\tmessage = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+\tsys.stderr.write("{} failed:\\n{}".format(name, message))
+\tif notify:
+\t\tGLib.idle_add(notify_failure, name + " failed", str(error) or type(error).__name__)
+"""
+
+    # For the python functions spreading the selection over processes
+    PARALLEL_CODE = """
+# Spreads the selection over a pool of processes from a thread of the pool, see context_menu.parallel
+def run_parallel(path, module, function, filenames, params, mode, notify=False, python=None, ordered=True):
+\tparallel = load_module("context_menu.parallel")
+\tensure_argv()
+\tfuture = get_executor("thread", python).submit(parallel.call, path, module, function, filenames, params, mode, python=python, ordered=ordered)
+\tactivation = current_activation()
+\tfuture.add_done_callback(lambda future: function_done(future, module + "." + function, notify, activation))
+\treturn future
+"""
+
+    # For the python functions run by the resident worker
+    WORKER_CODE = """
+# Hands the selection to the resident worker from a thread of the pool, starting the worker takes a while
+def run_worker(path, module, function, filenames, params, python=None):
+\tdef send():
+\t\tload_module("context_menu.worker").call(path, module, function, filenames, params, python=python)
+
+\tfuture = get_executor("thread", python).submit(send)
+\tactivation = current_activation()
+\tfuture.add_done_callback(lambda future: function_done(future, module + "." + function, False, activation))
+\treturn future
+"""
+
+    # Takes the name and the class attributes, the dispatch tables map every type to the
+    # (position, method) of the menus shown for it
     CLASS_TEMPLATE = """
 class {}MenuProvider(GObject.GObject, Nautilus.MenuProvider):
+{}
 \tdef __init__(self):
 \t\tpass
+
+\tdef dispatch(self, table, kinds, files):
+\t\tbuilders = []
+\t\tfor kind in kinds:
+\t\t\tbuilders.extend(table.get(kind, ()))
+\t\titems = []
+\t\t# A menu whose types overlap, like DIRECTORY and DRIVE, is in several lists of the table
+\t\tfor position, builder in sorted(set(builders)):
+\t\t\titems.extend(getattr(self, builder)(files))
+\t\treturn items
 """
 
     METHOD_HANDLER_TEMPLATE = """
 \tdef {}(self, menu, files):
-\t\tfilenames = [unquote(subFile.get_uri()[7:]) for subFile in files]
-\t\t{}.{}({}, "{}")
+\t\tfilenames = LazySelection(files)
+\t\tload_module("{}").{}({}, "{}")
+
+"""
+
+    PROFILED_HANDLER_TEMPLATE = """
+\tdef {}(self, menu, files):
+\t\tfilenames = LazySelection(files)
+\t\tload_module("context_menu.profiling").call(load_module("{}").{}, filenames, "{}", "{}", "{}")
+
+"""
+
+    POOL_HANDLER_TEMPLATE = """
+\tdef {}(self, menu, files):
+\t\trun_function("{}", "{}", "{}", list(LazySelection(files)), "{}"{}, python="{}")
+
+"""
+
+    PARALLEL_HANDLER_TEMPLATE = """
+\tdef {}(self, menu, files):
+\t\trun_parallel("{}", "{}", "{}", list(LazySelection(files)), "{}", "{}"{}, python="{}"{})
+
+"""
+
+    WORKER_HANDLER_TEMPLATE = """
+\tdef {}(self, menu, files):
+\t\trun_worker("{}", "{}", "{}", list(LazySelection(files)), "{}", python="{}")
 
 """
 
     COMMAND_HANDLER_TEMPLATE = """
 \tdef {}(self, menu, files):
-\t\tfilepath = [unquote(subFile.get_uri()[7:]) for subFile in files][0]
-\t\tos.system('{}'{})
+{}\t\trun_command('{}'{}{})
 
+"""
+
+    # Only emitted when the command actually uses the FILENAME variable
+    FILEPATH = """\t\tfilepath = LazySelection(files)[0]
 """
 
     FILE_ITEMS = """\tdef get_file_items(self, *args):
-\t\tfiles = args[-1]"""
+\t\tfiles = args[-1]
+\t\treturn self.dispatch(self.file_dispatch, selection_kinds(files, self.match_mime), files)"""
     BACKGROUND_ITEMS = """\tdef get_background_items(self, *args):
-\t\tfiles = args[-1]"""
-    SUB_MENU = "submenu{} = Nautilus.Menu()"
-    MENU_ITEM = 'menuitem{} = Nautilus.MenuItem(name = "ExampleMenuProvider::{}", label="{}", tip = "{}", icon = "{}")'
+\t\treturn self.dispatch(self.background_dispatch, BACKGROUND_KINDS, args[-1])"""
+    # Used instead with telemetry, recording how long every selection change takes
+    TIMED_FILE_ITEMS = """\tdef get_file_items(self, *args):
+\t\tstart = time.perf_counter()
+\t\tfiles = args[-1]
+\t\titems = self.dispatch(self.file_dispatch, selection_kinds(files, self.match_mime), files)
+\t\ttelemetry.record("items", "", start, len(files), 0)
+\t\treturn items"""
+    TIMED_BACKGROUND_ITEMS = """\tdef get_background_items(self, *args):
+\t\tstart = time.perf_counter()
+\t\titems = self.dispatch(self.background_dispatch, BACKGROUND_KINDS, args[-1])
+\t\ttelemetry.record("items", "", start, 1, 0)
+\t\treturn items"""
+    ITEMS_BUILDER = """\tdef {}(self, files):"""
+
+    # Used when the menu items are built once and reused across selections.
+    CACHED_CLASS_TEMPLATE = """
+class {}MenuProvider(GObject.GObject, Nautilus.MenuProvider):
+{}
+\tdef __init__(self):
+\t\tself.items = {{}}
+\t\tself.files = None
+
+\tdef activate(self, menu, handler):
+\t\thandler(menu, self.files)
+
+\tdef dispatch(self, table, kinds, files):
+\t\tself.files = files
+\t\tbuilders = []
+\t\tfor kind in kinds:
+\t\t\tbuilders.extend(table.get(kind, ()))
+\t\titems = []
+\t\t# A menu whose types overlap, like DIRECTORY and DRIVE, is in several lists of the table
+\t\tfor position, builder in sorted(set(builders)):
+\t\t\tif builder not in self.items:
+\t\t\t\tself.items[builder] = getattr(self, builder)(files)
+\t\t\titems.extend(self.items[builder])
+\t\treturn items
+"""
+    SUB_MENU = "submenu_{} = Nautilus.Menu()"
+    MENU_ITEM = 'menuitem_{} = Nautilus.MenuItem(name = "ExampleMenuProvider::{}", label="{}", tip = "{}", icon = "{}")'
+
+
+# The runtime helpers in the order they are emitted, after CODE_HEAD
+RUNTIME_CODE = (
+    ExistingCode.MODULES_CODE,
+    ExistingCode.PREWARM_CODE,
+    ExistingCode.TELEMETRY_CODE,
+    ExistingCode.NOTIFY_CODE,
+    ExistingCode.COMMAND_CODE,
+    ExistingCode.POOL_CODE,
+    ExistingCode.PARALLEL_CODE,
+    ExistingCode.WORKER_CODE,
+)
+# The runtime helpers a runtime helper calls
+RUNTIME_DEPENDENCIES = {
+    ExistingCode.PREWARM_CODE: (ExistingCode.MODULES_CODE,),
+    ExistingCode.COMMAND_CODE: (ExistingCode.NOTIFY_CODE,),
+    ExistingCode.POOL_CODE: (ExistingCode.MODULES_CODE, ExistingCode.NOTIFY_CODE),
+    ExistingCode.PARALLEL_CODE: (ExistingCode.POOL_CODE,),
+    ExistingCode.WORKER_CODE: (ExistingCode.POOL_CODE,),
+}
+# The runtime helpers the handlers of a template call
+HANDLER_RUNTIME = {
+    ExistingCode.METHOD_HANDLER_TEMPLATE: ExistingCode.MODULES_CODE,
+    ExistingCode.PROFILED_HANDLER_TEMPLATE: ExistingCode.MODULES_CODE,
+    ExistingCode.WORKER_HANDLER_TEMPLATE: ExistingCode.WORKER_CODE,
+    ExistingCode.POOL_HANDLER_TEMPLATE: ExistingCode.POOL_CODE,
+    ExistingCode.PARALLEL_HANDLER_TEMPLATE: ExistingCode.PARALLEL_CODE,
+    ExistingCode.COMMAND_HANDLER_TEMPLATE: ExistingCode.COMMAND_CODE,
+}
 
 
 # code_builder.py ----------------------------------
@@ -74,76 +567,225 @@ class CodeBuilder:
     def __init__(
         self,
         name: str,
-        body_commands: list[str],
+        sections: list[tuple[ActivationType | str | list[str], str, list[str]]],
         script_dirs: list[str],
         funcs: list[str],
         imports: list[str],
-        type: ActivationType | str,
+        cache_items: bool = False,
+        prewarm: bool = False,
+        telemetry: str | None = None,
+        modules: dict[str, tuple[str, str]] | None = None,
+        runtime: Iterable[ExistingCode] = (),
     ) -> None:
         """
-        Pass the list of body_commands, the directories of all the scripts, the
-        list of the function names, the list of the imports, and the type.
+        Pass the sections, the directories of all the scripts, the list of the
+        function names and the list of the imports.
+
+        modules maps the keys the handlers load the modules of the python functions with
+        to their name and directory (see context_menu.worker.module_key).
+
+        Every section holds the type or list of types, the method name and the
+        body_commands of one menu. The provider only builds the menus whose type matches the selection,
+        which it looks up in dispatch tables computed here.
+
+        If cache_items is True, the items of a menu are built on its first use and
+        reused for every following selection.
+
+        The handlers import their module on first use. With prewarm, the imports are
+        loaded in a background thread once Nautilus is idle.
+
+        telemetry is the path of the store the provider records its timings to (see context_menu.telemetry),
+        the handlers have to be wrapped with timed by the caller.
+
+        runtime holds the runtime helpers the handlers call (see HANDLER_RUNTIME), only these and the
+        ones the other options need are written after CODE_HEAD.
         """
         self.name = name
-        self.body_commands = body_commands
-        self.script_dirs = list(set(script_dirs))
+        self.sections = sections
+        # Deduplicated in a stable order, so the same menu always generates the same code
+        self.script_dirs = list(dict.fromkeys(script_dirs))
         self.funcs = funcs
-        self.imports = list(set(imports))
-        self.type = type.upper()
+        self.imports = list(dict.fromkeys(imports))
+        self.prewarm = prewarm
+        self.cache_items = cache_items
+        self.telemetry = telemetry
+        self.modules = modules or {}
+        self.runtime = set(runtime)
 
     def build_script_dirs(self) -> str:
         """
-        Creates the header of necessary path configurations.
+        Creates the header installing the import finders of the extension.
+
+        The modules of the functions are imported from their file, under a key of their own, and
+        the directories aren't added to the sys.path Nautilus shares with every other extension.
+
+        Handled automatically by compile.
+        """
+        if not self.script_dirs and not self.modules:
+            return ""
+        return "install_finders({!r}, {!r})".format(self.modules, self.script_dirs)
 
-        Adds all the 'sys.path.appends' in order to immport the classes and functions.
+    def build_runtime(self) -> list[str]:
+        """
+        Returns the runtime helpers the extension needs, with the ones they call.
 
         Handled automatically by compile.
         """
-        compiled_dirs = [f'sys.path.append("{x}")' for x in self.script_dirs]
-        return "\n".join(compiled_dirs)
+        needed = set(self.runtime)
+        if self.script_dirs or self.modules:
+            needed.add(ExistingCode.MODULES_CODE)
+        if self.prewarm and self.imports:
+            needed.add(ExistingCode.PREWARM_CODE)
+        if self.telemetry is not None:
+            needed.add(ExistingCode.TELEMETRY_CODE)
+
+        pending = list(needed)
+        while pending:
+            for dependency in RUNTIME_DEPENDENCIES.get(pending.pop(), ()):
+                if dependency not in needed:
+                    needed.add(dependency)
+                    pending.append(dependency)
+        return [runtime.value for runtime in RUNTIME_CODE if runtime in needed]
 
     def build_imports(self) -> str:
         """
         Creates the header of necessary imports.
 
+        The modules aren't imported when Nautilus loads the extension, only the prewarm is scheduled if enabled.
+
         Handled automatically by compile.
         """
-        compiled_imports = [f"import {x}" for x in self.imports]
-        return "\n".join(compiled_imports)
+        if not self.prewarm or not self.imports:
+            return ""
+        return "GLib.idle_add(prewarm, {})".format(sorted(self.imports))
+
+    def build_telemetry(self) -> str:
+        """
+        Creates the line opening the telemetry store, if enabled.
+
+        Handled automatically by compile.
+        """
+        if self.telemetry is None:
+            return ""
+        return "telemetry = Telemetry({!r})".format(self.telemetry)
+
+    def build_dispatch(self) -> tuple[dict[str, tuple], dict[str, tuple]]:
+        """
+        Creates the dispatch tables of the files and of the background.
+
+        They map every type to the (position, method) of the menus shown for it, so the
+        provider only looks up the types of the selection instead of testing every menu.
+
+        Handled automatically by compile.
+        """
+        file_dispatch: dict[str, tuple] = {}
+        background_dispatch: dict[str, tuple] = {}
+        for position, (types, method, _) in enumerate(self.sections):
+            if isinstance(types, str):
+                types = [types]
+            for type in types:
+                kind = dispatch_kind(type)
+                table = background_dispatch if kind in BACKGROUND_TYPES else file_dispatch
+                entries = table.get(kind, ())
+                # A type can be listed twice, like '.txt' and '.TXT'
+                if (position, method) not in entries:
+                    table[kind] = entries + ((position, method),)
+        return file_dispatch, background_dispatch
+
+    def write_items_method(self, out: TextIO, method: str, commands: list[str]) -> None:
+        """
+        Writes the method building the items of one menu.
+
+        Handled automatically by write.
+        """
+        out.write(ExistingCode.ITEMS_BUILDER.value.format(method))
+        for command in commands:
+            out.write("\n\t\t")
+            out.write(command)
+
+    def write(self, out: TextIO) -> None:
+        """
+        Writes the code file to out section by section, without assembling it in memory.
+        """
+        file_dispatch, background_dispatch = self.build_dispatch()
+        # MIME types are only asked from Nautilus if a menu is restricted to one
+        match_mime = any("/" in kind for kind in file_dispatch)
+        attributes = "".join(
+            "\t{} = {!r}\n".format(attribute, value)
+            for attribute, value in (
+                ("match_mime", match_mime),
+                ("file_dispatch", file_dispatch),
+                ("background_dispatch", background_dispatch),
+            )
+        )
+
+        template = ExistingCode.CLASS_TEMPLATE
+        if self.cache_items:
+            template = ExistingCode.CACHED_CLASS_TEMPLATE
+        class_dec = template.value.format(self.name, attributes)
+
+        for section in (
+            "",
+            ExistingCode.CODE_HEAD.value,
+            *self.build_runtime(),
+            self.build_script_dirs(),
+            self.build_imports(),
+            self.build_telemetry(),
+            class_dec,
+        ):
+            out.write(section)
+            out.write("\n")
+
+        write_joined(out, "\n\n", self.funcs)
+        out.write("\n")
+
+        file_items, background_items = ExistingCode.FILE_ITEMS, ExistingCode.BACKGROUND_ITEMS
+        if self.telemetry is not None:
+            file_items = ExistingCode.TIMED_FILE_ITEMS
+            background_items = ExistingCode.TIMED_BACKGROUND_ITEMS
+        items_methods = []
+        if file_dispatch:
+            items_methods.append(file_items.value)
+        if background_dispatch:
+            items_methods.append(background_items.value)
+        write_joined(out, "\n\n", items_methods)
+        for _, method, commands in self.sections:
+            out.write("\n\n")
+            self.write_items_method(out, method, commands)
+        out.write("\n    ")
 
     def compile(self) -> str:
         """
         Creates the code file.
         """
-        code_head = ExistingCode.CODE_HEAD.value
-        script_dirs_code = self.build_script_dirs()
-        imports_code = self.build_imports()
-        class_dec = ExistingCode.CLASS_TEMPLATE.value.format(self.name)
-        class_funcs = "\n\n".join(self.funcs)
-        class_type = ExistingCode.FILE_ITEMS.value
-        if self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"]:
-            class_type = ExistingCode.BACKGROUND_ITEMS.value
-        class_body = "\n".join(map(lambda x: "\t\t" + x, self.body_commands))
-
-        code_skeleton = """
-{}
-{}
-{}
-{}
-{}
-{}
-{}
-    """.format(
-            code_head,
-            script_dirs_code,
-            imports_code,
-            class_dec,
-            class_funcs,
-            class_type,
-            class_body,
-        )
+        code = io.StringIO()
+        self.write(code)
+        return code.getvalue()
+
+
+def dispatch_kind(type: ActivationType | str) -> str:
+    """
+    Returns the key of a type in the dispatch tables of the generated provider.
 
-        return code_skeleton
+    Extensions like '.txt' and MIME types like 'text/plain' or 'image/*' are matched
+    case-insensitively, anything else has to be one of NAMED_TYPES.
+    """
+    if "." in type or "/" in type:
+        return type.lower()
+    kind = type.upper()
+    if kind not in NAMED_TYPES:
+        raise ValueError(f"Unknown activation type {type!r}")
+    return kind
+
+
+def write_joined(out: TextIO, separator: str, parts: Iterable[str]) -> None:
+    """
+    Writes the parts to out like separator.join(parts), without joining them.
+    """
+    for index, part in enumerate(parts):
+        if index:
+            out.write(separator)
+        out.write(part)
 
 
 COMMAND_VARS = {
@@ -171,35 +813,68 @@ class Variable:
     Very simple class with no methods to help simplify the code.
     """
 
+    __slots__ = ("name", "code")
+
     def __init__(self, name: str, code: str) -> None:
         self.name = name
         self.code = code
 
 
+def extension_name(name: str) -> str:
+    """
+    Returns the name of the extension file of a menu.
+    """
+    # nautilus extensions doesn't work with filenames with spaces
+    # Example menu item -> ExampleMenuItem
+    return "".join([word.title() for word in name.split()]) if len(name.split()) > 0 else name
+
+
 class NautilusMenu:
     # Constructor, automatically handeled by menus.py
     def __init__(
-        self, name: str, sub_items: list[ItemType], type: ActivationType | str
+        self,
+        name: str,
+        sub_items: list[ItemType],
+        type: ActivationType | str | list[str],
+        cache_items: bool = False,
+        prewarm: bool = False,
+        telemetry: bool = False,
     ) -> None:
         """
-        Items required are the name of the top menu, the sub items, and the type.
+        Items required are the name of the top menu, the sub items, and the type or list of types.
+
+        With cache_items, the generated provider builds its menu items once and
+        only rebinds the current selection when an item is activated.
+
+        With prewarm, the modules of the python functions are imported in the
+        background after Nautilus started instead of on the first click.
+
+        With telemetry, the provider records its timings in the store of name (see context_menu.telemetry).
         """
-        # nautilus extensions doesn't work with filenames with spaces
-        # Example menu item -> ExampleMenuItem
-        self.name = (
-            "".join([word.title() for word in name.split()])
-            if len(name.split()) > 0
-            else name
-        )
-        self.sub_items = sub_items
+        self.name = extension_name(name)
+        self.sub_items = lower_items(sub_items)
         self.type = type
-        self.counter = 0
+        self.cache_items = cache_items
+        self.prewarm = prewarm
+        self.telemetry: str | None = None
+        if telemetry:
+            from context_menu.telemetry import store_path
+
+            self.telemetry = store_path(name)
+        # Number of uses of every identifier
+        self.identifiers: dict[str, int] = {}
 
         # Create all the necessary lists that will be used later on
         self.commands: list[str] = []
         self.script_dirs: list[str] = []
         self.funcs: list[str] = []
         self.imports: list[str] = []
+        # The name and directory of the modules of the python functions, by key
+        self.modules: dict[str, tuple[str, str]] = {}
+        # The runtime helpers the handlers call
+        self.runtime: set[ExistingCode] = set()
+        # Handlers by template and arguments, so identical commands share one
+        self.handlers: dict[tuple[ExistingCode, tuple[str, ...]], Variable] = {}
 
     # Methods to create action code
     def append_item(self, menu: str, item: str) -> str:
@@ -214,164 +889,351 @@ class NautilusMenu:
         """
         return "{}.set_submenu({})".format(item, menu)
 
-    def connect(self, item: str, func: str) -> str:
+    def connect(self, item: str, func: str, name: str) -> str:
         """
         Creates a necessary body_command.
+
+        Cached menus don't capture the selection, the provider passes the
+        current one when the item is activated. With telemetry, the activations
+        are recorded under name.
         """
+        if self.telemetry is not None:
+            func = 'timed("{}", {})'.format(name, func)
+        if self.cache_items:
+            return '{}.connect("activate", self.activate, {})'.format(item, func)
         return '{}.connect("activate", {}, files)'.format(item, func)
 
     # Methods to create variable declarations
 
-    def generate_menu(self) -> Variable:
+    def identifier(self, kind: str, *parts: str) -> str:
+        """
+        Returns an identifier derived from what it names, so adding an item doesn't rename every other one.
+
+        Repeated parts, like two items with the same name in one menu, are numbered.
+        """
+        digest = hashlib.sha1("\0".join((kind,) + parts).encode("utf-8"))
+        identifier = digest.hexdigest()[:8]
+        key = kind + identifier
+        self.identifiers[key] = self.identifiers.get(key, 0) + 1
+        if self.identifiers[key] > 1:
+            identifier += "_{}".format(self.identifiers[key])
+        return identifier
+
+    def generate_menu(self, name: str, parent: str) -> Variable:
         """
-        Generates a nautilus menu variable.
+        Generates a nautilus menu variable for the menu name in the menu variable parent.
         """
         base_menu = ExistingCode.SUB_MENU.value
-        base_menu = base_menu.format(self.counter)
-        self.counter += 1
+        base_menu = base_menu.format(self.identifier("menu", parent, name))
 
         return Variable(base_menu.split(" = ")[0], base_menu)
 
-    def generate_item(self, name: str) -> Variable:
+    def generate_item(self, name: str, parent: str) -> Variable:
         """
-        Generates a nautilus command variable.
+        Generates a nautilus command variable for the item name in the menu variable parent.
         """
         base_command = ExistingCode.MENU_ITEM.value
-        formatted_item = base_command.format(self.counter, name, name, "", "")
-        self.counter += 1
+        formatted_item = base_command.format(
+            self.identifier("item", parent, name), name, name, "", ""
+        )
 
         return Variable(formatted_item.split(" = ")[0], formatted_item)
 
+    def generate_handler(self, template: ExistingCode, *args: str) -> Variable:
+        """
+        Generates a handler method from a template and adds it to the funcs.
+
+        A handler identical to one that was already generated is reused instead.
+        """
+        key = (template, args)
+        if key in self.handlers:
+            return self.handlers[key]
+
+        func_name = "method_handler_{}".format(
+            self.identifier("handler", template.name, *args)
+        )
+        created_func = template.value.format(func_name, *args)
+        self.funcs.append(created_func)
+        self.runtime.add(HANDLER_RUNTIME[template])
+
+        handler = Variable(f"self.{func_name}", created_func)
+        self.handlers[key] = handler
+        return handler
+
     def generate_python_func(
         self, class_origin: str, class_func: str, params: str
     ) -> Variable:
         """
         Generates a command attached to a python function
         """
-        func_name = "method_handler{}".format(self.counter)
-        created_func = ExistingCode.METHOD_HANDLER_TEMPLATE.value.format(
-            func_name, class_origin, class_func, "filenames", params
+        return self.generate_handler(
+            ExistingCode.METHOD_HANDLER_TEMPLATE,
+            class_origin,
+            class_func,
+            "filenames",
+            params,
+        )
+
+    def generate_profiled_func(
+        self, class_origin: str, class_func: str, params: str, name: str, profile: str
+    ) -> Variable:
+        """
+        Generates a command calling a python function under the profilers of profile (see context_menu.profiling)
+        """
+        return self.generate_handler(
+            ExistingCode.PROFILED_HANDLER_TEMPLATE,
+            class_origin,
+            class_func,
+            params,
+            name,
+            profile,
+        )
+
+    def generate_worker_func(
+        self, class_origin: str, class_func: str, class_dir: str, params: str
+    ) -> Variable:
+        """
+        Generates a command forwarding the selection to the resident worker
+        """
+        return self.generate_handler(
+            ExistingCode.WORKER_HANDLER_TEMPLATE,
+            class_dir,
+            class_origin,
+            class_func,
+            params,
+            sys.executable,
         )
 
-        self.counter += 1
+    def generate_pool_func(
+        self,
+        execution: str,
+        class_origin: str,
+        class_func: str,
+        params: str,
+        notify_exit: bool = False,
+    ) -> Variable:
+        """
+        Generates a command running a python function in the thread or process pool of the extension
 
-        return Variable(f"self.{func_name}", created_func)
+        See generate_command_func for notify_exit.
+        """
+        return self.generate_handler(
+            ExistingCode.POOL_HANDLER_TEMPLATE,
+            execution,
+            class_origin,
+            class_func,
+            params,
+            ", notify=True" if notify_exit else "",
+            sys.executable,
+        )
 
-    def generate_command_func(self, command: str) -> Variable:
+    def generate_parallel_func(
+        self,
+        parallel: str,
+        class_origin: str,
+        class_func: str,
+        class_dir: str,
+        params: str,
+        notify_exit: bool = False,
+        ordered: bool = True,
+    ) -> Variable:
         """
-        Generates a command attached to a python function
+        Generates a command spreading the selection over a pool of processes
+
+        See generate_command_func for notify_exit and context_menu.parallel.run_map for ordered.
         """
-        func_name = "method_handler{}".format(self.counter)
-        created_func = ExistingCode.COMMAND_HANDLER_TEMPLATE.value.format(
-            func_name, command, ""
+        return self.generate_handler(
+            ExistingCode.PARALLEL_HANDLER_TEMPLATE,
+            class_dir,
+            class_origin,
+            class_func,
+            params,
+            parallel,
+            ", notify=True" if notify_exit else "",
+            sys.executable,
+            "" if ordered else ", ordered=False",
         )
 
-        self.counter += 1
+    def generate_command_func(self, command: str, notify_exit: bool = False) -> Variable:
+        """
+        Generates a command attached to a python function
 
-        return Variable(f"self.{func_name}", created_func)
+        The command is started without waiting for it, with notify_exit a failure is shown as a notification.
+        """
+        return self.generate_handler(
+            ExistingCode.COMMAND_HANDLER_TEMPLATE,
+            "",
+            command,
+            "",
+            ", notify=True" if notify_exit else "",
+        )
 
     def generate_mod_command_func(
-        self, command: str, command_vars: list[CommandVar]
+        self, command: str, command_vars: list[CommandVar], notify_exit: bool = False
     ) -> Variable:
         """
         Generates a command attached to a python function that allows special variables.
+
+        See generate_command_func for notify_exit.
         """
         new_command = command.replace("?", "{}")
         modified_vars = [command_var_format(item) for item in command_vars]
         final_str = ", ".join(modified_vars)
-        func_name = "method_handler{}".format(self.counter)
         replace_func = """.format({})""".format(final_str)
-        created_func = ExistingCode.COMMAND_HANDLER_TEMPLATE.value.format(
-            func_name, new_command, replace_func
+        filepath = ""
+        if COMMAND_VARS["FILENAME"] in modified_vars:
+            filepath = ExistingCode.FILEPATH.value
+
+        return self.generate_handler(
+            ExistingCode.COMMAND_HANDLER_TEMPLATE,
+            filepath,
+            new_command,
+            replace_func,
+            ", notify=True" if notify_exit else "",
         )
 
-        self.counter += 1
+    # Building the script body
 
-        return Variable(f"self.{func_name}", created_func)
+    def build_menu(self, name: str, parent: str) -> tuple[str, str]:
+        """
+        Builds the body commands of a menu item and its submenu, returns both variables.
+        """
+        menu_item = self.generate_item(name, parent)
+        menu = self.generate_menu(name, parent)
+        self.commands.append(menu_item.code)
+        self.commands.append(menu.code)
+        self.commands.append(self.set_submenu(menu_item.name, menu.name))
 
-    # Other misc methods to help out
+        return menu_item.name, menu.name
 
-    def get_next_item(self) -> str:
+    def build_script_body(self, name: str, items: tuple[Node, ...]) -> str:
         """
-        Very niche, required in other methods.
+        Builds the body commands of the script, returns the variable of the top item.
         """
-        val = self.generate_item("")
-        self.counter -= 1
+        top_item, top_menu = self.build_menu(name, "")
+        walk(items, top_menu, self.build_item)
 
-        return val.name
+        return top_item
 
-    # Building the script body
+    def build_item(self, item: Node, top_menu: str) -> str:
+        """
+        Builds the body commands of an item, top_menu is the variable of its menu.
 
-    def build_script_body(self, name: str, items: list[ItemType]) -> None:
-        """
-        Builds the body commands of the script.
-        """
-        top_item = self.generate_item(name)
-        top_menu = self.generate_menu()
-        submenu_com = self.set_submenu(top_item.name, top_menu.name)
-        self.commands.append(top_item.code)
-        self.commands.append(top_menu.code)
-        self.commands.append(submenu_com)
-
-        for item in items:
-            if item.isMenu:
-                subsubmenu_con = self.append_item(top_menu.name, self.get_next_item())
-                self.build_script_body(item.name, item.sub_items)
-                self.commands.append(subsubmenu_con)
-                continue
-
-            # if the item is a command
-            formatted_command = self.generate_item(item.name)
-            self.commands.append(formatted_command.code)
-
-            if item.python != None:
-                # if there is a python function
-                item_info = item.get_method_info()
-                connected_func = self.generate_python_func(
-                    item_info[1], item_info[0], item.params
+        For a menu, returns the variable of its submenu. The variables of the items are derived from
+        the variable of their menu, which is unique, so deep menus don't hash the names of all the parents.
+        """
+        if item.isMenu:
+            sub_item, sub_menu = self.build_menu(item.name, top_menu)
+            self.commands.append(self.append_item(top_menu, sub_item))
+            return sub_menu
+
+        # if the item is a command
+        formatted_command = self.generate_item(item.name, top_menu)
+        self.commands.append(formatted_command.code)
+
+        if item.function is not None:
+            # if there is a python function
+            item_info = item.function
+            if item.worker:
+                # the worker imports the function, the extension only needs context_menu.worker
+                from context_menu.worker import PACKAGE_PARENT
+
+                connected_func = self.generate_worker_func(
+                    item_info[1], item_info[0], item_info[2], item.params
                 )
-                self.script_dirs.append(item_info[2])
-                self.imports.append(item_info[1])
-            elif item.command_vars != None:
-                # if the command requries parameters
-                assert item.command is not None
-                assert item.command_vars is not None
-                connected_func = self.generate_mod_command_func(
-                    item.command, item.command_vars
+                self.script_dirs.append(PACKAGE_PARENT)
+                self.imports.append("context_menu.worker")
+            elif item.parallel is not None:
+                # the function is imported by the processes of the pool
+                from context_menu.worker import PACKAGE_PARENT
+
+                connected_func = self.generate_parallel_func(
+                    item.parallel,
+                    item_info[1],
+                    item_info[0],
+                    item_info[2],
+                    item.params,
+                    item.notify_exit,
+                    item.ordered,
                 )
+                self.script_dirs.append(PACKAGE_PARENT)
+                self.imports.append("context_menu.parallel")
             else:
-                # if the command is simply normal
-                assert item.command is not None
-                connected_func = self.generate_command_func(item.command)
-                # connected_func = self.generate_func('os', 'system')
-
-            self.funcs.append(connected_func.code)
-
-            connected_command = self.connect(
-                formatted_command.name, connected_func.name
+                from context_menu.worker import PACKAGE_PARENT, module_key
+
+                # Loaded under a key of their own, modules with the same name can come from several directories
+                key = module_key(item_info[2], item_info[1])
+                self.modules[key] = (item_info[1], item_info[2])
+                if item.profile is not None:
+                    connected_func = self.generate_profiled_func(
+                        key, item_info[0], item.params, item.name, item.profile
+                    )
+                    self.script_dirs.append(PACKAGE_PARENT)
+                    self.imports.append("context_menu.profiling")
+                elif item.execution == "inline":
+                    connected_func = self.generate_python_func(key, item_info[0], item.params)
+                else:
+                    connected_func = self.generate_pool_func(
+                        item.execution,
+                        key,
+                        item_info[0],
+                        item.params,
+                        item.notify_exit,
+                    )
+                    if item.execution == "process":
+                        # The processes run the function through context_menu.worker.run
+                        self.script_dirs.append(PACKAGE_PARENT)
+                self.script_dirs.append(item_info[2])
+                self.imports.append(key)
+        elif item.command_vars != None:
+            # if the command requries parameters
+            assert item.command is not None
+            assert item.command_vars is not None
+            connected_func = self.generate_mod_command_func(
+                item.command, list(item.command_vars), item.notify_exit
             )
-            self.commands.append(connected_command)
+        else:
+            # if the command is simply normal
+            assert item.command is not None
+            connected_func = self.generate_command_func(item.command, item.notify_exit)
+            # connected_func = self.generate_func('os', 'system')
+
+        connected_command = self.connect(
+            formatted_command.name, connected_func.name, item.name
+        )
+        self.commands.append(connected_command)
 
-            self.commands.append(
-                self.append_item(top_menu.name, formatted_command.name)
-            )
+        self.commands.append(
+            self.append_item(top_menu, formatted_command.name)
+        )
 
-    def build_script(self) -> str:
+        return top_menu
+
+    def get_builder(self) -> CodeBuilder:
         """
-        Finishes and returns the full code.
+        Builds the script body and returns the CodeBuilder for the full code.
         """
-        self.build_script_body(self.name, self.sub_items)
-        self.commands.append("return menuitem0,")
-        full_code = CodeBuilder(
+        top_item = self.build_script_body(self.name, self.sub_items)
+        self.commands.append("return {},".format(top_item))
+        method = "items_{}".format(self.identifier("items", self.name))
+        return CodeBuilder(
             self.name,
-            self.commands,
+            [(self.type, method, self.commands)],
             self.script_dirs,
             self.funcs,
             self.imports,
-            self.type,
-        ).compile()
+            self.cache_items,
+            self.prewarm,
+            self.telemetry,
+            self.modules,
+            self.runtime,
+        )
 
-        return full_code
+    def build_script(self) -> str:
+        """
+        Finishes and returns the full code.
+        """
+        return self.get_builder().compile()
 
     def create_path(self, path: str, dir: str) -> str:
         """
@@ -386,15 +1248,152 @@ class NautilusMenu:
         """
         Creates the code, creates a file, and moves it to the correct location.
         """
-        code = self.build_script()
-        save_loc = os.path.join(os.path.expanduser("~"), ".local/share/")
-        print(save_loc)
-        save_loc = self.create_path(save_loc, "nautilus-python")
-        save_loc = self.create_path(save_loc, "extensions")
-        save_loc = os.path.join(save_loc, f"{self.name}.py")
-        py_file = open(save_loc, "w")
-        py_file.write(code)
-        py_file.close()
+        save_extension(self.name, self.get_builder().write)
+
+
+class NautilusBundle:
+    """
+    Compiles several menus into a single extension module with one provider.
+
+    Nautilus then imports one module and calls one provider per selection, no
+    matter how many menus are installed. Imports and identical handlers are shared.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        menus: list[NautilusMenu],
+        cache_items: bool = False,
+        prewarm: bool = False,
+        telemetry: bool = False,
+    ) -> None:
+        """
+        Requires the name of the extension and the menus, which are only used for their name, sub items and type.
+
+        With telemetry, all the menus record their timings in the store of name.
+        """
+        # Collects the body commands, handlers and imports of every menu
+        self.builder = NautilusMenu(name, [], "FILES", cache_items, prewarm, telemetry)
+        self.name = self.builder.name
+        self.menus = menus
+
+    def get_builder(self) -> CodeBuilder:
+        """
+        Builds the script bodies of all the menus and returns the CodeBuilder for the full code.
+        """
+        builder = self.builder
+        sections = []
+
+        # Every menu gets its own method, so only the ones matching the selection are built
+        for menu in self.menus:
+            builder.commands = []
+            top_item = builder.build_script_body(menu.name, menu.sub_items)
+            builder.commands.append("return {},".format(top_item))
+            method = "items_{}".format(builder.identifier("items", menu.name))
+            sections.append((menu.type, method, builder.commands))
+
+        return CodeBuilder(
+            self.name,
+            sections,
+            builder.script_dirs,
+            builder.funcs,
+            builder.imports,
+            builder.cache_items,
+            builder.prewarm,
+            builder.telemetry,
+            builder.modules,
+            builder.runtime,
+        )
+
+    def build_script(self) -> str:
+        """
+        Finishes and returns the full code.
+        """
+        return self.get_builder().compile()
+
+    def compile(self) -> None:
+        """
+        Creates the code, creates a file, and moves it to the correct location.
+        """
+        save_extension(self.name, self.get_builder().write)
+
+
+def file_hash(path: str) -> str | None:
+    """
+    Returns the sha256 of the file content, or None if it can't be read.
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(65536), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+class HashingWriter:
+    """
+    Writes text to a binary file as utf-8 and hashes it on the way.
+    """
+
+    __slots__ = ("file", "hash")
+
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, text: str) -> int:
+        data = text.encode("utf-8")
+        self.hash.update(data)
+        self.file.write(data)
+        return len(text)
+
+
+def save_extension(name: str, code: str | Callable[[TextIO], None]) -> bool:
+    """
+    Saves the code of an extension in the directory nautilus-python loads extensions from.
+
+    code is either the source or a function writing it to a file object, like CodeBuilder.write,
+    in which case the source is streamed to disk instead of being held in memory.
+
+    Nothing is replaced if the extension already has this code. Otherwise the file is replaced
+    atomically, so Nautilus never loads a half-written extension. The extension is byte-compiled
+    as well, which Nautilus uses if it runs the same python version.
+
+    Returns whether the extension was replaced.
+    """
+    save_loc = os.path.join(os.path.expanduser("~"), ".local/share/")
+    print(save_loc)
+    save_dir = os.path.join(save_loc, "nautilus-python", "extensions")
+    os.makedirs(save_dir, exist_ok=True)
+    save_loc = os.path.join(save_dir, f"{name}.py")
+
+    # Not ending in .py, so Nautilus never picks up the temporary file
+    fd, tmp_loc = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=save_dir)
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            writer = HashingWriter(tmp_file)
+            if isinstance(code, str):
+                writer.write(code)
+            else:
+                code(writer)  # type: ignore
+
+        if writer.hash.hexdigest() == file_hash(save_loc):
+            os.remove(tmp_loc)
+            if not os.path.exists(importlib.util.cache_from_source(save_loc)):
+                py_compile.compile(save_loc)
+            return False
+
+        os.chmod(tmp_loc, 0o644)
+        os.replace(tmp_loc, save_loc)
+    except BaseException:
+        if os.path.exists(tmp_loc):
+            os.remove(tmp_loc)
+        raise
+
+    py_compile.compile(save_loc)
+    return True
 
 
 # Testing section...
@@ -403,13 +1402,18 @@ try:
 
     def remove_linux_menu(name) -> None:
         save_loc = os.path.join(
-            os.path.expanduser("~"), ".local/share/nautilus-python/extensions", name
+            os.path.expanduser("~"), ".local/share/nautilus-python/extensions", extension_name(name)
         )
         try:
             os.remove(save_loc + ".py")
-            os.remove(save_loc + ".pyc")
         except Exception as e:
             print(e)
 
+        for compiled in (importlib.util.cache_from_source(save_loc + ".py"), save_loc + ".pyc"):
+            try:
+                os.remove(compiled)
+            except OSError:
+                pass
+
 except Exception:
     pass
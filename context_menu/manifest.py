@@ -0,0 +1,312 @@
+"""
+Installs the menus described by a manifest, to deploy many menus on many machines in one step.
+
+A manifest is a JSON file, or a TOML file with python 3.11 or tomli:
+
+    {
+        "name": "MyMenus",
+        "cache_items": true,
+        "menus": [
+            {"name": "Foo menu", "type": "FILES", "items": [
+                {"name": "Foo One", "command": "echo hello > example.txt"},
+                {"name": "Foo Two", "python": "tools:foo", "worker": true},
+                {"name": "Sub menu", "items": [{"name": "Foo Three", "python": "tools:bar"}]}
+            ]},
+            {"name": "Fast", "type": ".txt", "command": "notepad %1"}
+        ]
+    }
+
+Entries with items are a ContextMenu, the other menus a FastCommand and the other items a ContextCommand.
+The keys of an entry are the arguments of its class, but python is "module:function", imported with the
+directory of the manifest first on sys.path. The other top-level keys are passed to compile_menus.
+
+    context-menu install menus.json
+    context-menu diff menus.json
+    context-menu list
+    context-menu remove MyMenus
+
+install compiles all the menus in a single pass and remembers the manifest in the manifests directory of
+context_menu. Installing a manifest whose content didn't change since its last install does nothing, so
+provisioning scripts can run it every time. The menus dropped from the manifest since then are removed.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import platform
+import sys
+import time
+
+from context_menu.paths import data_dir
+
+if TYPE_CHECKING:
+    from typing import Any
+
+    from context_menu.menus import ContextMenu, ContextCommand, FastCommand
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    try:
+        import tomli as tomllib  # type: ignore
+    except ImportError:
+        tomllib = None  # type: ignore
+
+# The top-level keys of a manifest passed to compile_menus
+COMPILE_OPTIONS = ("cache_items", "incremental", "prewarm", "telemetry")
+
+
+def load(path: str) -> dict[str, Any]:
+    """
+    Returns the content of a manifest, raises a ValueError if it isn't one.
+    """
+    with open(path, "rb") as file:
+        content = file.read()
+
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise ValueError("TOML manifests need python 3.11 or tomli, use JSON instead")
+        manifest = tomllib.loads(content.decode("utf-8"))
+    else:
+        manifest = json.loads(content)
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("menus"), list):
+        raise ValueError(f"{path} has no list of menus")
+    unknown = set(manifest) - {"name", "menus", *COMPILE_OPTIONS}
+    if unknown:
+        raise ValueError(f"unknown keys in {path}: {', '.join(sorted(unknown))}")
+
+    if not all(isinstance(menu, dict) and isinstance(menu.get("name"), str) for menu in manifest["menus"]):
+        raise ValueError(f"every menu of {path} needs a name")
+    names = [menu["name"] for menu in manifest["menus"]]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"menus named more than once in {path}: {', '.join(sorted(duplicates))}")
+    return manifest
+
+
+def name_of(manifest: dict[str, Any]) -> str:
+    """
+    Returns the name the menus of a manifest are compiled with.
+    """
+    return manifest.get("name", "ContextMenus")
+
+
+def content_hash(value: Any) -> str:
+    """
+    Returns a hash of a part of a manifest, which doesn't depend on its formatting.
+    """
+    encoded = json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def fingerprint(manifest: dict[str, Any], directory: str) -> dict[str, Any]:
+    """
+    Returns what is remembered of an installed manifest: its hash and the hash and type of every menu.
+
+    The python functions are found from the directory of the manifest, which is part of the hash.
+    """
+    return {
+        "name": name_of(manifest),
+        "hash": content_hash([manifest, directory]),
+        "menus": {
+            menu["name"]: {"type": menu.get("type"), "hash": content_hash(menu)}
+            for menu in manifest["menus"]
+        },
+    }
+
+
+def state_path(name: str) -> str:
+    """
+    Returns the file remembering the manifest installed with name.
+    """
+    return os.path.join(data_dir("manifests"), "".join(name.split()) + ".json")
+
+
+def read_state(name: str) -> dict[str, Any] | None:
+    """
+    Returns what was remembered of the manifest installed with name, None if there is none.
+    """
+    try:
+        with open(state_path(name), encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_state(state: dict[str, Any]) -> None:
+    """
+    Remembers an installed manifest.
+    """
+    path = state_path(state["name"])
+    # Replaced atomically, an interrupted install leaves the previous state
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(state, file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def import_function(reference: str, directory: str) -> Any:
+    """
+    Returns the function of a "module:function" reference, searching the directory of the manifest first.
+    """
+    module_name, _, function_name = reference.partition(":")
+    if not module_name or not function_name:
+        raise ValueError(f'python must look like "module:function", not "{reference}"')
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def build_item(entry: dict[str, Any], directory: str, top_level: bool) -> ContextMenu | ContextCommand | FastCommand:
+    """
+    Returns the menu, command or fast command of an entry of a manifest.
+    """
+    from context_menu import menus
+
+    options = dict(entry)
+    if "python" in options:
+        options["python"] = import_function(options["python"], directory)
+    items = options.pop("items", None)
+
+    if items is not None:
+        cls: Any = menus.ContextMenu
+    else:
+        cls = menus.FastCommand if top_level else menus.ContextCommand
+    try:
+        item = cls(**options)
+    except TypeError as error:
+        raise ValueError(f"{entry.get('name')}: {error}") from None
+
+    if items is not None:
+        item.add_items([build_item(child, directory, False) for child in items])
+    return item
+
+
+def install(path: str, force: bool = False) -> bool:
+    """
+    Compiles the menus of a manifest, returns False if it was already installed with the same content.
+
+    The menus that were in the manifest when it was last installed and aren't anymore, or had another type, are removed.
+    """
+    from context_menu import menus
+
+    manifest = load(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    state = fingerprint(manifest, directory)
+    previous = read_state(state["name"])
+    if previous is not None and previous["hash"] == state["hash"] and not force:
+        return False
+
+    items = [build_item(entry, directory, True) for entry in manifest["menus"]]
+    options = {key: manifest[key] for key in COMPILE_OPTIONS if key in manifest}
+
+    # On Linux all the menus are in one extension, which compile_menus replaces
+    if previous is not None and platform.system() == "Windows":
+        for name, menu in previous["menus"].items():
+            if state["menus"].get(name, {}).get("type") != menu["type"]:
+                menus.removeMenu(name, menu["type"])
+    menus.compile_menus(items, state["name"], **options)
+
+    state["manifest"] = os.path.abspath(path)
+    state["installed"] = time.time()
+    write_state(state)
+    return True
+
+
+def remove(name: str) -> None:
+    """
+    Removes the menus of the manifest installed with name, raises a ValueError if there is none.
+    """
+    from context_menu import menus
+
+    state = read_state(name)
+    if state is None:
+        raise ValueError(f"no manifest is installed as {name}")
+
+    if platform.system() == "Windows":
+        for menu_name, menu in state["menus"].items():
+            menus.removeMenu(menu_name, menu["type"])
+    else:
+        menus.removeMenu(state["name"], [])
+    os.remove(state_path(name))
+
+
+def installed() -> list[dict[str, Any]]:
+    """
+    Returns what was remembered of every installed manifest, by name.
+    """
+    directory = data_dir("manifests")
+    states = [read_state(file[: -len(".json")]) for file in sorted(os.listdir(directory)) if file.endswith(".json")]
+    return sorted((state for state in states if state is not None), key=lambda state: state["name"])
+
+
+def diff(path: str) -> list[tuple[str, str]]:
+    """
+    Returns what installing a manifest would change: ("+", menu) for an added menu, "-" removed and "~" changed.
+
+    Options of compile_menus that changed are reported as a change of the manifest itself, under its name.
+    """
+    manifest = load(path)
+    state = fingerprint(manifest, os.path.dirname(os.path.abspath(path)))
+    previous = read_state(state["name"]) or {"hash": None, "menus": {}}
+
+    changes = []
+    for name, menu in state["menus"].items():
+        if name not in previous["menus"]:
+            changes.append(("+", name))
+        elif previous["menus"][name]["hash"] != menu["hash"]:
+            changes.append(("~", name))
+    changes.extend(("-", name) for name in previous["menus"] if name not in state["menus"])
+    if not changes and previous["hash"] != state["hash"]:
+        changes.append(("~", state["name"]))
+    return changes
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    Entry point of the context-menu command and of python -m context_menu.manifest.
+    """
+    parser = argparse.ArgumentParser(prog="context-menu", description="Installs the menus of manifests")
+    commands = parser.add_subparsers(dest="command", required=True)
+    install_parser = commands.add_parser("install", help="compile the menus of a manifest")
+    install_parser.add_argument("manifest")
+    install_parser.add_argument("--force", action="store_true", help="compile even if the manifest didn't change")
+    remove_parser = commands.add_parser("remove", help="remove the menus of an installed manifest")
+    remove_parser.add_argument("name", help="the name of the manifest, or the manifest itself")
+    commands.add_parser("list", help="list the installed manifests")
+    diff_parser = commands.add_parser("diff", help="show what installing a manifest would change, exits with 1 if anything")
+    diff_parser.add_argument("manifest")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "install":
+            if install(args.manifest, args.force):
+                print(f"Installed {args.manifest}")
+            else:
+                print(f"{args.manifest} is already installed")
+        elif args.command == "remove":
+            name = name_of(load(args.name)) if os.path.isfile(args.name) else args.name
+            remove(name)
+            print(f"Removed {name}")
+        elif args.command == "list":
+            states = installed()
+            if not states:
+                print(f"No manifests installed in {data_dir('manifests')}")
+            for state in states:
+                installed_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(state["installed"]))
+                print(f"{state['name']:<30} {len(state['menus']):>5} menus  {installed_at}  {state['manifest']}")
+        else:
+            changes = diff(args.manifest)
+            for change, name in changes:
+                print(f"{change} {name}")
+            if changes:
+                sys.exit(1)
+    except (OSError, ValueError) as error:
+        parser.exit(2, f"context-menu: error: {error}\n")
+
+
+if __name__ == "__main__":
+    main()
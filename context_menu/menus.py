@@ -1,6 +1,5 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
-import inspect
 import sys
 import os
 import platform
@@ -14,8 +13,22 @@ if TYPE_CHECKING:
     ItemType = Union["ContextMenu", "ContextCommand"]
     MethodInfo = Tuple[str, str, str]
 
+    from context_menu import linux_menus, windows_menus
+    from context_menu.ir import Menu
+    from context_menu.windows_menus import RegistrySummary
 
-from context_menu import linux_menus, windows_menus
+
+# The backends are only imported by what compiles or removes menus, and only the one of the platform
+from context_menu import ir
+
+# Where the python functions of commands run on Linux, see ContextCommand
+EXECUTION_MODES = ("inline", "thread", "process")
+# How context_menu.parallel calls the python function, see ContextCommand
+PARALLEL_MODES = ("file", "chunk")
+# What context_menu.profiling records of the python function, see ContextCommand
+PROFILE_MODES = ("cpu", "memory")
+# How Windows starts the python of commands, see ContextCommand
+LAUNCH_MODES = ("console", "windowless")
 
 
 class ContextMenu:
@@ -23,16 +36,38 @@ class ContextMenu:
     The general menu class. This class generalizes the menus and eventually passes the correct values to the platform-specifically menus.
     """
 
-    def __init__(self, name: str, type: ActivationType | str | None = None, icon_path: str = None) -> None:
+    # Menus can hold a lot of items, slots keep every node small
+    __slots__ = ("name", "sub_items", "type", "icon_path", "cache_items", "prewarm", "telemetry")
+    isMenu = True  # Needed to avoid circular imports
+
+    def __init__(
+        self,
+        name: str,
+        type: ActivationType | str | list[str] | None = None,
+        icon_path: str = None,
+        cache_items: bool = False,
+        prewarm: bool = False,
+        telemetry: bool = False,
+    ) -> None:
         """
-        Only specify type if it's the root menu.
+        Only specify type if it's the root menu. type can be a list of types, like several extensions.
+
+        cache_items only affects Linux, where the menu items are then built once
+        by the Nautilus extension instead of on every selection change.
+
+        prewarm only affects Linux, where the modules of the python functions are then
+        imported in the background after Nautilus started instead of on the first click.
+
+        With telemetry, the timings of the menu are recorded in its telemetry store (see context_menu.telemetry).
         """
 
         self.name = name
         self.sub_items: list[ItemType] = []
         self.type = type
         self.icon_path = icon_path
-        self.isMenu = True  # Needed to avoid circular imports
+        self.cache_items = cache_items
+        self.prewarm = prewarm
+        self.telemetry = telemetry
 
     def add_items(self, items: list[ItemType]) -> None:
         """
@@ -40,17 +75,62 @@ class ContextMenu:
         """
         self.sub_items.extend(items)
 
-    def compile(self) -> None:
+    def compile(self, incremental: bool = False) -> RegistrySummary | None:
         """
         Recognizes the current platform and passes information to the respective menu. Creates the actual menu.
+
+        On Windows, incremental only writes the registry keys that changed since the last compile and returns a summary of the operations.
         """
         if self.type is None:
             raise Exception("type can't be None for top-level ContextMenu")
 
         if platform.system() == "Linux":
-            linux_menus.NautilusMenu(self.name, self.sub_items, self.type).compile()
+            self.get_linux_menu().compile()
         if platform.system() == "Windows":
-            windows_menus.RegistryMenu(self.name, self.sub_items, self.type, self.icon_path).compile()
+            return self.get_windows_menu().compile(incremental)
+        return None
+
+    def lower(self) -> Menu:
+        """
+        Returns the platform independent form of the menu, which both backends compile.
+
+        Lowering it once and passing it to several backends or compiles avoids resolving the menu again.
+        """
+        assert self.type is not None
+        return ir.lower(self)
+
+    def get_linux_menu(self, lowered: Menu | None = None) -> linux_menus.NautilusMenu:
+        """
+        Returns the Nautilus version of the menu.
+        """
+        from context_menu import linux_menus
+
+        if lowered is None:
+            lowered = self.lower()
+        return linux_menus.NautilusMenu(
+            self.name,
+            lowered.items,
+            self.type,
+            self.cache_items,
+            self.prewarm,
+            self.telemetry,
+        )
+
+    def get_windows_menu(self, lowered: Menu | None = None) -> windows_menus.RegistryMenu:
+        """
+        Returns the registry version of the menu.
+        """
+        from context_menu import windows_menus
+
+        if lowered is None:
+            lowered = self.lower()
+        return windows_menus.RegistryMenu(
+            self.name,
+            lowered.items,
+            self.type,
+            self.icon_path,
+            self.name if self.telemetry else None,
+        )
 
 
 class ContextCommand:
@@ -64,8 +144,36 @@ class ContextCommand:
      python = function to be ran
      params = any other parameters to be passed
      command_vars = to help with the command
+     worker = run the python function in the resident worker (see context_menu.worker)
+     coalesce = on Windows, call the python function once for a multi-file selection (see context_menu.coalesce)
+     notify_exit = on Linux, show a notification if the command fails
+     execution = on Linux, where the python function runs: "inline" in Nautilus, or in a "thread" or "process" pool shared by the extension
+     parallel = spread the selection over a pool of processes, calling the python function per "file" or per "chunk" of files (see context_menu.parallel)
+     ordered = with parallel, collect the results in the order of the selection, or in the order they finish if False
+     profile = run the python function under cProfile ("cpu"), and tracemalloc as well ("memory"), keeping the dumps of its last calls (see context_menu.profiling)
+     launch = on Windows, "windowless" starts pythonw without a console, isolated and without site, with the import path frozen at compile time
+     archive = import the python function from a zip archive of its module and the modules it imports from its directory, built at compile time (see context_menu.archive)
     """
 
+    __slots__ = (
+        "name",
+        "command",
+        "python",
+        "params",
+        "command_vars",
+        "icon_path",
+        "worker",
+        "coalesce",
+        "notify_exit",
+        "execution",
+        "parallel",
+        "profile",
+        "launch",
+        "archive",
+        "ordered",
+    )
+    isMenu = False
+
     def __init__(
         self,
         name: str,
@@ -74,20 +182,36 @@ class ContextCommand:
         params: str = "",
         command_vars: list[CommandVar] | None = None,
         icon_path: str = None,
+        worker: bool = False,
+        coalesce: bool = False,
+        notify_exit: bool = False,
+        execution: str = "inline",
+        parallel: str | None = None,
+        profile: str | None = None,
+        launch: str = "console",
+        archive: bool = False,
+        ordered: bool = True,
     ) -> None:
         """
         Do not specify both 'python' and 'command', either pass a python function or a command but not both.
         """
         self.name = name
         self.command = command
-        self.isMenu = False
         self.python = python
         self.params = params
         self.command_vars = command_vars
         self.icon_path = icon_path
-
-        if command != None and python != None:
-            raise ValueError("both command and python cannot be defined")
+        self.worker = worker
+        self.coalesce = coalesce
+        self.notify_exit = notify_exit
+        self.execution = execution
+        self.parallel = parallel
+        self.profile = profile
+        self.launch = launch
+        self.archive = archive
+        self.ordered = ordered
+
+        check_options(command, python, execution, parallel, worker, coalesce, profile, launch, ordered)
 
     def get_platform_command(self):
         """
@@ -104,13 +228,7 @@ class ContextCommand:
         Returns a tuple (function name, function file name, path to function directory)
         """
         assert self.python is not None
-        func_file_path = os.path.abspath(inspect.getfile(self.python))
-
-        func_dir_path = os.path.dirname(func_file_path).replace("\\", "/")
-        func_name = self.python.__name__
-        func_file_name = os.path.splitext(os.path.basename(func_file_path))[0]
-
-        return (func_name, func_file_name, func_dir_path)
+        return ir.locate(self.python)
 
 
 class FastCommand:
@@ -120,15 +238,49 @@ class FastCommand:
     Extremely similar methods to other classes, only slightly modified. View the documentation of the above classes for info on these methods.
     """
 
+    __slots__ = (
+        "name",
+        "type",
+        "command",
+        "python",
+        "params",
+        "command_vars",
+        "icon_path",
+        "cache_items",
+        "worker",
+        "coalesce",
+        "prewarm",
+        "notify_exit",
+        "execution",
+        "parallel",
+        "telemetry",
+        "profile",
+        "launch",
+        "archive",
+        "ordered",
+    )
+
     def __init__(
         self,
         name: str,
-        type: ActivationType | str,
+        type: ActivationType | str | list[str],
         command: str | None = None,
         python: FunctionType | None = None,
         params: str = "",
         command_vars: list[CommandVar] | None = None,
         icon_path: str = None,
+        cache_items: bool = False,
+        worker: bool = False,
+        coalesce: bool = False,
+        prewarm: bool = False,
+        notify_exit: bool = False,
+        execution: str = "inline",
+        parallel: str | None = None,
+        telemetry: bool = False,
+        profile: str | None = None,
+        launch: str = "console",
+        archive: bool = False,
+        ordered: bool = True,
     ) -> None:
         self.name = name
         self.type = type
@@ -137,59 +289,175 @@ class FastCommand:
         self.params = params
         self.command_vars = command_vars
         self.icon_path = icon_path
-
-        if command != None and python != None:
-            raise ValueError("both command and python cannot be defined")
+        self.cache_items = cache_items
+        self.worker = worker
+        self.coalesce = coalesce
+        self.prewarm = prewarm
+        self.notify_exit = notify_exit
+        self.execution = execution
+        self.parallel = parallel
+        self.telemetry = telemetry
+        self.profile = profile
+        self.launch = launch
+        self.archive = archive
+        self.ordered = ordered
+
+        check_options(command, python, execution, parallel, worker, coalesce, profile, launch, ordered)
 
     def get_method_info(self) -> MethodInfo:
         assert self.python is not None
-        func_file_path = os.path.abspath(inspect.getfile(self.python))
-
-        func_dir_path = os.path.dirname(func_file_path).replace("\\", "/")
-        func_name = self.python.__name__
-        func_file_name = os.path.splitext(os.path.basename(func_file_path))[0]
+        return ir.locate(self.python)
 
-        return (func_name, func_file_name, func_dir_path)
-
-    def compile(self) -> None:
+    def compile(self, incremental: bool = False) -> RegistrySummary | None:
         if platform.system() == "Linux":
-            linux_menus.NautilusMenu(
-                self.name,
-                [
-                    ContextCommand(
-                        self.name,
-                        command=self.command,
-                        python=self.python,
-                        params=self.params,
-                        command_vars=self.command_vars,
-                    )
-                ],
-                self.type,
-            ).compile()
+            self.get_linux_menu().compile()
         if platform.system() == "Windows":
-            windows_menus.FastRegistryCommand(
-                self.name,
-                self.type,
-                self.command,
-                self.python,
-                self.params,
-                self.command_vars,
-                self.icon_path,
-            ).compile()
+            return self.get_windows_menu().compile(incremental)
+        return None
+
+    def get_linux_menu(self) -> linux_menus.NautilusMenu:
+        from context_menu import linux_menus
+
+        return linux_menus.NautilusMenu(
+            self.name,
+            [
+                ContextCommand(
+                    self.name,
+                    command=self.command,
+                    python=self.python,
+                    params=self.params,
+                    command_vars=self.command_vars,
+                    worker=self.worker,
+                    coalesce=self.coalesce,
+                    notify_exit=self.notify_exit,
+                    execution=self.execution,
+                    parallel=self.parallel,
+                    profile=self.profile,
+                    launch=self.launch,
+                    archive=self.archive,
+                    ordered=self.ordered,
+                )
+            ],
+            self.type,
+            self.cache_items,
+            self.prewarm,
+            self.telemetry,
+        )
+
+    def get_windows_menu(self) -> windows_menus.FastRegistryCommand:
+        from context_menu import windows_menus
+
+        return windows_menus.FastRegistryCommand(
+            self.name,
+            self.type,
+            self.command,
+            self.python,
+            self.params,
+            self.command_vars,
+            self.icon_path,
+            self.worker,
+            self.coalesce,
+            self.parallel,
+            self.name if self.telemetry else None,
+            self.profile,
+            self.launch,
+            self.archive,
+            self.ordered,
+        )
+
+
+def check_options(
+    command: str | None,
+    python: FunctionType | None,
+    execution: str,
+    parallel: str | None,
+    worker: bool,
+    coalesce: bool = False,
+    profile: str | None = None,
+    launch: str = "console",
+    ordered: bool = True,
+) -> None:
+    """
+    Raises a ValueError if the options of a command don't work together.
+    """
+    if command != None and python != None:
+        raise ValueError("both command and python cannot be defined")
+    if execution not in EXECUTION_MODES:
+        raise ValueError(f"execution must be one of {', '.join(EXECUTION_MODES)}")
+    if parallel is not None and parallel not in PARALLEL_MODES:
+        raise ValueError(f"parallel must be one of {', '.join(PARALLEL_MODES)}")
+    if launch not in LAUNCH_MODES:
+        raise ValueError(f"launch must be one of {', '.join(LAUNCH_MODES)}")
+    if parallel is not None and worker:
+        raise ValueError("parallel and worker cannot be combined")
+    if not ordered and parallel is None:
+        raise ValueError("ordered only applies to parallel")
+    if profile is not None:
+        if profile not in PROFILE_MODES:
+            raise ValueError(f"profile must be one of {', '.join(PROFILE_MODES)}")
+        # The function has to be called by the command itself
+        if python is None or worker or coalesce or parallel is not None or execution != "inline":
+            raise ValueError("profile only works with a python function called inline")
+
+
+def compile_menus(
+    items: list[ContextMenu | FastCommand],
+    name: str = "ContextMenus",
+    cache_items: bool = False,
+    incremental: bool = False,
+    prewarm: bool = False,
+    telemetry: bool = False,
+) -> list[RegistrySummary] | None:
+    """
+    Compiles many menus and fast commands in a single pass.
+
+    On Linux they all go into one Nautilus extension called name, so Nautilus imports a single
+    module and calls a single provider per selection. removeMenu(name, ...) removes them all.
+    cache_items and prewarm apply to the whole extension.
+    On Windows they are written through one registry session, incremental works like in ContextMenu.compile
+    and the summaries are returned in the order of the items.
+
+    With telemetry, or if one of the items has it, all the items record their timings in the telemetry store of name.
+    """
+    telemetry = telemetry or any(item.telemetry for item in items)
+    if platform.system() == "Linux":
+        from context_menu import linux_menus
+
+        linux_menus.NautilusBundle(
+            name, [item.get_linux_menu() for item in items], cache_items, prewarm, telemetry
+        ).compile()
+    if platform.system() == "Windows":
+        from context_menu import windows_menus
+
+        windows_menus_list = [item.get_windows_menu() for item in items]
+        if telemetry:
+            for windows_menu in windows_menus_list:
+                windows_menu.telemetry = name
+        with windows_menus.RegistrySession() as session:
+            summaries = [
+                windows_menu.compile(incremental, session) for windows_menu in windows_menus_list
+            ]
+        if incremental:
+            return summaries  # type: ignore
+    return None
 
 
 try:
 
-    def removeMenu(name: str, type: ActivationType | str) -> None:
+    def removeMenu(name: str, type: ActivationType | str | list[str]) -> None:
         """
         Removes a menu/command entry from a context menu.
 
-        Requires the name of the menu and type of the menu
+        Requires the name of the menu and type of the menu, or the list of types it was compiled for
         """
 
         if platform.system() == "Linux":
+            from context_menu import linux_menus
+
             linux_menus.remove_linux_menu(name)
         if platform.system() == "Windows":
+            from context_menu import windows_menus
+
             windows_menus.remove_windows_menu(name, type)
 
 except Exception as e:
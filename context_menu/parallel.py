@@ -0,0 +1,119 @@
+"""
+Spreads the selection of a python command over a pool of processes.
+
+Commands compiled with parallel="file" call their function once per path, as function(filename, params),
+and commands compiled with parallel="chunk" once per slice of the selection, as function(filenames, params).
+The calls run in one process per core, so per-file work like thumbnails or checksums uses the whole machine.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from context_menu.worker import PACKAGE_PARENT, run
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Iterable
+
+MODES = ("file", "chunk")
+# Chunks per process, so a slow chunk doesn't leave the other processes idle at the end
+CHUNKS_PER_PROCESS = 4
+
+
+def split(filenames: list[str], size: int) -> list[list[str]]:
+    """
+    Splits the paths into chunks of size paths, the last one can be shorter.
+    """
+    return [filenames[start : start + size] for start in range(0, len(filenames), size)]
+
+
+def map_chunk(
+    function: Callable[..., Any], mode: str, chunk: list[str], params: str
+) -> list[Any]:
+    """
+    Calls function on a chunk, runs in the processes of the pool.
+    """
+    if mode == "chunk":
+        return [function(chunk, params)]
+    return [function(filename, params) for filename in chunk]
+
+
+def run_map(
+    function: Callable[..., Any],
+    filenames: Iterable[str],
+    params: str,
+    mode: str = "file",
+    chunksize: int | None = None,
+    ordered: bool = True,
+    processes: int | None = None,
+    python: str | None = None,
+) -> list[Any]:
+    """
+    Calls function for every path or every chunk of paths in a pool of processes, returns the results.
+
+    With mode="file" there is one result per path, with mode="chunk" one per chunk. The chunks hold
+    chunksize paths, by default the selection is split into CHUNKS_PER_PROCESS chunks per process.
+    The results are in the order of the selection if ordered is True, otherwise in the order the
+    chunks finish.
+
+    function has to be importable from its module, as the processes are started fresh (with python
+    if given, the current interpreter otherwise). Small selections are run in the current process.
+    An exception raised by function cancels the chunks that haven't started and is raised again.
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+
+    filenames = list(filenames)
+    processes = processes or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = -(-len(filenames) // (processes * CHUNKS_PER_PROCESS)) or 1
+    chunks = split(filenames, chunksize)
+
+    if processes == 1 or len(chunks) <= 1:
+        return [result for chunk in chunks for result in map_chunk(function, mode, chunk, params)]
+
+    # Forking a process with threads, like Nautilus, isn't safe
+    context = multiprocessing.get_context("spawn")
+    if python is not None:
+        context.set_executable(python)
+
+    # The processes start with the sys.path of this one, where a Nautilus extension may find context_menu
+    # through a finder of its own instead
+    setup = f"import sys; sys.path.append({PACKAGE_PARENT!r})"
+    results: list[Any] = []
+    with ProcessPoolExecutor(
+        min(processes, len(chunks)), mp_context=context, initializer=exec, initargs=(setup, {})
+    ) as executor:
+        futures = [executor.submit(map_chunk, function, mode, chunk, params) for chunk in chunks]
+        try:
+            for future in futures if ordered else as_completed(futures):
+                results.extend(future.result())
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    return results
+
+
+def call(
+    path: str,
+    module: str,
+    function: str,
+    filenames: Iterable[str],
+    params: str,
+    mode: str,
+    python: str | None = None,
+    ordered: bool = True,
+) -> list[Any]:
+    """
+    Runs module.function from the directory path on the selection with run_map, returns the results.
+
+    Used by the commands compiled with parallel. The function is imported by the processes calling it,
+    see context_menu.worker.import_file. See run_map for ordered.
+    """
+    return run_map(
+        functools.partial(run, path, module, function), filenames, params, mode, ordered=ordered, python=python
+    )
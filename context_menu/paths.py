@@ -0,0 +1,36 @@
+from __future__ import annotations
+import os
+import sys
+
+
+def data_dir(*parts: str) -> str:
+    """
+    Returns the directory where context_menu keeps its own files, creating it if needed.
+
+    This is %LOCALAPPDATA%\\context_menu on Windows and ~/.local/share/context_menu (or $XDG_DATA_HOME) elsewhere.
+    """
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.join(
+            os.path.expanduser("~"), "AppData", "Local"
+        )
+    else:
+        base = os.environ.get("XDG_DATA_HOME") or os.path.join(
+            os.path.expanduser("~"), ".local", "share"
+        )
+    path = os.path.join(base, "context_menu", *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_dir(*parts: str) -> str:
+    """
+    Returns the directory where context_menu keeps files it can build again, creating it if needed.
+
+    This is %LOCALAPPDATA%\\context_menu\\cache on Windows and ~/.cache/context_menu (or $XDG_CACHE_HOME) elsewhere.
+    """
+    if sys.platform == "win32":
+        return data_dir("cache", *parts)
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "context_menu", *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
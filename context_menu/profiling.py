@@ -0,0 +1,96 @@
+"""
+Profiles the python functions of commands compiled with profile, where they run.
+
+Every call of the function is run under cProfile, and with profile="memory" under tracemalloc as well.
+The dumps go to the profiles directory of context_menu, in a directory per command that keeps the
+PROFILES_KEPT most recent calls:
+
+    python -m pstats <dump>.prof
+    tracemalloc.Snapshot.load("<dump>.tracemalloc").statistics("lineno")
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import cProfile
+import os
+import time
+import tracemalloc
+
+from context_menu.paths import data_dir
+
+if TYPE_CHECKING:
+    from typing import Any, Callable
+
+MODES = ("cpu", "memory")
+# The dumps of every command beyond this many calls are deleted, oldest first
+PROFILES_KEPT = 20
+
+
+def profile_dir(command: str) -> str:
+    """
+    Returns the directory of the dumps of a command.
+    """
+    name = "".join(char if char.isalnum() or char in "-_" else "_" for char in command)
+    return data_dir("profiles", name)
+
+
+def profiles(command: str) -> list[str]:
+    """
+    Returns the paths of the cProfile dumps of a command, the most recent last.
+    """
+    directory = profile_dir(command)
+    return [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.endswith(".prof")
+    ]
+
+
+def rotate(directory: str, keep: int) -> None:
+    """
+    Deletes the dumps of all but the keep most recent calls.
+    """
+    names = sorted(os.listdir(directory))
+    calls = sorted({os.path.splitext(name)[0] for name in names})
+    removed = set(calls[: max(len(calls) - keep, 0)])
+    for name in names:
+        if os.path.splitext(name)[0] in removed:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def call(
+    function: Callable[..., Any],
+    filenames: Any,
+    params: str,
+    command: str,
+    mode: str = "cpu",
+    keep: int = PROFILES_KEPT,
+) -> Any:
+    """
+    Calls function(filenames, params) under the profilers of mode and dumps their results for command.
+
+    The dumps are written even if function raises. Returns what function returns.
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+
+    # Named by the time of the call, so they sort from the oldest to the most recent
+    directory = profile_dir(command)
+    stem = os.path.join(directory, f"{time.time_ns():020d}-{os.getpid()}")
+    # Only stopped here if it was started here, the caller could be tracing already
+    trace = mode == "memory" and not tracemalloc.is_tracing()
+    if trace:
+        tracemalloc.start()
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, filenames, params)
+    finally:
+        profiler.dump_stats(stem + ".prof")
+        if mode == "memory":
+            tracemalloc.take_snapshot().dump(stem + ".tracemalloc")
+        if trace:
+            tracemalloc.stop()
+        rotate(directory, keep)
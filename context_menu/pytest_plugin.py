@@ -1,5 +1,6 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
+from collections import Counter
 import pytest
 from unittest.mock import patch
 
@@ -7,6 +8,14 @@ if TYPE_CHECKING:
     from typing import Any, Iterable
 
 
+class MockedKey:
+    """A handle returned by MockedWinReg.open_key."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.closed = False
+
+
 class MockedWinReg:
     """Mocks the calls to winreg in windows_menus.
 
@@ -17,16 +26,29 @@ class MockedWinReg:
     This also prevents that the tests really change the keys in the
     registry, and makes it possible to run the tests on non-Windows
     platforms.
+
+    calls counts how many times each function was called, and
+    open_handles holds the handles returned by open_key that
+    haven't been closed yet.
     """
 
     def __init__(self) -> None:
         self._keys: dict[str, Any] = {}
+        # The names of the direct subkeys of every key, in creation order
+        self._subkeys: dict[str, dict[str, None]] = {}
+        self.calls: Counter[str] = Counter()
+        self.open_handles: list[MockedKey] = []
         self._patches = [
             patch(f"context_menu.windows_menus.{fun}", getattr(self, fun))
             for fun in [
                 "create_key",
                 "set_key_value",
+                "open_key",
+                "set_key_values",
+                "close_key",
                 "get_key_value",
+                "delete_value",
+                "list_values",
                 "list_keys",
                 "delete_key",
             ]
@@ -41,32 +63,95 @@ class MockedWinReg:
         for patch in self._patches:
             patch.__exit__(*args, **kwargs)
 
+    def _add_key(self, path: str) -> dict[str, Any]:
+        """Returns the values of a key, creating the key if needed."""
+        if path not in self._keys:
+            self._keys[path] = {"": ""}
+            parent, _, name = path.rpartition("\\")
+            self._subkeys.setdefault(parent, {})[name] = None
+        return self._keys[path]
+
     def create_key(self, path: str) -> None:
         """Mocks creating a key."""
-        self._keys.setdefault(f"HKEY_CURRENT_USER\\{path}", {"": ""})
+        self.calls["create_key"] += 1
+        self._add_key(f"HKEY_CURRENT_USER\\{path}")
 
     def set_key_value(self, key_path: str, subkey_name: str, value: str | int) -> None:
         """Mocks changing the value of a key."""
-        self._keys.setdefault(f"HKEY_CURRENT_USER\\{key_path}", {"": ""})[
-            subkey_name
-        ] = value
+        self.calls["set_key_value"] += 1
+        self._add_key(f"HKEY_CURRENT_USER\\{key_path}")[subkey_name] = value
+
+    def open_key(self, path: str, hive: MockedKey | None = None) -> MockedKey:
+        """Mocks creating a key and opening it for writing."""
+        self.calls["open_key"] += 1
+        if hive is None:
+            path = f"HKEY_CURRENT_USER\\{path}"
+        else:
+            assert not hive.closed
+            path = f"{hive.path}\\{path}"
+
+        self._add_key(path)
+        handle = MockedKey(path)
+        self.open_handles.append(handle)
+        return handle
+
+    def set_key_values(self, handle: MockedKey, values: dict[str, str | int]) -> None:
+        """Mocks changing several values of an open key."""
+        self.calls["set_key_values"] += 1
+        assert not handle.closed
+        self._keys[handle.path].update(values)
+
+    def close_key(self, handle: MockedKey) -> None:
+        """Mocks closing a key."""
+        self.calls["close_key"] += 1
+        assert not handle.closed
+        handle.closed = True
+        if self.open_handles[-1] is handle:
+            # Sessions close their handles in reverse order
+            self.open_handles.pop()
+        else:
+            self.open_handles.remove(handle)
 
     def get_key_value(self, key_path: str, subkey_name: str) -> Any:
         """Mocks getting the value of a key."""
+        self.calls["get_key_value"] += 1
         return self._keys.get(f"HKEY_CURRENT_USER\\{key_path}", {}).get(
             subkey_name, None
         )
 
+    def delete_value(self, key_path: str, subkey_name: str) -> None:
+        """Mocks deleting a value of a key."""
+        self.calls["delete_value"] += 1
+        del self._keys[f"HKEY_CURRENT_USER\\{key_path}"][subkey_name]
+
+    def list_values(self, path: str) -> dict[str, Any]:
+        """Mocks listing the values of a key.
+
+        Like winreg, this raises FileNotFoundError if the key doesn't exist.
+        """
+        self.calls["list_values"] += 1
+        try:
+            return dict(self._keys[f"HKEY_CURRENT_USER\\{path}"])
+        except KeyError:
+            raise FileNotFoundError(path) from None
+
     def list_keys(self, path: str) -> list[str]:
-        """Mocks listing the keys."""
-        return self._keys.get(f"HKEY_CURRENT_USER\\{path}", {}).keys()
+        """Mocks listing the direct subkeys of a key."""
+        self.calls["list_keys"] += 1
+        return list(self._subkeys.get(f"HKEY_CURRENT_USER\\{path}", {}))
 
     def delete_key(self, path: str) -> None:
-        """Mocks deleting a key."""
+        """Mocks deleting a key and all its subkeys."""
+        self.calls["delete_key"] += 1
         path = f"HKEY_CURRENT_USER\\{path}"
 
-        if path in self._keys:
-            del self._keys[path]
+        parent, _, name = path.rpartition("\\")
+        self._subkeys.get(parent, {}).pop(name, None)
+        stack = [path]
+        while stack:
+            key = stack.pop()
+            self._keys.pop(key, None)
+            stack.extend(f"{key}\\{subkey}" for subkey in self._subkeys.pop(key, {}))
 
     def assert_context_menu(self, parent: str, name: str) -> None:
         """Asserts that keys for a ContextMenu are correctly set.
@@ -191,6 +276,7 @@ class MockedPlatform:
         self._name = name
         self._patches = [
             patch("context_menu.menus.platform", self),
+            patch("context_menu.manifest.platform", self),
         ]
 
     def system(self) -> str:
@@ -0,0 +1,221 @@
+"""
+Records how long menus and their commands take, for menus compiled with telemetry=True.
+
+Every menu has its own append-only store in the telemetry directory of context_menu, one line per
+record. The Nautilus extensions record the time they take to build their items on every selection
+change, the time an activated command blocks Nautilus, and the time until the command finished.
+On Windows, where Explorer builds the menus, the commands running python record how long they ran.
+
+    python -m context_menu.telemetry "Foo menu"
+
+prints the 50th, 95th and 99th percentiles of every command.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING, NamedTuple
+import argparse
+import atexit
+import os
+import sys
+import time
+
+from context_menu.paths import data_dir
+
+if TYPE_CHECKING:
+    from typing import Iterator
+
+# The events of the records
+EVENTS = ("items", "activate", "exit")
+
+# The selection size and status of the exit record of the current process, set by start
+exit_record: dict[str, int] | None = None
+
+
+class Record(NamedTuple):
+    """
+    One line of a store, duration is in milliseconds.
+
+    items: a Nautilus extension built the items of a selection, command is empty
+    activate: a command was clicked, duration is the time Nautilus was blocked by it
+    exit: a command finished, status is its exit status or 1 if the python function raised
+    """
+
+    time: float
+    event: str
+    command: str
+    duration: float
+    selection: int
+    status: int
+
+
+class Summary(NamedTuple):
+    """
+    The durations of an event of a command, in milliseconds.
+    """
+
+    count: int
+    failures: int
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+
+def store_path(menu: str) -> str:
+    """
+    Returns the path of the store of a menu.
+    """
+    return os.path.join(data_dir("telemetry"), "".join(menu.split()) + ".log")
+
+
+def format_record(event: str, command: str, duration: float, selection: int, status: int) -> str:
+    """
+    Returns the line of a record, the generated Nautilus extensions write the same format.
+    """
+    command = command.replace("\t", " ").replace("\n", " ")
+    return f"{time.time():.6f}\t{event}\t{command}\t{duration:.3f}\t{selection}\t{status}\n"
+
+
+def append(menu: str, line: str) -> None:
+    """
+    Appends a line to the store of a menu, with a single write so concurrent processes don't mix their lines.
+    """
+    fd = os.open(store_path(menu), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, line.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
+def start(menu: str, command: str, selection: int) -> None:
+    """
+    Records the exit of the current process, called first by the commands of menus compiled with telemetry.
+
+    The status is 1 if the process ends with an uncaught exception.
+    """
+    global exit_record
+    begin = time.perf_counter()
+    record = exit_record = {"selection": selection, "status": 0}
+    excepthook = sys.excepthook
+
+    def failed(*args):
+        record["status"] = 1
+        excepthook(*args)
+
+    def finished() -> None:
+        if exit_record is not record:
+            return
+        duration = (time.perf_counter() - begin) * 1000
+        try:
+            append(menu, format_record("exit", command, duration, record["selection"], record["status"]))
+        except OSError:
+            pass
+
+    sys.excepthook = failed
+    atexit.register(finished)
+
+
+def set_selection(size: int) -> None:
+    """
+    Sets the selection size of the exit record of the current process, for a command that gathered more paths.
+    """
+    if exit_record is not None:
+        exit_record["selection"] = size
+
+
+def discard() -> None:
+    """
+    Drops the exit record of the current process, for a command that handed its paths over to another process.
+    """
+    global exit_record
+    exit_record = None
+
+
+def read(menu: str) -> Iterator[Record]:
+    """
+    Yields the records of a menu, skipping lines that are incomplete.
+    """
+    try:
+        store = open(store_path(menu), encoding="utf-8")
+    except FileNotFoundError:
+        return
+
+    with store:
+        for line in store:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 6:
+                continue
+            try:
+                yield Record(
+                    float(fields[0]),
+                    fields[1],
+                    fields[2],
+                    float(fields[3]),
+                    int(fields[4]),
+                    int(fields[5]),
+                )
+            except ValueError:
+                continue
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Returns the q-th percentile of sorted values, interpolating between the closest ranks.
+    """
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(menu: str, since: float | None = None) -> dict[tuple[str, str], Summary]:
+    """
+    Returns the summary of every (event, command) of a menu, only counting the records after since, a time.time().
+    """
+    durations: dict[tuple[str, str], list[float]] = {}
+    failures: dict[tuple[str, str], int] = {}
+    for record in read(menu):
+        if since is not None and record.time < since:
+            continue
+        key = (record.event, record.command)
+        durations.setdefault(key, []).append(record.duration)
+        failures[key] = failures.get(key, 0) + (record.status != 0)
+
+    summaries = {}
+    for key, values in sorted(durations.items()):
+        values.sort()
+        summaries[key] = Summary(
+            len(values),
+            failures[key],
+            percentile(values, 50),
+            percentile(values, 95),
+            percentile(values, 99),
+            values[-1],
+        )
+    return summaries
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    Entry point of python -m context_menu.telemetry.
+    """
+    parser = argparse.ArgumentParser(description="Reports the telemetry of a menu")
+    parser.add_argument("menu", help="the name the menu was compiled with")
+    parser.add_argument("--hours", type=float, default=None, help="only the records of the last hours")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.hours * 3600 if args.hours is not None else None
+    summaries = summarize(args.menu, since)
+    if not summaries:
+        print(f"No records for {args.menu} in {store_path(args.menu)}")
+        return
+
+    print(f"{'event':<10} {'command':<30} {'count':>7} {'failed':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for (event, command), summary in summaries.items():
+        print(
+            f"{event:<10} {command[:30]:<30} {summary.count:>7} {summary.failures:>7}"
+            f" {summary.p50:>10.2f} {summary.p95:>10.2f} {summary.p99:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Traversal of menu trees, shared by the Linux and Windows backends.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Callable, Iterable, Iterator, TypeVar
+
+    from context_menu.menus import ItemType
+
+    T = TypeVar("T")
+
+
+def walk(items: Iterable[ItemType], parent: T, visit: Callable[[ItemType, T], T]) -> None:
+    """
+    Calls visit(item, parent) for every item below items, in the order they appear in the menus.
+
+    For a menu, the value visit returns is passed as parent to the menu's own items, if it returns
+    None the items of the menu are skipped. The tree is walked with an explicit stack instead of
+    recursion, so the depth of the menus is only limited by memory.
+    """
+    stack: list[tuple[Iterator[ItemType], T]] = [(iter(items), parent)]
+    while stack:
+        children, parent = stack[-1]
+        for item in children:
+            context = visit(item, parent)
+            if item.isMenu and context is not None:
+                # Continues with the items of the menu, then with the rest of children
+                stack.append((iter(item.sub_items), context))
+                break
+        else:
+            stack.pop()
@@ -2,12 +2,21 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
 import os
-import ctypes
+import functools
+import hashlib
+import importlib.util
+import py_compile
 import sys
+from collections import Counter
+
+from context_menu.ir import archive_path, lower_items, locate, make_command
+from context_menu.tree import walk
 
 if TYPE_CHECKING:
-    from typing import Any
+    from typing import Any, Iterable, Sequence
     from types import FunctionType
+
+    from context_menu.ir import Command, Function, Node
     from context_menu.menus import (
         ItemType,
         MethodInfo,
@@ -28,6 +37,8 @@ try:
         """
         Returns True if the current python instance has admin, and false otherwise.
         """
+        import ctypes
+
         try:
             return ctypes.windll.shell32.IsUserAnAdmin()
         except:
@@ -40,6 +51,8 @@ try:
         You can customize where it runs/Force it to run regardless.
         """
         if not is_admin() or force:
+            import ctypes
+
             ctypes.windll.shell32.ShellExecuteW(
                 None, "runas", sys.executable, params, None, 1
             )
@@ -67,6 +80,27 @@ try:
         winreg.SetValueEx(registry_key, subkey_name, 0, winreg.REG_SZ, value)
         winreg.CloseKey(registry_key)
 
+    def open_key(path: str, hive: Any = winreg.HKEY_CURRENT_USER) -> Any:
+        """
+        Creates the key if needed and returns a handle to write to it.
+
+        hive can also be the handle of an open key, path is then relative to it.
+        """
+        return winreg.CreateKeyEx(hive, path, 0, winreg.KEY_WRITE)
+
+    def set_key_values(handle: Any, values: dict[str, str | int]) -> None:
+        """
+        Sets several values of an open key.
+        """
+        for value_name, value in values.items():
+            winreg.SetValueEx(handle, value_name, 0, winreg.REG_SZ, value)
+
+    def close_key(handle: Any) -> None:
+        """
+        Closes a handle returned by open_key.
+        """
+        winreg.CloseKey(handle)
+
     def get_key_value(
         key_path: str,
         subkey_name: str,
@@ -78,6 +112,30 @@ try:
         with winreg.OpenKey(hive, key_path, 0, winreg.KEY_READ) as open_key:
             return winreg.QueryValueEx(open_key, subkey_name)[0]
 
+    def delete_value(
+        key_path: str,
+        subkey_name: str,
+        hive: int = winreg.HKEY_CURRENT_USER,
+    ) -> None:
+        """
+        Deletes a value of a key.
+        """
+        with winreg.OpenKey(hive, key_path, 0, winreg.KEY_WRITE) as open_key:
+            winreg.DeleteValue(open_key, subkey_name)
+
+    def list_values(path: str, hive: int = winreg.HKEY_CURRENT_USER) -> dict[str, Any]:
+        """
+        Returns all the values of the key at the given path, by name.
+        """
+        with winreg.OpenKey(hive, path, 0, winreg.KEY_READ) as open_key:
+            value_amt = winreg.QueryInfoKey(open_key)[1]
+            values = {}
+            for count in range(value_amt):
+                value_name, value, _ = winreg.EnumValue(open_key, count)
+                values[value_name] = value
+
+        return values
+
     def list_keys(path: str, hive: int = winreg.HKEY_CURRENT_USER) -> list[str]:
         """
         Returns a list of all the keys at a given registry path.
@@ -121,12 +179,42 @@ except:
         """
         raise NotImplementedError("winreg is not available on this platform")
 
+    def open_key(path: str, hive: Any = 0) -> Any:
+        """
+        Creates the key if needed and returns a handle to write to it.
+        """
+        raise NotImplementedError("winreg is not available on this platform")
+
+    def set_key_values(handle: Any, values: dict[str, str | int]) -> None:
+        """
+        Sets several values of an open key.
+        """
+        raise NotImplementedError("winreg is not available on this platform")
+
+    def close_key(handle: Any) -> None:
+        """
+        Closes a handle returned by open_key.
+        """
+        raise NotImplementedError("winreg is not available on this platform")
+
     def get_key_value(key_path: str, subkey_name: str, hive: int = 0) -> Any:
         """
         Gets the value of a subkey.
         """
         raise NotImplementedError("winreg is not available on this platform")
 
+    def delete_value(key_path: str, subkey_name: str, hive: int = 0) -> None:
+        """
+        Deletes a value of a key.
+        """
+        raise NotImplementedError("winreg is not available on this platform")
+
+    def list_values(path: str, hive: int = 0) -> dict[str, Any]:
+        """
+        Returns all the values of the key at the given path, by name.
+        """
+        raise NotImplementedError("winreg is not available on this platform")
+
     def list_keys(path: str, hive: int = 0) -> list[str]:
         """
         Returns a list of all the keys at a given registry path.
@@ -139,8 +227,6 @@ except:
         """
         raise NotImplementedError("winreg is not available on this platform")
 
-    print("Not windows")
-
 
 # advanced_reg_config.py ----------------------------------------------------------------------------------------
 
@@ -154,8 +240,12 @@ CONTEXT_SHORTCUTS = {
     "DIRECTORY_BACKGROUND": "Software\\Classes\\Directory\\Background\\shell",
     "DRIVE": "Software\\Classes\\Drive\\shell",
     "DESKTOP": "Software\\Classes\\DesktopBackground\\shell",
+    # Menus registered for several types or with repeated submenus keep their items here once
+    "STORE": "Software\\Classes\\ContextMenus",
 }
 
+BACKGROUND_TYPES = ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"]
+
 # Not used yet, but could be useful in the future
 COMMAND_PRESETS = {
     "python": sys.executable,
@@ -194,6 +284,42 @@ def context_registry_format(item: str) -> str:
     return CONTEXT_SHORTCUTS[item]
 
 
+def type_list(type: ActivationType | str | Sequence[str]) -> list[str]:
+    """
+    Returns the types of a menu, which can be registered for a list of types.
+    """
+    if isinstance(type, str):
+        return [type.upper()]
+    return [item.upper() for item in type]
+
+
+def is_background(types: list[str]) -> bool:
+    """
+    Returns True if the types are backgrounds, whose commands run in the current directory instead of on a selection.
+    """
+    background = {item in BACKGROUND_TYPES for item in types}
+    if len(background) > 1:
+        raise ValueError("A menu can't be registered for both backgrounds and files")
+    return background.pop()
+
+
+def store_path(name: str, types: list[str]) -> str:
+    """
+    Returns the store key of a menu, named after the menu and its types.
+    """
+    digest = hashlib.sha1(";".join(sorted(types)).encode("utf-8"))
+    return join_keys(CONTEXT_SHORTCUTS["STORE"], f"{name}-{digest.hexdigest()[:8]}")
+
+
+def registry_class_path(path: str) -> str:
+    """
+    Converts a path below HKEY_CURRENT_USER\\Software\\Classes to a path in HKEY_CLASSES_ROOT.
+
+    Explorer resolves ExtendedSubCommandsKey in HKEY_CLASSES_ROOT, which merges the classes of the user.
+    """
+    return path.split("\\", 2)[2]
+
+
 def command_preset_format(item: str) -> str:
     """
     Converts a python string to an executable location.
@@ -211,21 +337,129 @@ def command_var_format(item: str) -> str:
     return COMMAND_VARS[item.upper()]
 
 
+def create_worker_call(
+    func_name: str, func_file_name: str, func_dir_path: str, params: str, dir_path: str
+) -> str:
+    """
+    Creates the python code that forwards a function call to the resident worker instead of importing the function.
+    """
+    func_dir_path = func_dir_path.replace("\\", "/")
+    return f"""from context_menu import worker; worker.call('{func_dir_path}', '{func_file_name}', '{func_name}', [{dir_path}], '{params}')"""
+
+
+def create_coalesce_call(
+    func_name: str,
+    func_file_name: str,
+    func_dir_path: str,
+    params: str,
+    worker: bool,
+    parallel: str | None = None,
+    ordered: bool = True,
+) -> str:
+    """
+    Creates the python code that merges the invocations of a multi-file selection into a single function call.
+    """
+    func_dir_path = func_dir_path.replace("\\", "/")
+    worker_arg = ", worker=True" if worker else ""
+    parallel_arg = f", parallel='{parallel}'" if parallel is not None else ""
+    ordered_arg = "" if ordered else ", ordered=False"
+    return f"""from context_menu import coalesce; coalesce.invoke('{func_dir_path}', '{func_file_name}', '{func_name}', sys.argv[1:], '{params}'{worker_arg}{parallel_arg}{ordered_arg})"""
+
+
+def create_parallel_call(
+    func_name: str,
+    func_file_name: str,
+    func_dir_path: str,
+    params: str,
+    parallel: str,
+    dir_path: str,
+    ordered: bool = True,
+) -> str:
+    """
+    Creates the python code that spreads the selection over a pool of processes (see context_menu.parallel).
+    """
+    func_dir_path = func_dir_path.replace("\\", "/")
+    ordered_arg = "" if ordered else ", ordered=False"
+    return f"""from context_menu import parallel; parallel.call('{func_dir_path}', '{func_file_name}', '{func_name}', {dir_path}, '{params}', '{parallel}'{ordered_arg})"""
+
+
+def create_import_section(func_file_name: str, func_dir_path: str) -> str:
+    """
+    Creates the python code importing the module of a function from its directory, without searching sys.path.
+
+    The directory is appended to sys.path for the modules the function imports from it, so these don't shadow
+    the other modules either.
+    """
+    func_dir_path = func_dir_path.replace("\\", "/")
+    return (
+        f"from importlib.machinery import PathFinder; from importlib.util import module_from_spec; "
+        f"sys.path.append('{func_dir_path}'); spec = PathFinder.find_spec('{func_file_name}', ['{func_dir_path}']); "
+        f"{func_file_name} = sys.modules['{func_file_name}'] = module_from_spec(spec); spec.loader.exec_module({func_file_name})"
+    )
+
+
+def create_function_call(
+    func_name: str,
+    func_file_name: str,
+    params: str,
+    dir_path: str,
+    profile: str | None = None,
+    command_name: str = "",
+) -> str:
+    """
+    Creates the python code calling the function directly, under the profilers if profile is set (see context_menu.profiling).
+    """
+    if profile is None:
+        return f"""{func_file_name}.{func_name}([{dir_path}],'{params}')"""
+    command_name = command_name.replace("'", "\\'")
+    return f"""from context_menu import profiling; profiling.call({func_file_name}.{func_name}, [{dir_path}], '{params}', '{command_name}', '{profile}')"""
+
+
 def create_file_select_command(
-    func_name: str, func_file_name: str, func_dir_path: str, params: str
+    func_name: str,
+    func_file_name: str,
+    func_dir_path: str,
+    params: str,
+    worker: bool = False,
+    coalesce: bool = False,
+    parallel: str | None = None,
+    profile: str | None = None,
+    command_name: str = "",
+    ordered: bool = True,
 ) -> str:
     """
     Creates a registry valid command to link a context menu entry to a funtion, specifically for file selection(FILES, DIRECTORY, DRIVE).
 
     Requires the name of the function, the name of the file, and the path to the directory of the file.
+    If worker is True, the function is ran by the resident worker (see context_menu.worker).
+    If coalesce is True, the processes Explorer starts for each selected file are merged into a single call (see context_menu.coalesce).
+    If parallel is set, the selection is spread over a pool of processes (see context_menu.parallel), ordered
+    tells how its results are collected.
+    If profile is set, the function is profiled and the dumps are kept under command_name (see context_menu.profiling).
     """
     python_loc = sys.executable
-    sys_section = f"""import sys; sys.path.insert(0, '{func_dir_path}')""".replace(
-        "\\", "/"
-    )
-    file_section = f"import {func_file_name}"
+    if coalesce:
+        coalesce_section = create_coalesce_call(
+            func_name, func_file_name, func_dir_path, params, worker, parallel, ordered
+        )
+        return f'''"{python_loc}" -c "import sys; {coalesce_section}" \"%1\"'''
+    if parallel is not None:
+        parallel_section = create_parallel_call(
+            func_name, func_file_name, func_dir_path, params, parallel, "sys.argv[1:]", ordered
+        )
+        return f'''"{python_loc}" -c "import sys; {parallel_section}" \"%1\"'''
+    if worker:
+        worker_section = create_worker_call(
+            func_name, func_file_name, func_dir_path, params, """' '.join(sys.argv[1:]) """
+        )
+        return f'''"{python_loc}" -c "import sys; {worker_section}" \"%1\"'''
+
+    sys_section = "import sys"
+    file_section = create_import_section(func_file_name, func_dir_path)
     dir_path = """' '.join(sys.argv[1:]) """
-    func_section = f"""{func_file_name}.{func_name}([{dir_path}],'{params}')"""
+    func_section = create_function_call(
+        func_name, func_file_name, params, dir_path, profile, command_name
+    )
     python_portion = (
         f'''"{python_loc}" -c "{sys_section}; {file_section}; {func_section}"'''
     )
@@ -235,22 +469,41 @@ def create_file_select_command(
 
 
 def create_directory_background_command(
-    func_name: str, func_file_name: str, func_dir_path: str, params: str
+    func_name: str,
+    func_file_name: str,
+    func_dir_path: str,
+    params: str,
+    worker: bool = False,
+    parallel: str | None = None,
+    profile: str | None = None,
+    command_name: str = "",
 ) -> str:
     """
     Creates a registry valid command to link a context menu entry to a funtion, specifically for backgrounds(DIRECTORY_BACKGROUND, DESKTOP_BACKGROUND).
 
     Requires the name of the function, the name of the file, and the path to the directory of the file.
+    If worker is True, the function is ran by the resident worker (see context_menu.worker).
+    If parallel is set, the function is called like for a selection of the directory (see context_menu.parallel).
+    See create_file_select_command for profile.
     """
     python_loc = sys.executable
-    sys_section = (
-        f"""import sys; import os; sys.path.insert(0, '{func_dir_path}')""".replace(
-            "\\", "/"
+    if parallel is not None:
+        parallel_section = create_parallel_call(
+            func_name, func_file_name, func_dir_path, params, parallel, "[os.getcwd()]"
         )
-    )
-    file_section = f"import {func_file_name}"
+        return f'''"{python_loc}" -c "import os; {parallel_section}"'''
+    if worker:
+        worker_section = create_worker_call(
+            func_name, func_file_name, func_dir_path, params, "os.getcwd()"
+        )
+        return f'''"{python_loc}" -c "import os; {worker_section}"'''
+
+    sys_section = "import sys; import os"
+    file_section = create_import_section(func_file_name, func_dir_path)
     dir_path = "os.getcwd()"
-    func_section = f"""{func_file_name}.{func_name}([{dir_path}],'{params}')"""
+    func_section = create_function_call(
+        func_name, func_file_name, params, dir_path, profile, command_name
+    )
     full_command = (
         f'''"{python_loc}" -c "{sys_section}; {file_section}; {func_section}"'''
     )
@@ -272,6 +525,323 @@ def create_shell_command(command: str, command_vars: list[CommandVar]) -> str:
     return full_command
 
 
+@functools.lru_cache(maxsize=65536)
+def create_item_command(item: Command, background: bool) -> str:
+    """
+    Returns the registry command of a lowered command.
+
+    Cached by the content of the command, so commands shared by several menus or compiles are only created once.
+    """
+    if item.function is not None:
+        # If a python function is defined
+        func_name, func_file_name, func_dir_path = item.function
+        if background:
+            # If it requires a background selection
+            return create_directory_background_command(
+                func_name,
+                func_file_name,
+                func_dir_path,
+                item.params,
+                item.worker,
+                item.parallel,
+                item.profile,
+                item.name,
+            )
+        # If it requires a file selection
+        return create_file_select_command(
+            func_name,
+            func_file_name,
+            func_dir_path,
+            item.params,
+            item.worker,
+            item.coalesce,
+            item.parallel,
+            item.profile,
+            item.name,
+            item.ordered,
+        )
+
+    assert item.command is not None
+    if item.command_vars is not None:
+        # If the item has to be ran from os.system
+        return create_shell_command(item.command, list(item.command_vars))
+    # The item is just a plain old command
+    return item.command
+
+
+@functools.lru_cache(maxsize=None)
+def frozen_path() -> str:
+    """
+    Returns the import path of the current interpreter as python code, for the commands launched without site.
+
+    It holds the directories site and the .pth files added, so the packages installed for this interpreter are found.
+    """
+    paths = [path.replace("\\", "/").replace("'", "\\'") for path in dict.fromkeys(sys.path) if path]
+    return "[" + ", ".join(f"'{path}'" for path in paths) + "]"
+
+
+def windowless_command(command: str) -> str:
+    """
+    Makes a command running python start pythonw, so no console flashes, with a short startup.
+
+    The interpreter runs isolated from the environment (-I) and without the site module (-S), its import
+    path is set to the one of the interpreter compiling the menu instead (see frozen_path).
+    Other commands are returned unchanged.
+    """
+    python_section = f'"{sys.executable}" -c "'
+    if not command.startswith(python_section):
+        return command
+    pythonw = COMMAND_PRESETS["pythonw"]
+    launch_section = f'"{pythonw}" -I -S -c "import sys; sys.path[:] = {frozen_path()}; '
+    return launch_section + command[len(python_section) :]
+
+
+def precompile(functions: Iterable[Function]) -> None:
+    """
+    Byte-compiles the modules of the functions whose bytecode is missing or outdated, so their first call doesn't compile them.
+    """
+    for function in functions:
+        source = os.path.join(function.directory, function.module + ".py")
+        try:
+            cached = importlib.util.cache_from_source(source)
+            if os.path.getmtime(cached) >= os.path.getmtime(source):
+                continue
+        except OSError:
+            # No bytecode yet, or the module isn't a source file
+            if not os.path.isfile(source):
+                continue
+        try:
+            py_compile.compile(source, doraise=True)
+        except (py_compile.PyCompileError, OSError):
+            # The error shows when the command is run
+            pass
+
+
+def add_telemetry(command: str, menu: str, name: str, background: bool) -> str:
+    """
+    Makes a command running python record how long it ran in the telemetry store of menu (see context_menu.telemetry).
+
+    Plain commands are started by Explorer itself and are returned unchanged. For coalesced commands, the
+    leader records the size of the merged selection and the invocations it merged record nothing.
+    """
+    python_section = f'"{sys.executable}" -c "'
+    if not command.startswith(python_section):
+        return command
+    menu, name = (value.replace("'", "\\'") for value in (menu, name))
+    selection = "1" if background else "len(sys.argv[1:])"
+    record = f"import sys; from context_menu import telemetry; telemetry.start('{menu}', '{name}', {selection}); "
+    return python_section + record + command[len(python_section) :]
+
+
+# registry_session.py ----------------------------------------------------------------------------------------
+
+
+class RegistrySession:
+    """
+    Keeps the keys written during a compile open, so each key is opened once.
+
+    Subkeys are opened relative to their parent when it is already open, and all the
+    values of a key are written through the same handle. Every handle is closed when
+    the session is closed, which happens when leaving the with block.
+
+    calls counts the registry operations, for example calls["open_key"].
+    """
+
+    def __init__(self) -> None:
+        self.handles: dict[str, Any] = {}
+        self.calls: Counter[str] = Counter()
+
+    def __enter__(self) -> "RegistrySession":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def key(self, path: str) -> Any:
+        """
+        Returns a handle to the key at path, creating the key if needed.
+        """
+        handle = self.handles.get(path)
+        if handle is None:
+            parent, _, name = path.rpartition("\\")
+            if parent in self.handles:
+                handle = open_key(name, self.handles[parent])
+            else:
+                handle = open_key(path)
+            self.calls["open_key"] += 1
+            self.handles[path] = handle
+        return handle
+
+    def set_values(self, path: str, values: dict[str, str]) -> None:
+        """
+        Writes the values of the key at path, creating the key if needed.
+        """
+        handle = self.key(path)
+        if values:
+            set_key_values(handle, values)
+            self.calls["set_key_values"] += 1
+            self.calls["values"] += len(values)
+
+    def close(self) -> None:
+        """
+        Closes every handle, subkeys before their parents.
+        """
+        for handle in reversed(list(self.handles.values())):
+            close_key(handle)
+            self.calls["close_key"] += 1
+        self.handles.clear()
+
+
+# registry_sync.py ----------------------------------------------------------------------------------------
+
+
+class RegistrySummary:
+    """
+    The registry operations performed by an incremental compile.
+    """
+
+    def __init__(self) -> None:
+        self.created_keys: list[str] = []
+        self.deleted_keys: list[str] = []
+        self.set_values: list[tuple[str, str]] = []
+        self.deleted_values: list[tuple[str, str]] = []
+        self.unchanged_keys = 0
+
+    @property
+    def changed(self) -> bool:
+        """
+        True if the registry was modified.
+        """
+        return bool(
+            self.created_keys or self.deleted_keys or self.set_values or self.deleted_values
+        )
+
+    def update(self, other: RegistrySummary) -> None:
+        """
+        Adds the operations of other.
+        """
+        self.created_keys.extend(other.created_keys)
+        self.deleted_keys.extend(other.deleted_keys)
+        self.set_values.extend(other.set_values)
+        self.deleted_values.extend(other.deleted_values)
+        self.unchanged_keys += other.unchanged_keys
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self.created_keys)} keys created, {len(self.deleted_keys)} keys deleted, "
+            f"{len(self.set_values)} values set, {len(self.deleted_values)} values deleted, "
+            f"{self.unchanged_keys} keys unchanged"
+        )
+
+
+def read_keys(path: str) -> dict[str, dict[str, Any]]:
+    """
+    Reads the key at path and all its subkeys, returns the values of every key by path.
+
+    Returns an empty dict if the key doesn't exist.
+    """
+    try:
+        keys = {path: dict(list_values(path))}
+    except OSError:
+        return {}
+
+    for subkey in list_keys(path):
+        keys.update(read_keys(join_keys(path, subkey)))
+
+    return keys
+
+
+def write_keys(keys: dict[str, dict[str, str]], session: RegistrySession | None = None) -> None:
+    """
+    Creates every key and sets its values, parents have to come before their subkeys.
+    """
+    if session is None:
+        with RegistrySession() as session:
+            write_keys(keys, session)
+        return
+
+    for key_path, values in keys.items():
+        session.set_values(key_path, values)
+
+
+def sync_keys(
+    path: str, keys: dict[str, dict[str, str]], session: RegistrySession | None = None
+) -> RegistrySummary:
+    """
+    Makes the subtree at path match keys, only writing what differs from the registry.
+
+    Keys and values that are no longer wanted are deleted, except for the default
+    value of a key, which is left alone.
+    """
+    if session is None:
+        with RegistrySession() as session:
+            return sync_keys(path, keys, session)
+
+    summary = RegistrySummary()
+    existing = read_keys(path)
+
+    for key_path in existing:
+        parent = key_path.rpartition("\\")[0]
+        if key_path not in keys and (parent not in existing or parent in keys):
+            # Deleting the topmost stale key takes its subkeys with it
+            delete_key(key_path)
+            summary.deleted_keys.append(key_path)
+
+    for key_path, values in keys.items():
+        current = existing.get(key_path)
+        changed = current is None
+        if current is None:
+            session.key(key_path)
+            summary.created_keys.append(key_path)
+            current = {}
+
+        for value_name in current:
+            if value_name != "" and value_name not in values:
+                delete_value(key_path, value_name)
+                summary.deleted_values.append((key_path, value_name))
+                changed = True
+
+        changed_values = {
+            value_name: value
+            for value_name, value in values.items()
+            if current.get(value_name) != value
+        }
+        if changed_values:
+            session.set_values(key_path, changed_values)
+            summary.set_values.extend((key_path, value_name) for value_name in changed_values)
+            changed = True
+
+        if not changed:
+            summary.unchanged_keys += 1
+
+    return summary
+
+
+def sync_roots(
+    roots: list[str], keys: dict[str, dict[str, str]], session: RegistrySession | None = None
+) -> RegistrySummary:
+    """
+    Syncs the subtree of every root like sync_keys, every key has to be below one of the roots.
+
+    Roots without keys are deleted.
+    """
+    if session is None:
+        with RegistrySession() as session:
+            return sync_roots(roots, keys, session)
+
+    grouped: dict[str, dict[str, dict[str, str]]] = {root: {} for root in roots}
+    for key_path, values in keys.items():
+        root = key_path
+        while root not in grouped:
+            root = root.rpartition("\\")[0]
+        grouped[root][key_path] = values
+
+    summary = RegistrySummary()
+    for root, root_keys in grouped.items():
+        summary.update(sync_keys(root, root_keys, session))
+    return summary
+
+
 # windows_menus.py ----------------------------------------------------------------------------------------
 
 
@@ -281,96 +851,183 @@ class RegistryMenu:
     Class to convert the general menu from menus.py to a Windows-specific menu.
     """
 
-    def __init__(self, name: str, sub_items: list[ItemType], type: str, icon_path: str = None) -> None:
+    def __init__(
+        self,
+        name: str,
+        sub_items: list[ItemType],
+        type: ActivationType | str | Sequence[str],
+        icon_path: str = None,
+        telemetry: str | None = None,
+    ) -> None:
         """
-        Handled automatically by menus.py, but requires a name, all the sub items, and a type
+        Handled automatically by menus.py, but requires a name, all the sub items, and a type or a list of types.
+
+        A menu registered for several types, like a list of extensions, keeps its items once in the
+        store (CONTEXT_SHORTCUTS["STORE"]) and every type only gets a key referencing them. Submenus
+        that appear several times in the menu are kept once in the store as well. Menus with the same
+        name and other types have their own store, which lists its types for remove_windows_menu.
+
+        If telemetry is the name of a telemetry store, the commands running python record how long they ran in it.
         """
         self.name = name
-        self.sub_items = sub_items
-        self.type = type.upper()
+        self.sub_items = lower_items(sub_items)
+        self.types = type_list(type)
+        self.type = self.types[0]
+        self.background = is_background(self.types)
         self.icon_path = icon_path
-        self.path = context_registry_format(type)
+        self.telemetry = telemetry
+        self.paths = [context_registry_format(item) for item in self.types]
+        self.path = self.paths[0]
+        self.store = store_path(name, self.types)
+        # The keys of the menu and their values, filled by build_keys
+        self.keys: dict[str, dict[str, str]] = {}
+        # The submenus that appear more than once, with the store key of the ones already written
+        self.shared: dict[Node, str | None] = {}
+        # The functions of the commands launched windowless, byte-compiled by compile
+        self.functions: set[Function] = set()
 
     def create_menu(self, name: str, path: str, icon_path: str = None) -> str:
         """
         Creates a menu with the given name and path.
 
-        Used in the compile method.
+        Used in the build_keys method.
         """
         key_path = join_keys(path, name)
-        create_key(key_path)
-
-        set_key_value(key_path, "MUIVerb", name)
-        set_key_value(key_path, "subcommands", "")
+        self.keys[key_path] = {"MUIVerb": name, "subcommands": ""}
         if icon_path is not None:
-            set_key_value(key_path, 'Icon', icon_path)
+            self.keys[key_path]["Icon"] = icon_path
 
         key_shell_path = join_keys(key_path, "shell")
-        create_key(key_shell_path)
+        self.keys[key_shell_path] = {}
 
         return key_shell_path
 
-    def create_command(self, name: str, path: str, command: str, icon_path: str = None) -> None:
+    def create_reference(self, name: str, path: str, store: str, icon_path: str = None) -> None:
         """
-        Creates a key with a command subkey with the 'name' and 'command', at path 'path'.
+        Creates a menu with the given name and path, whose items are in the store key store.
         """
         key_path = join_keys(path, name)
-        create_key(key_path)
-        set_key_value(key_path, "", name)
+        self.keys[key_path] = {
+            "MUIVerb": name,
+            "ExtendedSubCommandsKey": registry_class_path(store),
+        }
+        if icon_path is not None:
+            self.keys[key_path]["Icon"] = icon_path
 
-        command_path = join_keys(key_path, "command")
-        create_key(command_path)
-        set_key_value(command_path, "", command)
+    def create_store(self, store: str) -> str:
+        """
+        Creates a key of the store, returns the path its items go to.
+        """
+        self.keys.setdefault(self.store, {"Types": ";".join(self.types)})
+        self.keys.setdefault(store, {})
+        store_shell_path = join_keys(store, "shell")
+        self.keys[store_shell_path] = {}
+
+        return store_shell_path
 
+    def create_command(
+        self, name: str, path: str, command: str, icon_path: str = None, coalesce: bool = False
+    ) -> None:
+        """
+        Creates a key with a command subkey with the 'name' and 'command', at path 'path'.
+
+        A coalesced command gets the Player selection model, Explorer hides the others for more than 15 files.
+        """
+        key_path = join_keys(path, name)
+        self.keys[key_path] = {"": name}
         if icon_path is not None:
-            set_key_value(key_path, 'Icon', icon_path)
+            self.keys[key_path]["Icon"] = icon_path
+        if coalesce:
+            self.keys[key_path]["MultiSelectModel"] = "Player"
+
+        command_path = join_keys(key_path, "command")
+        self.keys[command_path] = {"": command}
 
     def compile(
-        self, items: list[ItemType] | None = None, path: str | None = None
-    ) -> None:
+        self, incremental: bool = False, session: RegistrySession | None = None
+    ) -> RegistrySummary | None:
         """
-        Used to create the menu. Recursively iterates through each element in the top level menu.
+        Used to create the menu.
+
+        If incremental is True, only the keys and values that differ from the registry are written,
+        the ones that aren't part of the menu anymore are deleted, and a summary of the operations is returned.
+        The keys are written through session if given, otherwise through a session of their own.
         """
-        if items == None:
-            # run_admin()
-            items = self.sub_items
+        # run_admin()
+        self.keys = {}
+        self.functions = set()
+        self.build_keys()
+        precompile(self.functions)
+
+        if incremental:
+            # The store is synced as well, so it's deleted if the menu doesn't need it anymore
+            roots = [join_keys(path, self.name) for path in self.paths] + [self.store]
+            return sync_roots(roots, self.keys, session)
+
+        write_keys(self.keys, session)
+        return None
+
+    def build_keys(self) -> None:
+        """
+        Collects the keys of the menu in self.keys. Iterates through each element in the top level menu.
+        """
+        self.shared = self.find_shared()
+        if len(self.paths) > 1:
+            for path in self.paths:
+                self.create_reference(self.name, path, self.store, self.icon_path)
+            path = self.create_store(self.store)
+        else:
             path = self.create_menu(self.name, self.path, self.icon_path)
+        walk(self.sub_items, path, self.build_item_keys)
 
-        assert items is not None
-        assert path is not None
-        for item in items:
-            if item.isMenu:
-                # if the item is a menu
-                submenu_path = self.create_menu(item.name, path, self.icon_path)
-                self.compile(items=item.sub_items, path=submenu_path)
-                continue
+    def find_shared(self) -> dict[Node, str | None]:
+        """
+        Returns the submenus that appear more than once.
 
-            # Otherwise the item is  a command
-            if item.command == None:
-                # If a Python function is defined
-                func_name, func_file_name, func_dir_path = item.get_method_info()
-                new_command = None
-                if self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"]:
-                    # If it requires a background command
-                    new_command = create_directory_background_command(
-                        func_name, func_file_name, func_dir_path, item.params
-                    )
-                else:
-                    # If it requires a file command
-                    new_command = create_file_select_command(
-                        func_name, func_file_name, func_dir_path, item.params
-                    )
-                self.create_command(item.name, path, new_command, item.icon_path)
-            elif item.command_vars != None:
-                # If the item has to be ran from os.system
-                assert item.command is not None
-                assert item.command_vars is not None
-                new_command = create_shell_command(item.command, item.command_vars)
-                self.create_command(item.name, path, new_command, item.icon_path)
-            else:
-                # The item is just a plain old command
-                assert item.command is not None
-                self.create_command(item.name, path, item.command, item.icon_path)
+        The items of a repeated submenu aren't counted again, as they are only written once.
+        """
+        counts: Counter[Node] = Counter()
+
+        def count(item: Node, parent: bool) -> bool | None:
+            if not item.isMenu:
+                return parent
+            counts[item] += 1
+            return True if counts[item] == 1 else None
+
+        walk(self.sub_items, True, count)
+        return {item: None for item, uses in counts.items() if uses > 1}
+
+    def build_item_keys(self, item: Node, path: str) -> str | None:
+        """
+        Collects the keys of an item at path. For a menu, returns the path of its items.
+
+        Returns None for a repeated submenu whose items are already in the store.
+        """
+        if item.isMenu:
+            # if the item is a menu
+            if item not in self.shared:
+                return self.create_menu(item.name, path, self.icon_path)
+
+            store = self.shared[item]
+            first = store is None
+            if store is None:
+                # Named after where it first appears, so it keeps its key when other items change
+                digest = hashlib.sha1(join_keys(path, item.name).encode("utf-8"))
+                store = self.shared[item] = join_keys(self.store, digest.hexdigest()[:8])
+            self.create_reference(item.name, path, store, self.icon_path)
+            return self.create_store(store) if first else None
+
+        # Otherwise the item is  a command
+        new_command = create_item_command(item, self.background)
+        if self.telemetry is not None:
+            new_command = add_telemetry(new_command, self.telemetry, item.name, self.background)
+        if item.launch == "windowless":
+            new_command = windowless_command(new_command)
+            if item.function is not None:
+                self.functions.add(item.function)
+        self.create_command(item.name, path, new_command, item.icon_path, item.coalesce)
+
+        return path
 
 
 # Fast command class
@@ -385,78 +1042,142 @@ class FastRegistryCommand:
     def __init__(
         self,
         name: str,
-        type: ActivationType | str,
+        type: ActivationType | str | Sequence[str],
         command: str,
         python: FunctionType,
         params: str,
         command_vars: list[CommandVar],
         icon_path: str = None,
+        worker: bool = False,
+        coalesce: bool = False,
+        parallel: str | None = None,
+        telemetry: str | None = None,
+        profile: str | None = None,
+        launch: str = "console",
+        archive: bool = False,
+        ordered: bool = True,
     ) -> None:
         self.name = name
-        self.type = type
-        self.path = context_registry_format(type)
+        self.types = type_list(type)
+        self.type = self.types[0]
+        self.background = is_background(self.types)
+        # A single command only needs two keys, so it is written for every type instead of into the store
+        self.paths = [context_registry_format(item) for item in self.types]
+        self.path = self.paths[0]
         self.command = command
         self.python = python
         self.params = params
         self.command_vars = command_vars
         self.icon_path = icon_path
+        self.worker = worker
+        self.coalesce = coalesce
+        self.parallel = parallel
+        self.telemetry = telemetry
+        self.profile = profile
+        self.launch = launch
+        self.archive = archive
+        self.ordered = ordered
 
     def get_method_info(self) -> MethodInfo:
-        import inspect
-
-        func_file_path = os.path.abspath(inspect.getfile(self.python))
-
-        func_dir_path = os.path.dirname(func_file_path)
-        func_name = self.python.__name__
-        func_file_name = os.path.splitext(os.path.basename(func_file_path))[0]
-
-        return (func_name, func_file_name, func_dir_path)
+        return locate(self.python)
 
-    def compile(self) -> None:
+    def compile(
+        self, incremental: bool = False, session: RegistrySession | None = None
+    ) -> RegistrySummary | None:
+        """
+        Creates the command, see RegistryMenu.compile for incremental and session.
+        """
         # run_admin()
+        keys = self.build_keys()
+        if self.launch == "windowless" and self.python is not None and not self.archive:
+            precompile([locate(self.python)])
 
-        key_path = join_keys(self.path, self.name)
-        create_key(key_path)
+        if incremental:
+            roots = [join_keys(path, self.name) for path in self.paths]
+            return sync_roots(roots, keys, session)
 
-        command_path = join_keys(key_path, "command")
-        create_key(command_path)
-
-        new_command = self.command
-
-        if self.command == None:
-            # If a python function is defined
-            func_name, func_file_name, func_dir_path = self.get_method_info()
-            if self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"]:
-                # If it requires a background selection
-                new_command = create_directory_background_command(
-                    func_name, func_file_name, func_dir_path, self.params
-                )
-            else:
-                # If it requires a file selection
-                new_command = create_file_select_command(
-                    func_name, func_file_name, func_dir_path, self.params
-                )
-        elif self.command_vars != None:
-            # If it has command_vars
-            new_command = create_shell_command(self.command, self.command_vars)
+        write_keys(keys, session)
+        return None
 
-        set_key_value(command_path, "", new_command)
+    def build_keys(self) -> dict[str, dict[str, str]]:
+        """
+        Returns the keys of the command and their values.
+        """
+        item = make_command(
+            self.name,
+            self.command,
+            self.python,
+            self.params,
+            tuple(self.command_vars) if self.command_vars is not None else None,
+            self.icon_path,
+            self.worker,
+            self.coalesce,
+            parallel=self.parallel,
+            profile=self.profile,
+            launch=self.launch,
+            archive=archive_path(self.python, self.archive),
+            ordered=self.ordered,
+        )
+        new_command = create_item_command(item, self.background)
+        if self.telemetry is not None:
+            new_command = add_telemetry(new_command, self.telemetry, self.name, self.background)
+        if self.launch == "windowless":
+            new_command = windowless_command(new_command)
+
+        keys: dict[str, dict[str, str]] = {}
+        for path in self.paths:
+            key_path = join_keys(path, self.name)
+            keys[key_path] = {}
+            if self.icon_path is not None:
+                keys[key_path]["Icon"] = self.icon_path
+            if self.coalesce:
+                # Explorer doesn't show verbs for more than 15 files otherwise
+                keys[key_path]["MultiSelectModel"] = "Player"
+            keys[join_keys(key_path, "command")] = {"": new_command}
 
-        if self.icon_path is not None:
-            set_key_value(key_path, 'Icon', self.icon_path)
+        return keys
 
 
 # Testing section...
 
 try:
 
-    def remove_windows_menu(name: str, type: ActivationType | str) -> None:
+    def remove_windows_menu(name: str, type: ActivationType | str | Sequence[str]) -> None:
         """
-        Removes a context menu from the windows registry.
+        Removes a context menu from the windows registry, for every type if type is a list.
         """
         # run_admin()
-        menu_path = join_keys(context_registry_format(type), name)
-        delete_key(menu_path)
+        for item in type_list(type):
+            menu_path = join_keys(context_registry_format(item), name)
+            delete_key(menu_path)
+
+        # Only there if the menu has a list of types or repeated submenus. A store is kept
+        # while one of its types still refers to it, the menu may have been removed for some of them.
+        try:
+            stores = list_keys(CONTEXT_SHORTCUTS["STORE"])
+        except OSError:
+            return
+        for store in stores:
+            prefix, _, digest = store.rpartition("-")
+            if prefix != name or len(digest) != 8:
+                continue
+            path = join_keys(CONTEXT_SHORTCUTS["STORE"], store)
+            try:
+                types = list_values(path).get("Types", "").split(";")
+            except OSError:
+                continue
+            if not any(key_exists(join_keys(context_registry_format(item), name)) for item in types if item):
+                delete_key(path)
+
+    def key_exists(path: str) -> bool:
+        """
+        Returns True if the key at path exists.
+        """
+        try:
+            list_values(path)
+        except OSError:
+            return False
+        return True
 
 except Exception:
     pass
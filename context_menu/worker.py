@@ -0,0 +1,489 @@
+"""
+A resident process that keeps the modules of python commands imported.
+
+Commands compiled with worker=True don't import the user's module themselves, they
+forward the selection and the params to the worker, starting it if it isn't running yet.
+The worker stops by itself once it has been idle for a while.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import argparse
+import getpass
+import hashlib
+import importlib.machinery
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import zipimport
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from context_menu.paths import data_dir
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Iterable
+    from multiprocessing.connection import Connection
+    from types import ModuleType
+
+# Seconds without any request before the worker exits
+IDLE_TIMEOUT = 600.0
+# Seconds a client waits for a freshly started worker
+START_TIMEOUT = 10.0
+
+# The directory containing the context_menu package, so the worker can be started by any interpreter
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONNECTION_ERRORS = (OSError, EOFError, AuthenticationError)
+
+
+def default_address(name: str = "worker") -> str:
+    """
+    Returns the address of the worker for the current user.
+
+    This is a named pipe on Windows and a unix socket everywhere else.
+    """
+    if sys.platform == "win32":
+        return f"\\\\.\\pipe\\context_menu_{name}_{getpass.getuser()}"
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or data_dir()
+    return os.path.join(runtime_dir, f"context_menu_{name}.sock")
+
+
+def authkey() -> bytes:
+    """
+    Returns the key shared by the worker and its clients, creating it the first time.
+    """
+    key_path = os.path.join(data_dir(), "worker.key")
+    while True:
+        try:
+            with open(key_path, "rb") as key_file:
+                key = key_file.read()
+            if key:
+                return key
+        except FileNotFoundError:
+            pass
+
+        try:
+            fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            # Another process is creating it at the same time
+            time.sleep(0.01)
+            continue
+        with os.fdopen(fd, "wb") as key_file:
+            key_file.write(os.urandom(32))
+
+
+class DirectoryFinder:
+    """
+    Finds the modules the python functions import from their directory, after everything on sys.path.
+    """
+
+    def __init__(self) -> None:
+        self.directories: list[str] = []
+
+    def find_spec(self, name: str, path: Any = None, target: Any = None) -> Any:
+        if path is not None or not self.directories:
+            return None
+        return importlib.machinery.PathFinder.find_spec(name, self.directories, target)
+
+
+# Appended to sys.meta_path by the first load_function
+directory_finder = DirectoryFinder()
+
+# A lock per module key, so a thread importing a module waits for another one that is importing it already
+import_locks: dict[str, threading.Lock] = {}
+import_locks_lock = threading.Lock()
+
+
+def module_key(path: str, module: str) -> str:
+    """
+    Returns the name a module of a python function is imported under, unique to its directory.
+    """
+    return f"{module}@{hashlib.sha1(path.encode('utf-8')).hexdigest()[:12]}"
+
+
+def import_file(path: str, module: str) -> ModuleType:
+    """
+    Imports the module from the directory path only, without changing sys.path.
+
+    The module is registered under module_key, so modules with the same name from other directories
+    don't replace each other, unless it was already imported under its own name from the same file.
+    The directory is searched for the modules it imports, after everything on sys.path.
+
+    The module is in sys.modules before it finished executing, so concurrent imports wait for each other.
+    """
+    key = module_key(path, module)
+    with import_locks_lock:
+        lock = import_locks.setdefault(key, threading.Lock())
+    with lock:
+        return import_module_file(path, module, key)
+
+
+def import_module_file(path: str, module: str, key: str) -> ModuleType:
+    """
+    Imports the module under key for import_file, which holds the lock of key.
+    """
+    loaded = sys.modules.get(key)
+    if loaded is not None:
+        return loaded
+
+    spec = importlib.machinery.PathFinder.find_spec(module, [path])
+    if spec is None or spec.origin is None:
+        raise ModuleNotFoundError(f"No module named {module!r} in {path}", name=module)
+    loaded = sys.modules.get(module)
+    if loaded is not None and getattr(loaded, "__file__", None) == spec.origin:
+        return loaded
+
+    if path not in directory_finder.directories:
+        directory_finder.directories.append(path)
+    if directory_finder not in sys.meta_path:
+        sys.meta_path.append(directory_finder)
+
+    code = None
+    if isinstance(spec.loader, zipimport.zipimporter):
+        # A zipimporter only loads the modules under their own name, its code is run in a module named key
+        code = spec.loader.get_code(module)
+        locations = spec.submodule_search_locations
+        spec = importlib.machinery.ModuleSpec(key, spec.loader, origin=spec.origin, is_package=locations is not None)
+        spec.submodule_search_locations = locations
+        spec.has_location = True
+    else:
+        spec = importlib.util.spec_from_file_location(
+            key, spec.origin, submodule_search_locations=spec.submodule_search_locations
+        )
+    assert spec is not None and spec.loader is not None
+    loaded = importlib.util.module_from_spec(spec)
+    sys.modules[key] = loaded
+    try:
+        if code is None:
+            spec.loader.exec_module(loaded)
+        else:
+            exec(code, loaded.__dict__)
+    except BaseException:
+        del sys.modules[key]
+        raise
+    return loaded
+
+
+def load_function(path: str, module: str, function: str) -> Callable[..., Any]:
+    """
+    Imports the module from the given directory and returns the function, see import_file.
+
+    Modules stay imported, so only the first call for a module pays for the import.
+    """
+    return getattr(import_file(path, module), function)
+
+
+def run(path: str, module: str, function: str, filenames: list[str], params: str) -> Any:
+    """
+    Calls module.function(filenames, params), for the pools running python functions in other processes.
+
+    Submitted instead of the function, which is only imported by the process running it.
+    """
+    return load_function(path, module, function)(filenames, params)
+
+
+def send(address: str, key: bytes, request: dict[str, Any]) -> Any:
+    """
+    Sends a single request and returns the answer of the worker.
+    """
+    with Client(address, authkey=key) as conn:
+        conn.send(request)
+        return conn.recv()
+
+
+def is_running(address: str | None = None, key: bytes | None = None) -> bool:
+    """
+    Returns True if a worker is listening on the address.
+    """
+    try:
+        send(address or default_address(), key or authkey(), {"command": "ping"})
+    except CONNECTION_ERRORS:
+        return False
+    return True
+
+
+def listen(address: str, key: bytes) -> Listener | None:
+    """
+    Binds the address, returns None if it is taken by a process that still listens on it.
+
+    A unix socket left behind by a process that crashed is removed and bound again. This happens under
+    a lock file, so a process can't remove the socket another one has just bound in its place.
+    """
+    if sys.platform == "win32":
+        # Named pipes disappear with their process
+        try:
+            return Listener(address, authkey=key)
+        except OSError:
+            return None
+
+    import fcntl
+
+    with open(address + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return Listener(address, authkey=key)
+        except OSError:
+            if not is_stale(address):
+                return None
+        try:
+            os.remove(address)
+        except OSError:
+            pass
+        try:
+            return Listener(address, authkey=key)
+        except OSError:
+            return None
+
+
+def is_stale(address: str) -> bool:
+    """
+    Returns True if nothing listens on the unix socket anymore.
+
+    A process that is closing refuses new requests but still listens, its socket must not be removed.
+    """
+    probe = socket.socket(socket.AF_UNIX)
+    try:
+        probe.connect(address)
+    except (ConnectionRefusedError, FileNotFoundError):
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return False
+
+
+class Worker:
+    """
+    Listens for requests and runs each of them in its own thread.
+    """
+
+    def __init__(
+        self,
+        address: str | None = None,
+        idle_timeout: float = IDLE_TIMEOUT,
+        key: bytes | None = None,
+    ) -> None:
+        self.address = address or default_address()
+        self.idle_timeout = idle_timeout
+        self.key = key if key is not None else authkey()
+        self.active = 0
+        self.last_request = time.monotonic()
+        self.closing = False
+        self.lock = threading.Lock()
+
+    def serve_forever(self) -> None:
+        """
+        Handles requests until the worker has been idle for idle_timeout seconds.
+
+        Returns once the calls that are still running have finished.
+        """
+        # Binding first, checking for a running worker and then binding lets two workers started at once
+        # both find none, the second one would remove the socket of the first
+        listener = listen(self.address, self.key)
+        if listener is None:
+            # Another client started a worker first
+            return
+        threading.Thread(target=self.watch_idle, daemon=True).start()
+        try:
+            while not self.closing:
+                try:
+                    conn = listener.accept()
+                except CONNECTION_ERRORS:
+                    continue
+                with conn:
+                    self.handle(conn)
+        finally:
+            listener.close()
+
+        while self.active > 0:
+            time.sleep(0.05)
+
+    def handle(self, conn: Connection) -> None:
+        """
+        Acknowledges a request and starts running it.
+
+        A worker that is closing answers "closed" instead, so the client starts a new one once it exited.
+        """
+        try:
+            request = conn.recv()
+        except CONNECTION_ERRORS:
+            return
+
+        with self.lock:
+            if self.closing:
+                answer = "closed"
+            else:
+                answer = "ok"
+                self.last_request = time.monotonic()
+                if request.get("command") == "run":
+                    self.active += 1
+                    threading.Thread(target=self.run, args=(request,), daemon=True).start()
+                elif request.get("command") == "stop":
+                    self.closing = True
+        try:
+            conn.send(answer)
+        except CONNECTION_ERRORS:
+            pass
+
+    def run(self, request: dict[str, Any]) -> None:
+        """
+        Calls the requested function, errors are printed to the log of the worker.
+        """
+        try:
+            func = load_function(request["path"], request["module"], request["function"])
+            func(request["filenames"], request["params"])
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.last_request = time.monotonic()
+
+    def watch_idle(self) -> None:
+        """
+        Shuts the worker down once no request arrived for idle_timeout seconds.
+        """
+        while True:
+            time.sleep(min(1.0, self.idle_timeout))
+            with self.lock:
+                idle = time.monotonic() - self.last_request
+                if self.active == 0 and idle >= self.idle_timeout:
+                    # Under the lock, a request is either accepted before or refused
+                    self.closing = True
+                    break
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        """
+        Stops serve_forever.
+        """
+        self.closing = True
+        try:
+            # Wakes up the pending accept()
+            Client(self.address, authkey=self.key).close()
+        except CONNECTION_ERRORS:
+            pass
+
+
+def stop(address: str | None = None) -> bool:
+    """
+    Asks the worker to exit, calls that are already running are finished first.
+
+    Returns False if no worker was running.
+    """
+    try:
+        send(address or default_address(), authkey(), {"command": "stop"})
+    except CONNECTION_ERRORS:
+        return False
+    return True
+
+
+def start(
+    address: str | None = None,
+    python: str | None = None,
+    idle_timeout: float = IDLE_TIMEOUT,
+) -> subprocess.Popen:
+    """
+    Starts a worker in the background, detached from the current process, and returns its process.
+
+    python is the interpreter used for the worker, sys.executable by default.
+    """
+    args = [
+        python or sys.executable,
+        "-m",
+        "context_menu.worker",
+        "--address",
+        address or default_address(),
+        "--idle-timeout",
+        str(idle_timeout),
+    ]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (PACKAGE_PARENT, env.get("PYTHONPATH")) if path
+    )
+
+    kwargs: dict[str, Any] = {}
+    if sys.platform == "win32":
+        kwargs["creationflags"] = subprocess.DETACHED_PROCESS
+    else:
+        kwargs["start_new_session"] = True
+
+    with open(os.path.join(data_dir(), "worker.log"), "ab") as log:
+        process = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            env=env,
+            close_fds=True,
+            **kwargs,
+        )
+    # Reaps the worker when it exits, the caller may be a long running process like Nautilus
+    threading.Thread(target=process.wait, daemon=True).start()
+    return process
+
+
+def call(
+    path: str,
+    module: str,
+    function: str,
+    filenames: Iterable[str],
+    params: str,
+    address: str | None = None,
+    python: str | None = None,
+) -> None:
+    """
+    Runs module.function(filenames, params) in the worker, starting the worker if needed.
+
+    Returns as soon as the worker has accepted the request. A worker that is closing refuses it, a new
+    worker is then started once the closing one has released the address.
+    """
+    address = address or default_address()
+    key = authkey()
+    request = {
+        "command": "run",
+        "path": path,
+        "module": module,
+        "function": function,
+        "filenames": list(filenames),
+        "params": params,
+    }
+
+    process: subprocess.Popen | None = None
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+        try:
+            if send(address, key, request) == "ok":
+                return
+            # "closed", the address is released once the calls of the closing worker finished
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"the worker at {address} is still closing")
+        except CONNECTION_ERRORS:
+            if time.monotonic() > deadline:
+                raise
+            # Not started yet, or exited as a closing worker still held the address
+            if process is None or process.poll() is not None:
+                process = start(address, python)
+        time.sleep(0.05)
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    Entry point of python -m context_menu.worker.
+    """
+    parser = argparse.ArgumentParser(description="context_menu worker")
+    parser.add_argument("--address", default=None)
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT)
+    args = parser.parse_args(argv)
+
+    Worker(args.address, args.idle_timeout).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -27,4 +27,5 @@ setuptools.setup(
     python_requires=">= 3.7",
     packages=setuptools.find_packages(exclude=["tests*"]),
     extras_require={"test": ["pytest-html"]},
+    entry_points={"console_scripts": ["context-menu = context_menu.manifest:main"]},
 )
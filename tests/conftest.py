@@ -1,3 +1,16 @@
 from __future__ import annotations
 
+from pathlib import Path
+
+import pytest
+
 pytest_plugins: list[str] = ["context_menu.pytest_plugin"]
+
+
+@pytest.fixture
+def data_dirs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Points the data, cache and runtime directories of Linux and Windows to a temporary directory."""
+    # Kept short, the sockets of the coalesced commands are created in the runtime directory
+    for name in ("XDG_DATA_HOME", "XDG_CACHE_HOME", "XDG_RUNTIME_DIR", "LOCALAPPDATA"):
+        monkeypatch.setenv(name, str(tmp_path))
+    return tmp_path
@@ -0,0 +1,96 @@
+import os
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+from context_menu import archive, menus
+from context_menu.ir import lower_command
+
+
+@pytest.fixture
+def project(tmp_path, data_dirs):
+    source = tmp_path / "project"
+    (source / "helpers").mkdir(parents=True)
+    (source / "main.py").write_text("import json\nfrom helpers import shout\n\ndef run(filenames, params):\n    print(shout(params))\n")
+    (source / "helpers" / "__init__.py").write_text("from helpers.text import shout\n")
+    (source / "helpers" / "text.py").write_text("import util\n\ndef shout(text):\n    return util.upper(text)\n")
+    (source / "util.py").write_text("def upper(text):\n    return text.upper() + '!'\n")
+    (source / "unused.py").write_text("")
+    return source
+
+
+def test_build_archive(project):
+    path = archive.build_archive(str(project), "main")
+    assert os.path.dirname(path) == archive.cache_dir("archives")
+
+    names = zipfile.ZipFile(path).namelist()
+    assert {name for name in names if name.endswith(".pyc")} == {
+        "main.pyc", "helpers/__init__.pyc", "helpers/text.pyc", "util.pyc"
+    }
+    assert "main.py" in names and "unused.py" not in names
+    assert {info.compress_type for info in zipfile.ZipFile(path).infolist()} == {zipfile.ZIP_STORED}
+
+    # The function is imported from the archive alone
+    code = f"import sys; sys.path.insert(0, {path!r}); import main; main.run([], 'hi'); print(main.__file__)"
+    output = subprocess.run([sys.executable, "-c", code], cwd="/", capture_output=True, text=True, check=True).stdout
+    assert output.splitlines() == ["HI!", os.path.join(path, "main.pyc")]
+
+    # Named after the content, so a changed dependency gets a new archive
+    assert archive.build_archive(str(project), "main") == path
+    (project / "util.py").write_text("def upper(text):\n    return text\n")
+    rebuilt = archive.build_archive(str(project), "main")
+    assert rebuilt != path
+    # The previous archive of the module is removed, not the one of a module with the same name elsewhere
+    (project / "other").mkdir()
+    (project / "other" / "main.py").write_text("")
+    other = archive.build_archive(str(project / "other"), "main")
+    assert sorted(os.listdir(archive.cache_dir("archives"))) == sorted(map(os.path.basename, [rebuilt, other]))
+
+
+def test_archived_command(project):
+    sys.path.insert(0, str(project))
+    try:
+        import main
+    finally:
+        sys.path.remove(str(project))
+        for name in ("main", "helpers", "helpers.text", "util"):
+            sys.modules.pop(name, None)
+
+    command = lower_command(menus.ContextCommand("Run", python=main.run, archive=True))
+    assert command.function.module == "main"
+    assert command.function.directory.endswith(".zip")
+    assert lower_command(menus.ContextCommand("Run", python=main.run)).function.directory == str(project).replace("\\", "/")
+
+    # A later compile of the same process archives the changed sources, and the previous archive is removed
+    (project / "util.py").write_text("def upper(text):\n    return text.upper() + '?'\n")
+    rebuilt = lower_command(menus.ContextCommand("Run", python=main.run, archive=True))
+    assert rebuilt.function.directory != command.function.directory
+    assert os.path.exists(rebuilt.function.directory)
+    assert not os.path.exists(command.function.directory)
+
+
+def test_import_archived_function(project, capsys):
+    from context_menu import linux_menus, worker
+
+    path = archive.build_archive(str(project), "main")
+    key = worker.module_key(path, "main")
+    meta_path, modules = list(sys.meta_path), set(sys.modules)
+    try:
+        # Through the worker, the pools and the Windows commands
+        worker.load_function(path, "main", "run")([], "hi")
+        assert sys.modules[key].__file__ == os.path.join(path, "main.pyc")
+        del sys.modules[key]
+
+        # Through the generated Nautilus extension
+        helpers = {"sys": sys}
+        exec(linux_menus.ExistingCode.MODULES_CODE.value, helpers)
+        helpers["install_finders"]({key: ("main", path)}, [path])
+        helpers["load_module"](key).run([], "ho")
+    finally:
+        sys.meta_path[:] = meta_path
+        for name in set(sys.modules) - modules:
+            del sys.modules[name]
+
+    assert capsys.readouterr().out.splitlines() == ["HI!", "HO!"]
@@ -0,0 +1,105 @@
+from __future__ import annotations
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from context_menu import coalesce, telemetry, windows_menus
+from context_menu.worker import PACKAGE_PARENT
+
+
+calls = []
+
+
+def record(filenames, params):
+    calls.append((sorted(filenames), params))
+
+
+def test_invocations_are_merged(data_dirs):
+    threads = [
+        threading.Thread(
+            target=coalesce.invoke,
+            args=(os.path.dirname(__file__), __name__, "record", [f"file{i}"], "x"),
+            kwargs={"window": 0.5},
+        )
+        for i in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert calls == [([f"file{i}" for i in range(5)], "x")]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="named pipes are never stale")
+def test_listen_keeps_live_leader(data_dirs):
+    address = coalesce.command_address("dir", "module", "function", "")
+    key = coalesce.authkey()
+    listener = coalesce.listen(address, key)
+    assert listener is not None
+
+    # A closing leader refuses paths but its socket must stay
+    assert coalesce.listen(address, key) is None
+    assert os.path.exists(address)
+    listener.close()
+
+    # Left behind by a leader that crashed, taken over right away
+    open(address, "w").close()
+    listener = coalesce.listen(address, key)
+    assert listener is not None
+    listener.close()
+
+
+def test_coalesced_command(tmp_path, monkeypatch, data_dirs):
+    monkeypatch.setenv("PYTHONPATH", PACKAGE_PARENT)
+    output = tmp_path / "calls.txt"
+    (tmp_path / "user_module.py").write_text(
+        "import json\n"
+        "def run(filenames, params):\n"
+        f"    with open({str(output)!r}, 'a') as calls:\n"
+        "        calls.write(json.dumps(filenames) + '\\n')\n"
+    )
+
+    command = windows_menus.create_file_select_command(
+        "run", "user_module", str(tmp_path), "", coalesce=True
+    )
+    args = shlex.split(command)
+    assert args[0] == sys.executable and args[-1] == "%1"
+
+    processes = [subprocess.Popen(args[:-1] + [f"file{i}"]) for i in range(3)]
+    for process in processes:
+        assert process.wait(30) == 0
+
+    received = [json.loads(line) for line in output.read_text().splitlines()]
+    assert sorted(sum(received, [])) == ["file0", "file1", "file2"]
+
+    # Only the leaders record their exit, with the size of the merged selection
+    output.unlink()
+    args = shlex.split(windows_menus.add_telemetry(command, "Foo menu", "Run", False))
+    processes = [subprocess.Popen(args[:-1] + [f"file{i}"]) for i in range(3)]
+    for process in processes:
+        assert process.wait(30) == 0
+
+    received = [json.loads(line) for line in output.read_text().splitlines()]
+    records = list(telemetry.read("Foo menu"))
+    assert sorted(record.selection for record in records) == sorted(map(len, received))
+
+
+def test_attempts_back_off(monkeypatch, data_dirs):
+    monkeypatch.setattr(coalesce, "forward", lambda address, key, filenames: False)
+    monkeypatch.setattr(coalesce, "listen", lambda address, key: None)
+    delays = []
+    monkeypatch.setattr(coalesce.time, "sleep", delays.append)
+    calls.clear()
+
+    # Without a leader to reach or become, the invocation runs alone after waiting longer and longer
+    coalesce.invoke(os.path.dirname(__file__), __name__, "record", ["file"], "x", window=0.1)
+    assert calls == [(["file"], "x")]
+    assert len(delays) == coalesce.ATTEMPTS
+    assert delays[:3] == [coalesce.BACKOFF, coalesce.BACKOFF * 2, coalesce.BACKOFF * 4]
+    assert max(delays) == 0.1
@@ -1,10 +1,52 @@
+from __future__ import annotations
 import os
+import subprocess
 import sys
 
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Generous for slow CI machines, a cold import takes a few tens of milliseconds
+IMPORT_BUDGET = 0.25
+# The modules importing context_menu.menus may add to sys.modules, the standard library included
+MODULE_BUDGET = 40
+
+MEASURE = """
+import sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+import context_menu.menus
+duration = time.perf_counter() - start
+print(duration)
+print(" ".join(sorted(set(sys.modules) - before)))
+"""
+
+
+def measure_import() -> tuple[float, list[str], str]:
+    """
+    Imports context_menu.menus in a fresh interpreter, returns the duration, the new modules and the other output.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    *output, duration, modules = result.stdout.split("\n")[:-1]
+    return float(duration), modules.split(), "\n".join(output) + result.stderr
+
+
 def test_importing():
     from context_menu import menus
     c = menus.ContextCommand("test")
     assert c.name == "test"
 
 
+def test_import_budget():
+    # The first run may write the bytecode
+    runs = [measure_import() for _ in range(3)]
+    duration = min(run[0] for run in runs)
+    modules, output = runs[-1][1], runs[-1][2]
+
+    assert output == ""
+    for backend in ["context_menu.linux_menus", "context_menu.windows_menus", "ctypes", "winreg"]:
+        assert backend not in modules
+    assert len(modules) <= MODULE_BUDGET, modules
+    assert duration < IMPORT_BUDGET
 
@@ -0,0 +1,83 @@
+from __future__ import annotations
+import os
+import sys
+
+from context_menu import ir, menus, windows_menus
+
+
+def foo(filenames, params):
+    pass
+
+
+def build() -> menus.ContextMenu:
+    cm = menus.ContextMenu("Menu", "files")
+    sub = menus.ContextMenu("Sub")
+    sub.add_items([menus.ContextCommand("Foo", python=foo, params="x")])
+    cm.add_items([sub, menus.ContextCommand("Touch", command="touch ?", command_vars=["filename"])])
+    return cm
+
+
+def test_lower() -> None:
+    lowered = build().lower()
+    assert lowered.type == "FILES"
+
+    sub, touch = lowered.items
+    assert sub.isMenu and not touch.isMenu
+    assert touch.command_vars == ("FILENAME",)
+    tests_dir = os.path.dirname(os.path.abspath(__file__)).replace("\\", "/")
+    assert sub.items[0].function == ("foo", "test_ir", tests_dir)
+
+    # Equal menus are equal and hash equally, so the lowered menus can be used as cache keys
+    assert build().lower() == lowered
+    assert hash(build().lower()) == hash(lowered)
+    other = build()
+    other.sub_items[0].sub_items[0].params = "y"
+    assert other.lower() != lowered
+    assert ir.lower(lowered) is lowered
+
+
+def test_lowering_is_reused() -> None:
+    ir.locate.cache_clear()
+    ir.make_command.cache_clear()
+    windows_menus.create_item_command.cache_clear()
+    cm = build()
+    lowered = cm.lower()
+
+    cm.get_linux_menu(lowered).build_script()
+    cm.get_windows_menu(lowered).build_keys()
+    cm.get_windows_menu().build_keys()
+    assert ir.locate.cache_info().misses == 1
+    assert windows_menus.create_item_command.cache_info().misses == 2
+
+
+def test_deep_lowering() -> None:
+    depth = sys.getrecursionlimit() * 2
+    root = menu = menus.ContextMenu("Root", "FILES")
+    for level in range(depth):
+        submenu = menus.ContextMenu(f"Menu {level}")
+        menu.add_items([submenu])
+        menu = submenu
+
+    lowered = root.lower()
+    for _ in range(depth):
+        (lowered,) = lowered.items
+    assert lowered.name == f"Menu {depth - 1}"
+
+
+def test_deep_equality() -> None:
+    depth = sys.getrecursionlimit() + 500
+
+    def chain(last: str) -> ir.Menu:
+        menu = ir.make_menu("Leaf", (ir.lower_command(menus.ContextCommand(last, command="echo")),), None)
+        for level in range(depth):
+            menu = ir.make_menu(f"Menu {level}", (menu,), None)
+        return menu
+
+    # Identical chains are compared and counted without recursing into every level
+    first, second = chain("Foo"), chain("Foo")
+    assert first is not second and first == second
+    assert chain("Bar") != first
+    assert len({first, second}) == 1
+
+    root = ir.make_menu("Root", (first, second), None, "FILES")
+    assert list(windows_menus.RegistryMenu("Root", root.items, "FILES").find_shared()) == [first]
@@ -1,4 +1,13 @@
+import os
+import re
+import sys
+import threading
+import time
+
+import pytest
+
 from context_menu import menus, linux_menus
+from context_menu.worker import PACKAGE_PARENT, module_key
 # from context_menu import menus
 #
 # from context_menu import linux_menus
@@ -7,18 +16,124 @@ from context_menu import menus, linux_menus
 fc = menus.FastCommand('TestCommand', type='FILES',
                        command='echo hello > example.txt')
 
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__)).replace('\\', '/')
+# The key the generated code loads this module with
+TEST_MODULE = module_key(TESTS_DIR, 'test_linux')
+
 
 def test_command_func():
     nm = linux_menus.NautilusMenu(fc.name, [menus.ContextCommand(
         fc.name, command=fc.command, python=fc.python)], fc.type)
     lm = nm.generate_command_func(fc.command)
-    valid_func = '''
-\tdef method_handler0(self, menu, files):
-\t\tfilepath = [unquote(subFile.get_uri()[7:]) for subFile in files][0]
-\t\tos.system('echo hello > example.txt')\n
+    assert re.fullmatch(r'self\.method_handler_[0-9a-f]{8}', lm.name)
+    valid_func = f'''
+\tdef {lm.name[5:]}(self, menu, files):
+\t\trun_command('echo hello > example.txt')\n
+'''
+    assert valid_func == lm.code
+
+
+def test_mod_command_func():
+    nm = linux_menus.NautilusMenu(fc.name, [], fc.type)
+    lm = nm.generate_mod_command_func('touch ?x', ['FILENAME'])
+    valid_func = f'''
+\tdef {lm.name[5:]}(self, menu, files):
+\t\tfilepath = LazySelection(files)[0]
+\t\trun_command('touch {{}}x'.format(filepath))\n
 '''
     assert valid_func == lm.code
 
+    lm = nm.generate_mod_command_func('cd ?', ['DIR'])
+    assert 'filepath' not in lm.code
+
+    lm = nm.generate_mod_command_func('cd ?', ['DIR'], notify_exit=True)
+    assert "\t\trun_command('cd {}'.format(os.getcwd()), notify=True)" in lm.code
+
+
+class FakeGLib:
+    """
+    Records the children started by run_command instead of starting them.
+    """
+
+    PRIORITY_DEFAULT = 0
+
+    class SpawnFlags:
+        DO_NOT_REAP_CHILD = 2
+
+    def __init__(self):
+        self.spawned = []
+        self.watches = []
+        self.closed = []
+
+    def spawn_async(self, argv, flags):
+        self.spawned.append((argv, flags))
+        return len(self.spawned), None, None, None
+
+    def child_watch_add(self, priority, pid, function, *data):
+        self.watches.append((pid, function, data))
+
+    def spawn_close_pid(self, pid):
+        self.closed.append(pid)
+
+    def idle_add(self, function, *args):
+        self.watches.append((None, function, args))
+
+
+class FakeApplication:
+    def __init__(self):
+        self.notifications = []
+
+    def send_notification(self, id, notification):
+        self.notifications.append(notification.body)
+
+
+class FakeGio:
+    application = FakeApplication()
+
+    class Application:
+        @staticmethod
+        def get_default():
+            return FakeGio.application
+
+    class Notification:
+        def __init__(self, title):
+            self.body = None
+
+        @classmethod
+        def new(cls, title):
+            return cls(title)
+
+        def set_body(self, body):
+            self.body = body
+
+
+Code = linux_menus.ExistingCode
+
+
+def runtime(*sections):
+    """
+    Returns the helpers of CODE_HEAD followed by the given runtime helpers, without the imports of Nautilus.
+    """
+    return Code.CODE_HEAD.value.split('# ---')[1].split('\n', 1)[1] + ''.join(section.value for section in sections)
+
+
+def test_run_command(capsys):
+    glib = FakeGLib()
+    helpers = {'os': os, 'sys': sys, 'GLib': glib, 'Gio': FakeGio}
+    exec(runtime(Code.NOTIFY_CODE, Code.COMMAND_CODE), helpers)
+
+    # Returns once the child is started
+    helpers['run_command']('sleep 10 && false')
+    helpers['run_command']('exit 3', notify=True)
+    assert glib.spawned == [(['/bin/sh', '-c', 'sleep 10 && false'], 2), (['/bin/sh', '-c', 'exit 3'], 2)]
+
+    # The exit is handled when GLib reports it
+    for (pid, function, data), status in zip(glib.watches, [0, 3 << 8]):
+        function(pid, status, *data)
+    assert glib.closed == [1, 2]
+    assert capsys.readouterr().err == 'exit 3: exited with status 3\n'
+    assert FakeGio.application.notifications == ['exit 3\nexited with status 3']
+
 
 # getting rid of this after update
 # def test_build_script_body():
@@ -32,3 +147,520 @@ def test_command_func():
 #     print()
 #     print(valid_commands)
 #     assert nm.commands == valid_commands
+
+
+def test_cached_items_script():
+    nm = linux_menus.NautilusMenu(fc.name, [menus.ContextCommand(
+        fc.name, command=fc.command)], fc.type, cache_items=True)
+    code = nm.build_script()
+    compile(code, 'TestCommand.py', 'exec')
+
+    assert re.search(r'\tdef items_\w+\(self, files\):', code)
+    assert '\t\t\tif builder not in self.items:' in code
+    assert re.search(r'menuitem_\w+\.connect\("activate", self\.activate, self\.method_handler_\w+\)', code)
+    assert re.search(r'self\.method_handler_\w+, files\)', code) is None
+
+
+class FakeFile:
+    def __init__(self, uri, mime_type='application/octet-stream', mount=None):
+        self.uri = uri
+        self.mime_type = mime_type
+        self.mount = mount
+        self.calls = 0
+
+    def get_uri(self):
+        self.calls += 1
+        return self.uri
+
+    def get_name(self):
+        return self.uri.rsplit('/', 1)[-1]
+
+    def is_directory(self):
+        return self.uri.endswith('/')
+
+    def get_mount(self):
+        return self.mount
+
+    def get_mime_type(self):
+        self.calls += 1
+        return self.mime_type
+
+
+def test_lazy_selection():
+    helpers = {}
+    exec(runtime(), helpers)
+
+    files = [FakeFile('file:///tmp/a%20b.txt'), FakeFile('sftp://host/c.txt'), FakeFile('file:///d')]
+    selection = helpers['LazySelection'](files)
+    assert len(selection) == 3
+    assert selection[0] == '/tmp/a b.txt'
+    assert [f.calls for f in files] == [1, 0, 0]
+    assert list(selection) == ['/tmp/a b.txt', 'sftp://host/c.txt', '/d']
+    assert selection[1:] == ['sftp://host/c.txt', '/d']
+
+    # The background handlers only receive the current folder
+    assert list(helpers['LazySelection'](FakeFile('file:///home'))) == ['/home']
+
+
+def test_selection_kinds():
+    helpers = {}
+    exec(runtime(), helpers)
+    selection_kinds = helpers['selection_kinds']
+
+    csv = FakeFile('file:///tmp/a.CSV', 'text/csv')
+    assert selection_kinds([csv], False) == {'FILES', '.csv'}
+    assert csv.calls == 0
+    assert selection_kinds([csv], True) == {'FILES', '.csv', 'text/csv', 'text/*'}
+    assert selection_kinds([csv, FakeFile('file:///tmp/b.txt', 'text/plain')], True) == {'FILES', 'text/*'}
+    assert selection_kinds([csv, FakeFile('file:///tmp/c/')], False) == ()
+    assert selection_kinds([FakeFile('file:///media/usb/', mount=object())], False) == {'DIRECTORY', 'DRIVE'}
+
+
+class FakeGObject:
+    class GObject:
+        pass
+
+
+class FakeNautilus:
+    class MenuProvider:
+        pass
+
+    class Menu:
+        def __init__(self):
+            self.items = []
+
+        def append_item(self, item):
+            self.items.append(item)
+
+    class MenuItem:
+        def __init__(self, name, label, tip, icon):
+            self.label = label
+
+        def set_submenu(self, menu):
+            pass
+
+        def connect(self, *args):
+            pass
+
+
+def load_provider(code):
+    """
+    Runs the generated extension without Nautilus, returns its provider.
+    """
+    namespace = {'os': os, 'sys': sys, 'Nautilus': FakeNautilus, 'GObject': FakeGObject, 'GLib': None}
+    exec(code.split('# ---')[1].split('\n', 1)[1], namespace)
+    return next(value for name, value in namespace.items() if name.endswith('MenuProvider'))()
+
+
+def labels(items):
+    return [item.label for item in items]
+
+
+def test_dispatch():
+    cm = menus.ContextMenu('Background', type='DIRECTORY_BACKGROUND')
+    cm.add_items([menus.ContextCommand('Hello', command='echo hello')])
+    bundle = linux_menus.NautilusBundle('Bundle', [
+        menus.FastCommand('Files', type='FILES', command='echo files').get_linux_menu(),
+        menus.FastCommand('Csv', type='.csv', command='echo csv').get_linux_menu(),
+        menus.FastCommand('Text', type='text/*', command='echo text').get_linux_menu(),
+        menus.FastCommand('Folders', type='DIRECTORY', command='echo folders').get_linux_menu(),
+        cm.get_linux_menu(),
+        menus.FastCommand('Tables', type=['.csv', '.TSV'], command='echo tables').get_linux_menu(),
+    ])
+    provider = load_provider(bundle.build_script())
+    assert provider.match_mime is True
+
+    csv = FakeFile('file:///tmp/a.csv', 'text/csv')
+    assert labels(provider.get_file_items([csv])) == ['Files', 'Csv', 'Text', 'Tables']
+    assert labels(provider.get_file_items([FakeFile('file:///tmp/a.tsv')])) == ['Files', 'Tables']
+    assert labels(provider.get_file_items([FakeFile('file:///tmp/b.png', 'image/png')])) == ['Files']
+    assert labels(provider.get_file_items([FakeFile('file:///tmp/c/')])) == ['Folders']
+    assert labels(provider.get_file_items(None, [csv, FakeFile('file:///tmp/c/')])) == []
+    assert labels(provider.get_background_items(FakeFile('file:///tmp/c/'))) == ['Background']
+
+
+@pytest.mark.parametrize('cache_items', [False, True])
+def test_overlapping_kinds(cache_items):
+    bundle = linux_menus.NautilusBundle('Bundle', [
+        menus.FastCommand('Dirdrive', type=['DIRECTORY', 'DRIVE'], command='echo dir').get_linux_menu(),
+        menus.FastCommand('Bg', type=['DIRECTORY_BACKGROUND', 'DESKTOP'], command='echo bg').get_linux_menu(),
+        menus.FastCommand('Text', type=['.txt', '.TXT', 'text/plain'], command='echo text').get_linux_menu(),
+    ], cache_items)
+    provider = load_provider(bundle.build_script())
+    assert provider.file_dispatch['.txt'] == ((2, provider.file_dispatch['text/plain'][0][1]),)
+
+    assert labels(provider.get_file_items([FakeFile('file:///media/usb/', mount=object())])) == ['Dirdrive']
+    assert labels(provider.get_file_items([FakeFile('file:///tmp/a.txt', 'text/plain')])) == ['Text']
+    assert labels(provider.get_background_items(FakeFile('file:///home/user/Desktop/'))) == ['Bg']
+
+
+def test_unknown_type():
+    with pytest.raises(ValueError):
+        menus.FastCommand('Files', type='FILE', command='echo files').get_linux_menu().build_script()
+
+
+def foo(filenames, params):
+    pass
+
+
+def double(filenames, params):
+    return [filename * 2 for filename in filenames] + [params]
+
+
+def fail(filenames, params):
+    raise ValueError('broken ' + params)
+
+
+def test_execution_pools(capsys, monkeypatch):
+    glib = FakeGLib()
+    helpers = {'os': os, 'sys': sys, 'GLib': glib, 'Gio': FakeGio}
+    exec(runtime(*linux_menus.RUNTIME_CODE), helpers)
+    run_function = helpers['run_function']
+    meta_path = list(sys.meta_path)
+    helpers['install_finders']({TEST_MODULE: ('test_linux', TESTS_DIR)}, [TESTS_DIR, PACKAGE_PARENT])
+
+    argv = sys.argv
+    try:
+        assert run_function('process', TEST_MODULE, 'double', ['b'], 'y', python=sys.executable).result(30) == ['bb', 'y']
+        # The process pool imports the function itself, and sys.argv is left alone when it is set
+        assert TEST_MODULE not in helpers['loaded_modules']
+        assert sys.argv is argv
+        assert run_function('thread', TEST_MODULE, 'double', ['a'], 'x').result(30) == ['aa', 'x']
+        # One pool of each kind, shared by every handler
+        run_function('thread', TEST_MODULE, 'fail', ['a'], 'z', notify=True).exception(30)
+        assert sorted(helpers['executors']) == ['process', 'thread']
+    finally:
+        sys.meta_path[:] = meta_path
+        for executor in helpers['executors'].values():
+            executor.shutdown()
+
+    err = capsys.readouterr().err
+    assert 'test_linux.fail failed:\nTraceback' in err
+    assert 'ValueError: broken z' in err
+    # The notification is sent from the main loop
+    assert [(function.__name__, args) for _, function, args in glib.watches] == [
+        ('notify_failure', ('test_linux.fail failed', 'broken z'))
+    ]
+
+    # Only set for the processes to start when the embedded python has none
+    monkeypatch.delattr(sys, 'argv')
+    helpers['ensure_argv']()
+    assert sys.argv == ['']
+
+
+def test_execution_script():
+    nm = linux_menus.NautilusMenu(fc.name, [menus.ContextCommand(
+        fc.name, python=foo, params='x', execution='process', notify_exit=True)], fc.type)
+    code = nm.build_script()
+    compile(code, 'TestCommand.py', 'exec')
+    assert f'\t\trun_function("process", "{TEST_MODULE}", "foo", list(LazySelection(files)), "x", notify=True, python="{sys.executable}")' in code
+
+    with pytest.raises(ValueError):
+        menus.ContextCommand(fc.name, python=foo, execution='fork')
+
+    nm = linux_menus.NautilusMenu(fc.name, [menus.ContextCommand(
+        fc.name, python=foo, parallel='chunk')], fc.type)
+    code = nm.build_script()
+    tests_dir = os.path.dirname(os.path.abspath(__file__)).replace('\\', '/')
+    assert f'\t\trun_parallel("{tests_dir}", "test_linux", "foo", list(LazySelection(files)), "", "chunk", python="{sys.executable}")' in code
+    assert 'load_module("test_linux' not in code
+
+    nm = linux_menus.NautilusMenu(fc.name, [menus.ContextCommand(
+        fc.name, python=foo, parallel='file', ordered=False)], fc.type)
+    assert f'"", "file", python="{sys.executable}", ordered=False)' in nm.build_script()
+
+    with pytest.raises(ValueError):
+        menus.ContextCommand(fc.name, python=foo, parallel='chunk', worker=True)
+    with pytest.raises(ValueError):
+        menus.ContextCommand(fc.name, python=foo, ordered=False)
+
+    nm = linux_menus.NautilusMenu(fc.name, [menus.ContextCommand(
+        'Profiled', python=foo, params='x', profile='cpu')], fc.type, prewarm=True)
+    code = nm.build_script()
+    compile(code, 'TestCommand.py', 'exec')
+    assert f'\t\tload_module("context_menu.profiling").call(load_module("{TEST_MODULE}").foo, filenames, "x", "Profiled", "cpu")' in code
+    assert "'context_menu.profiling'" in code
+
+    for options in ({'command': 'echo'}, {'python': foo, 'execution': 'thread'}, {'python': foo, 'worker': True}):
+        with pytest.raises(ValueError):
+            menus.ContextCommand(fc.name, profile='cpu', **options)
+
+
+def test_telemetry(data_dirs):
+    from context_menu import telemetry
+
+    nm = linux_menus.NautilusMenu('Timed menu', [
+        menus.ContextCommand('Sleep', command='sleep 1'),
+        menus.ContextCommand('Pool', python=fail, params='x', execution='thread'),
+    ], fc.type, telemetry=True)
+    code = nm.build_script()
+    assert f"telemetry = Telemetry({telemetry.store_path('Timed menu')!r})" in code
+    assert re.search(r'\.connect\("activate", timed\("Sleep", self\.method_handler_[0-9a-f]{8}\), files\)', code)
+    assert labels(load_provider(code).get_file_items([FakeFile('file:///tmp/a.txt'), FakeFile('file:///tmp/b.txt')])) == ['TimedMenu']
+    assert 'telemetry = Telemetry(' not in fc.get_linux_menu().build_script()
+
+    glib = FakeGLib()
+    helpers = {'os': os, 'sys': sys, 'Nautilus': FakeNautilus, 'GObject': FakeGObject, 'GLib': glib, 'Gio': FakeGio}
+    meta_path = list(sys.meta_path)
+    try:
+        exec(code.split('# ---')[1].split('\n', 1)[1], helpers)
+    finally:
+        sys.meta_path[:] = meta_path
+    helpers['timed']('Sleep', lambda menu, files: helpers['run_command']('sleep 1'))(None, [object()])
+    helpers['timed']('Pool', lambda menu, files: helpers['run_function']('thread', TEST_MODULE, 'fail', [], 'x').exception(30))(None, [])
+    pid, function, data = glib.watches[0]
+    function(pid, 1 << 8, *data)
+    helpers['executors']['thread'].shutdown()
+
+    records = [record[1:3] + record[4:] for record in telemetry.read('Timed menu')]
+    # The pool records the exit from its thread
+    assert records[:2] == [('items', '', 2, 0), ('activate', 'Sleep', 1, 0)]
+    assert sorted(records[2:4]) == [('activate', 'Pool', 0, 0), ('exit', 'Pool', 0, 1)]
+    assert records[4] == ('exit', 'Sleep', 1, 1)
+
+
+@pytest.mark.parametrize('item,options,helpers', [
+    (menus.ContextCommand('Hello', command='echo hello'), {}, ['run_command', 'notify_failure']),
+    (menus.ContextCommand('Foo', python=foo), {}, ['load_module']),
+    (menus.ContextCommand('Foo', python=foo), {'prewarm': True}, ['load_module', 'prewarm']),
+    (menus.ContextCommand('Foo', python=foo, worker=True), {}, ['load_module', 'notify_failure', 'run_function', 'run_worker']),
+    (menus.ContextCommand('Foo', python=foo, execution='thread'), {}, ['load_module', 'notify_failure', 'run_function']),
+    (menus.ContextCommand('Foo', python=foo, parallel='file'), {}, ['load_module', 'notify_failure', 'run_function', 'run_parallel']),
+    (menus.ContextCommand('Hello', command='echo hello'), {'telemetry': True}, ['run_command', 'notify_failure', 'timed']),
+])
+def test_runtime_helpers(data_dirs, item, options, helpers):
+    code = linux_menus.NautilusMenu('Menu', [item], 'FILES', **options).build_script()
+    # Only the helpers the items call are emitted
+    defined = re.findall(r'^def (\w+)\(', code, re.MULTILINE)
+    for helper in ('run_command', 'notify_failure', 'load_module', 'prewarm', 'timed', 'run_function', 'run_parallel', 'run_worker'):
+        assert (helper in defined) == (helper in helpers), helper
+    assert ('import threading' in code) == ('load_module' in helpers)
+    assert ('import time' in code) == ('timed' in helpers)
+
+    # and they are enough to load the extension
+    namespace = {'os': os, 'sys': sys, 'Nautilus': FakeNautilus, 'GObject': FakeGObject, 'GLib': FakeGLib()}
+    meta_path = list(sys.meta_path)
+    try:
+        exec(code.split('# ---')[1].split('\n', 1)[1], namespace)
+    finally:
+        sys.meta_path[:] = meta_path
+    assert labels(namespace['MenuMenuProvider']().get_file_items([FakeFile('file:///tmp/a.txt')])) == ['Menu']
+
+
+def test_module_finders():
+    nm = linux_menus.NautilusMenu(fc.name, [
+        menus.ContextCommand('Foo', python=foo),
+        menus.ContextCommand('Worker', python=foo, worker=True),
+    ], fc.type)
+    code = nm.build_script()
+    modules = {TEST_MODULE: ('test_linux', TESTS_DIR)}
+    assert f'install_finders({modules!r}, {[TESTS_DIR, PACKAGE_PARENT]!r})' in code
+    assert 'sys.path.append' not in code
+
+    path, meta_path = list(sys.path), list(sys.meta_path)
+    try:
+        load_provider(code)
+        assert sys.path == path
+        # Only appended, the finders of sys.path and of other extensions come first
+        assert sys.meta_path[:-1] == meta_path
+        last = sys.meta_path[-1]
+    finally:
+        sys.meta_path[:] = meta_path
+
+    # The other modules of the directories are only found after sys.path
+    assert last.find_spec('conftest').origin.endswith('conftest.py')
+    assert last.find_spec('missing_module') is None
+
+
+def test_module_collisions(tmp_path):
+    from context_menu import worker
+
+    functions = []
+    for name in ('colA', 'colB'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'tools.py').write_text(f'def run(filenames, params):\n    return {name!r}\n')
+        functions.append(worker.load_function(str(tmp_path / name), 'tools', 'run'))
+    assert [function(None, '') for function in functions] == ['colA', 'colB']
+
+    nm = linux_menus.NautilusMenu(fc.name, [
+        menus.ContextCommand('A', python=functions[0]),
+        menus.ContextCommand('B', python=functions[1]),
+    ], fc.type)
+    code = nm.build_script()
+    keys = [module_key(str(tmp_path / name), 'tools') for name in ('colA', 'colB')]
+    for key in keys:
+        assert f'load_module("{key}").run(filenames, "")' in code
+
+    helpers = {'os': os, 'sys': sys, 'Nautilus': FakeNautilus, 'GObject': FakeGObject, 'GLib': None}
+    meta_path = list(sys.meta_path)
+    try:
+        exec(code.split('# ---')[1].split('\n', 1)[1], helpers)
+    finally:
+        sys.meta_path[:] = meta_path
+    assert [helpers['load_module'](key).run(None, '') for key in keys] == ['colA', 'colB']
+    assert 'tools' not in sys.modules
+
+
+def test_worker_script(monkeypatch):
+    nm = linux_menus.NautilusMenu(fc.name, [menus.ContextCommand(
+        fc.name, python=foo, params='x', worker=True)], fc.type)
+    code = nm.build_script()
+    compile(code, 'TestCommand.py', 'exec')
+
+    tests_dir = os.path.dirname(os.path.abspath(__file__)).replace('\\', '/')
+    assert 'import test_linux' not in code
+    assert 'load_module("test_linux' not in code
+    assert f'run_worker("{tests_dir}", "test_linux", "foo", list(LazySelection(files)), "x", python="{sys.executable}")' in code
+
+    # Starting the worker can take seconds, the request is sent from a thread instead of the main loop
+    from context_menu import worker
+
+    calls = []
+    monkeypatch.setattr(worker, 'call', lambda *args, **kwargs: calls.append((args, threading.current_thread())))
+    helpers = {'os': os, 'sys': sys, 'GLib': FakeGLib(), 'Gio': FakeGio}
+    exec(runtime(*linux_menus.RUNTIME_CODE), helpers)
+    try:
+        helpers['run_worker'](tests_dir, 'test_linux', 'foo', ['a'], 'x').result(10)
+    finally:
+        helpers['executors']['thread'].shutdown()
+    assert calls[0][0] == (tests_dir, 'test_linux', 'foo', ['a'], 'x')
+    assert calls[0][1] is not threading.main_thread()
+
+
+def test_lazy_imports():
+    nm = linux_menus.NautilusMenu(fc.name, [menus.ContextCommand(
+        fc.name, python=foo)], fc.type)
+    code = nm.build_script()
+    assert 'import test_linux' not in code
+    assert 'GLib.idle_add(prewarm' not in code
+    assert f'\t\tload_module("{TEST_MODULE}").foo(filenames, "")' in code
+
+    nm = linux_menus.NautilusMenu(fc.name, [menus.ContextCommand(
+        fc.name, python=foo)], fc.type, prewarm=True)
+    assert f"GLib.idle_add(prewarm, ['{TEST_MODULE}'])" in nm.build_script()
+
+
+def test_prewarm():
+    helpers = {}
+    exec(runtime(Code.MODULES_CODE, Code.PREWARM_CODE), helpers)
+
+    # Returns False so GLib only runs it once
+    assert helpers['prewarm'](['json', 'missing_module']) is False
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join(5)
+    assert list(helpers['loaded_modules']) == ['json']
+    assert helpers['load_module']('json') is helpers['loaded_modules']['json']
+
+
+def test_prewarm_and_click(tmp_path):
+    (tmp_path / 'slowmod.py').write_text('import time\ntime.sleep(0.5)\n\ndef f():\n    return 1\n')
+    key = module_key(str(tmp_path), 'slowmod')
+    helpers = {'sys': sys}
+    exec(runtime(Code.MODULES_CODE, Code.PREWARM_CODE), helpers)
+    helpers['module_files'][key] = ('slowmod', str(tmp_path))
+
+    # The click waits for the prewarm importing the module instead of getting it half executed
+    try:
+        helpers['prewarm']([key])
+        time.sleep(0.1)
+        assert helpers['load_module'](key).f() == 1
+    finally:
+        sys.modules.pop(key, None)
+
+
+def test_bundle(linux_platform, tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    cm = menus.ContextMenu('Shared Menu', type='DIRECTORY_BACKGROUND')
+    cm.add_items([menus.ContextCommand('Hello', command='echo hello'), menus.ContextCommand('Foo', python=foo)])
+    menus.compile_menus([
+        menus.FastCommand('First', type='FILES', python=foo),
+        menus.FastCommand('Second', type='.txt', command='echo hello'),
+        cm,
+    ], name='My Bundle')
+
+    extensions = tmp_path / '.local/share/nautilus-python/extensions'
+    assert sorted(path.name for path in extensions.iterdir()) == ['MyBundle.py', '__pycache__']
+    code = (extensions / 'MyBundle.py').read_text()
+    compile(code, 'MyBundle.py', 'exec')
+
+    assert code.count('MenuProvider(GObject.GObject, Nautilus.MenuProvider)') == 1
+    assert code.count(f'load_module("{TEST_MODULE}")') == 1
+    # The handlers of identical commands are shared
+    assert code.count('\tdef method_handler') == 2
+    assert len(re.findall(r'\t\treturn menuitem_\w+,\n', code)) == 3
+    assert code.index('def get_file_items') < code.index('def get_background_items')
+    assert "'.txt': ((1, 'items_" in code
+
+
+def test_stable_identifiers():
+    items = [menus.ContextCommand('Hello', command='echo hello'), menus.ContextCommand('Foo', python=foo)]
+    code = linux_menus.NautilusMenu('Menu', items, 'FILES').build_script()
+    assert linux_menus.NautilusMenu('Menu', items, 'FILES').build_script() == code
+
+    inserted = linux_menus.NautilusMenu('Menu', [menus.ContextCommand('New', command='echo new')] + items, 'FILES').build_script()
+    for line in code.splitlines():
+        assert line in inserted
+
+    # Items with the same name still get their own variables
+    twice = linux_menus.NautilusMenu('Menu', [items[0], items[0]], 'FILES').build_script()
+    assert len(set(re.findall(r'(menuitem_\w+) = Nautilus.MenuItem', twice))) == 3
+
+
+def test_deep_identifiers(monkeypatch):
+    depth = sys.getrecursionlimit() * 2
+    root = menu = menus.ContextMenu('Root', 'FILES')
+    for level in range(depth):
+        submenu = menus.ContextMenu(f'Menu {level}')
+        menu.add_items([submenu])
+        menu = submenu
+    menu.add_items([menus.ContextCommand('Hello', command='echo hello')])
+
+    # The identifiers hash the variable of the parent menu, not the names of all the parents
+    hashed = []
+    identifier = linux_menus.NautilusMenu.identifier
+
+    def spy(self, kind, *parts):
+        hashed.append(sum(map(len, parts)))
+        return identifier(self, kind, *parts)
+
+    monkeypatch.setattr(linux_menus.NautilusMenu, 'identifier', spy)
+    code = linux_menus.NautilusMenu('Menu', root.sub_items, 'FILES').build_script()
+    assert max(hashed) < 50
+    assert len(set(re.findall(r'(submenu_\w+) = Nautilus.Menu\(\)', code))) == depth + 1
+
+
+def test_save_extension(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    extension = tmp_path / '.local/share/nautilus-python/extensions/Test.py'
+
+    assert linux_menus.save_extension('Test', 'x = 1\n') is True
+    assert extension.read_text() == 'x = 1\n'
+    compiled = tmp_path / '.local/share/nautilus-python/extensions/__pycache__'
+    assert len(list(compiled.iterdir())) == 1
+    mtime = extension.stat().st_mtime_ns
+
+    assert linux_menus.save_extension('Test', 'x = 1\n') is False
+    assert extension.stat().st_mtime_ns == mtime
+
+    assert linux_menus.save_extension('Test', 'x = 2\n') is True
+    assert extension.read_text() == 'x = 2\n'
+    assert sorted(path.name for path in extension.parent.iterdir()) == ['Test.py', '__pycache__']
+
+    linux_menus.remove_linux_menu('Test')
+    assert list(extension.parent.iterdir()) == [compiled]
+    assert list(compiled.iterdir()) == []
+
+
+def test_streamed_extension(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    items = [menus.ContextCommand('Hello', command='echo hello'), menus.ContextCommand('Foo', python=foo)]
+    code = linux_menus.NautilusMenu('Menu', items, 'FILES').build_script()
+
+    builder = linux_menus.NautilusMenu('Menu', items, 'FILES').get_builder()
+    assert linux_menus.save_extension('Menu', builder.write) is True
+    assert (tmp_path / '.local/share/nautilus-python/extensions/Menu.py').read_text() == code
+
+    # Compared through the hash of the streamed code
+    builder = linux_menus.NautilusMenu('Menu', items, 'FILES').get_builder()
+    assert linux_menus.save_extension('Menu', builder.write) is False
@@ -0,0 +1,139 @@
+from __future__ import annotations
+import json
+import os
+
+import pytest
+
+from context_menu import manifest
+
+TOOLS = """
+def foo(filenames, params):
+    print(filenames)
+"""
+
+
+def write_manifest(tmp_path, menus: list[dict], **options) -> str:
+    path = tmp_path / "menus.json"
+    path.write_text(json.dumps({"name": "Test Menus", "menus": menus, **options}))
+    return str(path)
+
+
+@pytest.fixture
+def isolated(tmp_path, monkeypatch, data_dirs):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    (tmp_path / "manifest_tools.py").write_text(TOOLS)
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+
+MENUS = [
+    {
+        "name": "Foo menu",
+        "type": "FILES",
+        "items": [
+            {"name": "Echo", "command": "echo hello"},
+            {"name": "Sub", "items": [{"name": "Python", "python": "manifest_tools:foo", "params": "x"}]},
+        ],
+    },
+    {"name": "Fast", "type": ".txt", "command": "echo fast"},
+]
+
+
+def test_install_linux(tmp_path, isolated, linux_platform, capsys):
+    path = write_manifest(tmp_path, MENUS, cache_items=True)
+    extension = tmp_path / ".local/share/nautilus-python/extensions/TestMenus.py"
+
+    manifest.main(["install", path])
+    code = extension.read_text()
+    assert "echo hello" in code and "echo fast" in code and "manifest_tools" in code
+    assert capsys.readouterr().out.endswith(f"Installed {path}\n")
+
+    # Unchanged, the extension isn't written again
+    extension.write_text("")
+    manifest.main(["install", path])
+    assert extension.read_text() == ""
+    assert capsys.readouterr().out == f"{path} is already installed\n"
+    manifest.main(["install", path, "--force"])
+    assert extension.read_text() == code
+
+    capsys.readouterr()
+    manifest.main(["list"])
+    assert capsys.readouterr().out.split()[:4] == ["Test", "Menus", "2", "menus"]
+
+    manifest.main(["remove", path])
+    assert not extension.exists()
+    assert manifest.installed() == []
+    with pytest.raises(SystemExit):
+        manifest.main(["remove", "Test Menus"])
+
+
+def test_diff(tmp_path, isolated, linux_platform, capsys):
+    path = write_manifest(tmp_path, MENUS)
+    assert manifest.diff(path) == [("+", "Foo menu"), ("+", "Fast")]
+    manifest.install(path)
+    assert manifest.diff(path) == []
+
+    changed = json.loads(json.dumps(MENUS))
+    changed[0]["items"][0]["command"] = "echo bye"
+    write_manifest(tmp_path, changed[:1] + [{"name": "New", "type": "FILES", "command": "echo new"}])
+    assert manifest.diff(path) == [("~", "Foo menu"), ("+", "New"), ("-", "Fast")]
+    with pytest.raises(SystemExit) as exit:
+        manifest.main(["diff", path])
+    assert exit.value.code == 1
+    assert capsys.readouterr().out.endswith("~ Foo menu\n+ New\n- Fast\n")
+
+    write_manifest(tmp_path, MENUS, prewarm=True)
+    assert manifest.diff(path) == [("~", "Test Menus")]
+
+
+def test_install_windows(tmp_path, isolated, windows_platform, mocked_winreg):
+    path = write_manifest(tmp_path, MENUS)
+    assert manifest.install(path)
+    mocked_winreg.assert_context_command("Software\\Classes\\*\\shell\\Foo menu\\shell", "Echo", "echo hello")
+    mocked_winreg.assert_fast_command("Software\\Classes\\SystemFileAssociations\\.txt\\shell", "Fast", "echo fast")
+    assert not manifest.install(path)
+
+    # The menus dropped from the manifest are removed from the registry
+    write_manifest(tmp_path, MENUS[:1])
+    assert manifest.install(path)
+    assert mocked_winreg.list_keys("Software\\Classes\\SystemFileAssociations\\.txt\\shell") == []
+
+    manifest.remove("Test Menus")
+    assert "Foo menu" not in mocked_winreg.list_keys("Software\\Classes\\*\\shell")
+
+
+@pytest.mark.parametrize(
+    "content, error",
+    [
+        ({"menus": {}}, "has no list of menus"),
+        ({"menus": [], "icons": True}, "unknown keys"),
+        ({"menus": [{"type": "FILES"}]}, "needs a name"),
+        ({"menus": [{"name": "A", "type": "FILES", "command": "a"}] * 2}, "named more than once"),
+        ({"menus": [{"name": "A", "type": "FILES", "python": "manifest_tools"}]}, "module:function"),
+        ({"menus": [{"name": "A", "type": "FILES", "commands": "a"}]}, "A: "),
+    ],
+)
+def test_invalid(tmp_path, isolated, linux_platform, content, error):
+    path = tmp_path / "menus.json"
+    path.write_text(json.dumps(content))
+    with pytest.raises(ValueError, match=error):
+        manifest.install(str(path))
+    assert manifest.installed() == []
+
+
+def test_toml(tmp_path):
+    if manifest.tomllib is None:
+        pytest.skip("needs python 3.11 or tomli")
+    path = tmp_path / "menus.toml"
+    path.write_text(
+        'name = "Test Menus"\n'
+        "cache_items = true\n\n"
+        "[[menus]]\n"
+        'name = "Fast"\n'
+        'type = ".txt"\n'
+        'command = "echo fast"\n'
+    )
+    assert manifest.load(str(path)) == {
+        "name": "Test Menus",
+        "cache_items": True,
+        "menus": [{"name": "Fast", "type": ".txt", "command": "echo fast"}],
+    }
@@ -0,0 +1,66 @@
+import os
+import time
+
+import pytest
+
+from context_menu import parallel
+
+
+def square(filename, params):
+    return int(filename) ** 2
+
+
+def measure(filenames, params):
+    return (len(filenames), params, os.getpid())
+
+
+def fail(filename, params):
+    raise ValueError(filename)
+
+
+def test_run_map_files():
+    filenames = [str(i) for i in range(20)]
+    assert parallel.run_map(square, filenames, '', processes=2) == [i ** 2 for i in range(20)]
+    assert sorted(parallel.run_map(square, filenames, '', ordered=False, processes=2)) == [i ** 2 for i in range(20)]
+
+
+def slow_first(filename, params):
+    if filename == '0':
+        time.sleep(1)
+    return filename
+
+
+def test_run_map_orders():
+    filenames = [str(i) for i in range(4)]
+    assert parallel.run_map(slow_first, filenames, '', chunksize=1, processes=2) == filenames
+    # Collected as the chunks finish, the slow first path comes last
+    assert parallel.run_map(slow_first, filenames, '', chunksize=1, ordered=False, processes=2)[-1] == '0'
+
+
+def test_run_map_chunks():
+    results = parallel.run_map(measure, map(str, range(10)), 'x', mode='chunk', chunksize=3, processes=2)
+    assert [result[:2] for result in results] == [(3, 'x'), (3, 'x'), (3, 'x'), (1, 'x')]
+    assert os.getpid() not in {result[2] for result in results}
+
+
+def test_run_map_in_process():
+    # Not picklable, small selections don't start a pool
+    assert parallel.run_map(lambda filename, params: filename + params, ['a'], 'b') == ['ab']
+    assert parallel.run_map(measure, ['a', 'b', 'c'], 'y', mode='chunk', chunksize=2, processes=1) == [
+        (2, 'y', os.getpid()),
+        (1, 'y', os.getpid()),
+    ]
+    assert parallel.run_map(square, [], '') == []
+
+    with pytest.raises(ValueError):
+        parallel.run_map(square, ['1'], '', mode='dir')
+
+
+def test_run_map_errors():
+    with pytest.raises(ValueError, match='3'):
+        parallel.run_map(fail, ['3', '4'], '', processes=2)
+
+
+def test_call():
+    results = parallel.call(os.path.dirname(__file__), __name__, 'measure', ['a', 'b'], 'z', 'chunk')
+    assert [result[:2] for result in results] == [(1, 'z'), (1, 'z')]
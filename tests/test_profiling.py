@@ -0,0 +1,46 @@
+import os
+import pstats
+import tracemalloc
+
+import pytest
+
+from context_menu import profiling
+
+
+def allocate(filenames, params):
+    return [filename * 1000 for filename in filenames] + [params]
+
+
+def fail(filenames, params):
+    raise ValueError(params)
+
+
+pytestmark = pytest.mark.usefixtures("data_dirs")
+
+
+def test_call():
+    assert profiling.call(allocate, ["a"], "x", "Make/Copies") == ["a" * 1000, "x"]
+    assert profiling.call(allocate, ["b"], "y", "Make/Copies", "memory") == ["b" * 1000, "y"]
+    assert not tracemalloc.is_tracing()
+
+    cpu, memory = profiling.profiles("Make/Copies")
+    assert os.path.basename(os.path.dirname(cpu)) == "Make_Copies"
+    assert "allocate" in str(pstats.Stats(cpu).stats)
+    assert not os.path.exists(cpu[:-5] + ".tracemalloc")
+    assert tracemalloc.Snapshot.load(memory[:-5] + ".tracemalloc").statistics("lineno")
+
+    with pytest.raises(ValueError):
+        profiling.call(allocate, [], "", "Make/Copies", "wall")
+
+
+def test_rotation():
+    for index in range(5):
+        with pytest.raises(ValueError):
+            profiling.call(fail, [], str(index), "Fail", "memory", keep=3)
+
+    # The dumps are written when the function raises, only the last calls are kept
+    assert len(profiling.profiles("Fail")) == 3
+    assert len(os.listdir(profiling.profile_dir("Fail"))) == 6
+
+    profiling.rotate(profiling.profile_dir("Fail"), 0)
+    assert os.listdir(profiling.profile_dir("Fail")) == []
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+from context_menu import telemetry
+from context_menu.worker import PACKAGE_PARENT
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+    assert telemetry.percentile(values, 50) == 50.5
+    assert telemetry.percentile(values, 99) == 99.01
+    assert telemetry.percentile([3.0], 95) == 3.0
+
+
+def test_summarize(data_dirs):
+    assert telemetry.summarize("Foo menu") == {}
+
+    for duration in range(1, 11):
+        telemetry.append("Foo menu", telemetry.format_record("exit", "Sleep", duration, 2, int(duration == 10)))
+    telemetry.append("Foo menu", telemetry.format_record("items", "", 0.5, 1, 0))
+    # Lines that aren't records are skipped
+    telemetry.append("Foo menu", "12.5\texit\tSleep\n")
+    # Stored under the same name as "Foo menu"
+    telemetry.append("Foomenu", telemetry.format_record("items", "", 1.5, 1, 0))
+
+    records = list(telemetry.read("Foo menu"))
+    assert len(records) == 12
+    assert records[0][1:] == ("exit", "Sleep", 1.0, 2, 0)
+
+    summaries = telemetry.summarize("Foo menu")
+    assert list(summaries) == [("exit", "Sleep"), ("items", "")]
+    assert summaries["exit", "Sleep"] == (10, 1, 5.5, 9.55, 9.91, 10.0)
+    assert summaries["items", ""] == (2, 0, 1.0, 1.45, 1.49, 1.5)
+    assert telemetry.summarize("Foo menu", since=records[-1].time + 1) == {}
+
+
+def test_start(monkeypatch, data_dirs):
+    monkeypatch.setenv("PYTHONPATH", PACKAGE_PARENT)
+    for code in ("pass", "raise ValueError"):
+        subprocess.run(
+            [sys.executable, "-c", f"from context_menu import telemetry; telemetry.start('Foo menu', 'Run', 3); {code}"],
+            stderr=subprocess.DEVNULL,
+        )
+
+    records = list(telemetry.read("Foo menu"))
+    assert [record[1:3] + record[4:] for record in records] == [("exit", "Run", 3, 0), ("exit", "Run", 3, 1)]
+    assert os.path.dirname(telemetry.store_path("Foo menu")) == os.path.join(str(data_dirs), "context_menu", "telemetry")
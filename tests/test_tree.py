@@ -0,0 +1,49 @@
+from __future__ import annotations
+import sys
+
+from context_menu import linux_menus, menus, windows_menus
+from context_menu.tree import walk
+
+
+def nested(depth: int) -> menus.ContextMenu:
+    root = menu = menus.ContextMenu("Root", "FILES")
+    for level in range(depth):
+        submenu = menus.ContextMenu(f"Menu {level}")
+        menu.add_items([menus.ContextCommand(f"Command {level}", command="echo hello"), submenu])
+        menu = submenu
+    return root
+
+
+def test_walk_order() -> None:
+    root = menus.ContextMenu("Root", "FILES")
+    first = menus.ContextMenu("First")
+    first.add_items([menus.ContextCommand("A", command="a"), menus.ContextMenu("Empty")])
+    root.add_items([first, menus.ContextCommand("B", command="b")])
+
+    visited = []
+
+    def visit(item, parent):
+        visited.append((parent, item.name))
+        return f"{parent}/{item.name}"
+
+    walk(root.sub_items, "Root", visit)
+    assert visited == [("Root", "First"), ("Root/First", "A"), ("Root/First", "Empty"), ("Root", "B")]
+
+
+def test_deep_menus() -> None:
+    depth = sys.getrecursionlimit() * 2
+    root = nested(depth)
+
+    code = root.get_linux_menu().build_script()
+    assert code.count("Nautilus.Menu()") == depth + 1
+
+    registry_menu = root.get_windows_menu()
+    registry_menu.build_keys()
+    assert len(registry_menu.keys) == 2 * (depth + 1) + 2 * depth
+
+
+def test_slots() -> None:
+    items = [menus.ContextMenu("Menu"), menus.ContextCommand("Command"), menus.FastCommand("Fast", "FILES")]
+    for item in items:
+        assert not hasattr(item, "__dict__")
+    assert [item.isMenu for item in items[:2]] == [True, False]
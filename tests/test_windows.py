@@ -1,11 +1,13 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
+import os
+import shlex
 import sys
 from pathlib import Path
 import pytest
 
 # from context_menu import menus
-from context_menu import menus
+from context_menu import menus, windows_menus
 
 if TYPE_CHECKING:
     from typing import Any
@@ -18,6 +20,15 @@ def foo() -> None:
     pass
 
 
+TESTS_DIR = Path(__file__).parent.as_posix()
+# How the commands import this module
+IMPORT_SECTION = (
+    "from importlib.machinery import PathFinder; from importlib.util import module_from_spec; "
+    f"sys.path.append('{TESTS_DIR}'); spec = PathFinder.find_spec('test_windows', ['{TESTS_DIR}']); "
+    "test_windows = sys.modules['test_windows'] = module_from_spec(spec); spec.loader.exec_module(test_windows)"
+)
+
+
 def test_context_menu(windows_platform: None, mocked_winreg: MockedWinReg) -> None:
     """Tests ContextMenu alone."""
     # Assuming the icon path should include the .ico extension explicitly if required
@@ -62,8 +73,8 @@ def test_context_menu(windows_platform: None, mocked_winreg: MockedWinReg) -> No
             "FILES",
             {"python": foo},
             "Software\\Classes\\*\\shell",
-            '''"{}" -c "import sys; sys.path.insert(0, '{}'); import test_windows; test_windows.foo([' '.join(sys.argv[1:]) ],'')" "%1"'''.format(
-                sys.executable, Path(__file__).parent.as_posix()
+            '''"{}" -c "import sys; {}; test_windows.foo([' '.join(sys.argv[1:]) ],'')" "%1"'''.format(
+                sys.executable, IMPORT_SECTION
             ),
             None,
         ),
@@ -72,18 +83,94 @@ def test_context_menu(windows_platform: None, mocked_winreg: MockedWinReg) -> No
             "DIRECTORY_BACKGROUND",
             {"python": foo},
             "Software\\Classes\\Directory\\Background\\shell",
-            '''"{}" -c "import sys; import os; sys.path.insert(0, '{}'); import test_windows; test_windows.foo([os.getcwd()],'')"'''.format(
+            '''"{}" -c "import sys; import os; {}; test_windows.foo([os.getcwd()],'')"'''.format(
+                sys.executable, IMPORT_SECTION
+            ),
+            None,
+        ),
+        # Test with the resident worker
+        (
+            "FILES",
+            {"python": foo, "worker": True},
+            "Software\\Classes\\*\\shell",
+            '''"{}" -c "import sys; from context_menu import worker; worker.call('{}', 'test_windows', 'foo', [' '.join(sys.argv[1:]) ], '')" "%1"'''.format(
+                sys.executable, Path(__file__).parent.as_posix()
+            ),
+            None,
+        ),
+        (
+            "DIRECTORY_BACKGROUND",
+            {"python": foo, "worker": True},
+            "Software\\Classes\\Directory\\Background\\shell",
+            '''"{}" -c "import os; from context_menu import worker; worker.call('{}', 'test_windows', 'foo', [os.getcwd()], '')"'''.format(
+                sys.executable, Path(__file__).parent.as_posix()
+            ),
+            None,
+        ),
+        # Test with coalesced invocations
+        (
+            "FILES",
+            {"python": foo, "coalesce": True},
+            "Software\\Classes\\*\\shell",
+            '''"{}" -c "import sys; from context_menu import coalesce; coalesce.invoke('{}', 'test_windows', 'foo', sys.argv[1:], '')" "%1"'''.format(
+                sys.executable, Path(__file__).parent.as_posix()
+            ),
+            None,
+        ),
+        # Test with the selection spread over a pool of processes
+        (
+            "FILES",
+            {"python": foo, "parallel": "file"},
+            "Software\\Classes\\*\\shell",
+            '''"{}" -c "import sys; from context_menu import parallel; parallel.call('{}', 'test_windows', 'foo', sys.argv[1:], '', 'file')" "%1"'''.format(
                 sys.executable, Path(__file__).parent.as_posix()
             ),
             None,
         ),
+        (
+            "FILES",
+            {"python": foo, "parallel": "file", "ordered": False},
+            "Software\\Classes\\*\\shell",
+            '''"{}" -c "import sys; from context_menu import parallel; parallel.call('{}', 'test_windows', 'foo', sys.argv[1:], '', 'file', ordered=False)" "%1"'''.format(
+                sys.executable, Path(__file__).parent.as_posix()
+            ),
+            None,
+        ),
+        (
+            "FILES",
+            {"python": foo, "coalesce": True, "parallel": "chunk", "ordered": False},
+            "Software\\Classes\\*\\shell",
+            '''"{}" -c "import sys; from context_menu import coalesce; coalesce.invoke('{}', 'test_windows', 'foo', sys.argv[1:], '', parallel='chunk', ordered=False)" "%1"'''.format(
+                sys.executable, Path(__file__).parent.as_posix()
+            ),
+            None,
+        ),
+        (
+            "FILES",
+            {"python": foo, "coalesce": True, "parallel": "chunk"},
+            "Software\\Classes\\*\\shell",
+            '''"{}" -c "import sys; from context_menu import coalesce; coalesce.invoke('{}', 'test_windows', 'foo', sys.argv[1:], '', parallel='chunk')" "%1"'''.format(
+                sys.executable, Path(__file__).parent.as_posix()
+            ),
+            None,
+        ),
+        # Test with a profiled python function
+        (
+            "FILES",
+            {"python": foo, "profile": "memory"},
+            "Software\\Classes\\*\\shell",
+            '''"{}" -c "import sys; {}; from context_menu import profiling; profiling.call(test_windows.foo, [' '.join(sys.argv[1:]) ], '', 'Command', 'memory')" "%1"'''.format(
+                sys.executable, IMPORT_SECTION
+            ),
+            None,
+        ),
         # Test with DESKTOP
         (
             "DESKTOP",
             {"python": foo},
             "Software\\Classes\\DesktopBackground\\shell",
-            '''"{}" -c "import sys; sys.path.insert(0, '{}'); import test_windows; test_windows.foo([' '.join(sys.argv[1:]) ],'')" "%1"'''.format(
-                sys.executable, Path(__file__).parent.as_posix()
+            '''"{}" -c "import sys; {}; test_windows.foo([' '.join(sys.argv[1:]) ],'')" "%1"'''.format(
+                sys.executable, IMPORT_SECTION
             ),
             None,
         ),
@@ -114,6 +201,10 @@ def test_context_command(
             f"{expected_parent}\\Test\\shell", "Command", expected_command
         )
 
+    # Explorer only shows verbs for more than 15 files with the Player selection model
+    multi_select = "Player" if params.get("coalesce") else None
+    assert mocked_winreg.get_key_value(f"{expected_parent}\\Test\\shell\\Command", "MultiSelectModel") == multi_select
+
 
 @pytest.mark.parametrize(
     "activation_type,params,expected_parent,expected_command,expected_icon",
@@ -149,8 +240,8 @@ def test_context_command(
             "FILES",
             {"python": foo},
             "Software\\Classes\\*\\shell",
-            '''"{}" -c "import sys; sys.path.insert(0, '{}'); import test_windows; test_windows.foo([' '.join(sys.argv[1:]) ],'')" "%1"'''.format(
-                sys.executable, Path(__file__).parent.as_posix()
+            '''"{}" -c "import sys; {}; test_windows.foo([' '.join(sys.argv[1:]) ],'')" "%1"'''.format(
+                sys.executable, IMPORT_SECTION
             ),
             None,
         ),
@@ -159,8 +250,8 @@ def test_context_command(
             "DIRECTORY_BACKGROUND",
             {"python": foo},
             "Software\\Classes\\Directory\\Background\\shell",
-            '''"{}" -c "import sys; import os; sys.path.insert(0, '{}'); import test_windows; test_windows.foo([os.getcwd()],'')"'''.format(
-                sys.executable, Path(__file__).parent.as_posix()
+            '''"{}" -c "import sys; import os; {}; test_windows.foo([os.getcwd()],'')"'''.format(
+                sys.executable, IMPORT_SECTION
             ),
             None,
         ),
@@ -172,6 +263,16 @@ def test_context_command(
             "echo hello",
             None,
         ),
+        # Test with coalesced invocations
+        (
+            ".png",
+            {"python": foo, "coalesce": True},
+            "Software\\Classes\\SystemFileAssociations\\.png\\shell",
+            '''"{}" -c "import sys; from context_menu import coalesce; coalesce.invoke('{}', 'test_windows', 'foo', sys.argv[1:], '')" "%1"'''.format(
+                sys.executable, Path(__file__).parent.as_posix()
+            ),
+            None,
+        ),
     ),
 )
 def test_fast_command(
@@ -190,4 +291,256 @@ def test_fast_command(
         mocked_winreg.assert_fast_command_with_icon(expected_parent, "Test", expected_command, expected_icon)
     else:
         mocked_winreg.assert_fast_command(expected_parent, "Test", expected_command)
+    multi_select = "Player" if params.get("coalesce") else None
+    assert mocked_winreg.get_key_value(f"{expected_parent}\\Test", "MultiSelectModel") == multi_select
+
+
+
+def test_incremental_compile(windows_platform: None, mocked_winreg: MockedWinReg) -> None:
+    """Tests that an incremental compile only writes what changed."""
+    parent = "Software\\Classes\\*\\shell"
+
+    def build(command: str, with_submenu: bool) -> menus.ContextMenu:
+        cm = menus.ContextMenu("Test", "FILES")
+        items: list[Any] = [menus.ContextCommand("Command", command=command)]
+        if with_submenu:
+            sub = menus.ContextMenu("Sub")
+            sub.add_items([menus.ContextCommand("Nested", command="echo nested")])
+            items.append(sub)
+        cm.add_items(items)
+        return cm
+
+    summary = build("echo hello", True).compile(incremental=True)
+    assert len(summary.created_keys) == 8
+    assert summary.unchanged_keys == 0
+    mocked_winreg.assert_context_menu(parent, "Test")
+    mocked_winreg.assert_context_menu(f"{parent}\\Test\\shell", "Sub")
+    mocked_winreg.assert_context_command(f"{parent}\\Test\\shell\\Sub\\shell", "Nested", "echo nested")
+
+    summary = build("echo hello", True).compile(incremental=True)
+    assert not summary.changed
+    assert summary.unchanged_keys == 8
+
+    summary = build("echo changed", False).compile(incremental=True)
+    assert summary.created_keys == []
+    assert summary.deleted_keys == [f"{parent}\\Test\\shell\\Sub"]
+    assert summary.set_values == [(f"{parent}\\Test\\shell\\Command\\command", "")]
+    assert summary.unchanged_keys == 3
+    mocked_winreg.assert_context_command(f"{parent}\\Test\\shell", "Command", "echo changed")
+    assert mocked_winreg.list_keys(f"{parent}\\Test\\shell") == ["Command"]
+
+
+def test_incremental_fast_command(windows_platform: None, mocked_winreg: MockedWinReg) -> None:
+    """Tests that values that aren't wanted anymore are deleted."""
+    parent = "Software\\Classes\\*\\shell"
+    menus.FastCommand("Test", "FILES", command="echo", icon_path="icon.ico").compile(incremental=True)
+
+    summary = menus.FastCommand("Test", "FILES", command="echo").compile(incremental=True)
+    assert summary.deleted_values == [(f"{parent}\\Test", "Icon")]
+    assert str(summary) == "0 keys created, 0 keys deleted, 0 values set, 1 values deleted, 1 keys unchanged"
+    mocked_winreg.assert_fast_command(parent, "Test", "echo")
+
+
+def test_registry_session(windows_platform: None, mocked_winreg: MockedWinReg) -> None:
+    """Tests that a compile opens each key once and closes every handle."""
+    cm = menus.ContextMenu("Test", "FILES", "icon.ico")
+    sub = menus.ContextMenu("Sub")
+    sub.add_items([menus.ContextCommand("Nested", command="echo nested")])
+    cm.add_items([menus.ContextCommand("Command", command="echo hello"), sub])
+    cm.compile()
+
+    mocked_winreg.assert_context_menu_with_icon("Software\\Classes\\*\\shell", "Test", "icon.ico")
+    mocked_winreg.assert_context_command("Software\\Classes\\*\\shell\\Test\\shell\\Sub\\shell", "Nested", "echo nested")
+
+    # 8 keys, 6 of them with values (the \\shell keys have none)
+    assert mocked_winreg.calls["open_key"] == 8
+    assert mocked_winreg.calls["set_key_values"] == 6
+    assert mocked_winreg.calls["close_key"] == 8
+    assert mocked_winreg.calls["create_key"] == 0
+    assert mocked_winreg.calls["set_key_value"] == 0
+    assert mocked_winreg.open_handles == []
+
+
+def test_registry_session_counts(mocked_winreg: MockedWinReg) -> None:
+    """Tests the counters of a RegistrySession."""
+    from context_menu import windows_menus
+
+    with windows_menus.RegistrySession() as session:
+        session.set_values("A", {"x": "1", "y": "2"})
+        session.set_values("A\\B", {})
+        session.set_values("A", {"z": "3"})
+        assert len(mocked_winreg.open_handles) == 2
+
+    assert session.calls == {"open_key": 2, "set_key_values": 2, "values": 3, "close_key": 2}
+    assert mocked_winreg.open_handles == []
+    assert mocked_winreg.get_key_value("A", "z") == "3"
+    assert mocked_winreg.list_keys("A") == ["B"]
+
+
+def test_compile_menus(windows_platform: None, mocked_winreg: MockedWinReg) -> None:
+    """Tests compiling several menus through one registry session."""
+    cm = menus.ContextMenu("Test", "DIRECTORY")
+    cm.add_items([menus.ContextCommand("Command", command="echo hello")])
+    fc = menus.FastCommand("Fast", ".txt", command="echo fast")
+
+    assert menus.compile_menus([cm, fc]) is None
+    mocked_winreg.assert_context_command("Software\\Classes\\Directory\\shell\\Test\\shell", "Command", "echo hello")
+    mocked_winreg.assert_fast_command("Software\\Classes\\SystemFileAssociations\\.txt\\shell", "Fast", "echo fast")
+    assert mocked_winreg.calls["open_key"] == 6
+    assert mocked_winreg.open_handles == []
+
+    summaries = menus.compile_menus([cm, fc], incremental=True)
+    assert [summary.unchanged_keys for summary in summaries] == [4, 2]
+
+
+def test_shared_store(windows_platform: None, mocked_winreg: MockedWinReg) -> None:
+    """Tests that a menu registered for many extensions keeps its items once."""
+    extensions = [f".ext{index}" for index in range(50)]
+
+    def build(type: Any) -> menus.ContextMenu:
+        cm = menus.ContextMenu("Test", type)
+        sub = menus.ContextMenu("Sub")
+        sub.add_items([menus.ContextCommand("Nested", command="echo nested")])
+        cm.add_items([menus.ContextCommand("Command", command="echo hello"), sub])
+        return cm
+
+    for extension in extensions:
+        build(extension).compile()
+    separate_keys = mocked_winreg.calls["open_key"]
+    for extension in extensions:
+        menus.removeMenu("Test", extension)
+
+    mocked_winreg.calls.clear()
+    build(extensions).compile()
+    assert mocked_winreg.calls["open_key"] == 50 + 8
+    assert separate_keys == 50 * 8
+
+    store = windows_menus.store_path("Test", windows_menus.type_list(extensions))
+    assert store.startswith("Software\\Classes\\ContextMenus\\Test-")
+    for extension in extensions:
+        parent = f"Software\\Classes\\SystemFileAssociations\\{extension}\\shell"
+        assert mocked_winreg.get_key_value(f"{parent}\\Test", "MUIVerb") == "Test"
+        assert mocked_winreg.get_key_value(f"{parent}\\Test", "ExtendedSubCommandsKey") == store.split("\\", 2)[2]
+        assert mocked_winreg.list_keys(f"{parent}\\Test") == []
+    mocked_winreg.assert_context_command(f"{store}\\shell\\Sub\\shell", "Nested", "echo nested")
+
+    summary = build(extensions).compile(incremental=True)
+    assert not summary.changed
+    assert summary.unchanged_keys == 50 + 8
+
+    menus.removeMenu("Test", extensions)
+    assert mocked_winreg.list_keys("Software\\Classes\\ContextMenus") == []
+    assert mocked_winreg.list_keys("Software\\Classes\\SystemFileAssociations\\.ext0\\shell") == []
+
+
+def test_same_named_stores(windows_platform: None, mocked_winreg: MockedWinReg) -> None:
+    """Tests that menus with the same name and other types keep their own store."""
+    parent = "Software\\Classes\\SystemFileAssociations\\{}\\shell\\Convert"
+
+    def build(type: list[str], verb: str) -> menus.ContextMenu:
+        cm = menus.ContextMenu("Convert", type)
+        cm.add_items([menus.ContextCommand(verb, command=f"echo {verb}")])
+        return cm
+
+    build([".png", ".jpg"], "To webp").compile()
+    build([".mp4", ".mkv"], "To webm").compile()
+
+    stores = {
+        extension: mocked_winreg.get_key_value(parent.format(extension), "ExtendedSubCommandsKey")
+        for extension in [".png", ".jpg", ".mp4", ".mkv"]
+    }
+    assert stores[".png"] == stores[".jpg"] != stores[".mp4"] == stores[".mkv"]
+    assert mocked_winreg.list_keys(f"Software\\Classes\\{stores['.png']}\\shell") == ["To webp"]
+    assert mocked_winreg.list_keys(f"Software\\Classes\\{stores['.mp4']}\\shell") == ["To webm"]
+
+    menus.removeMenu("Convert", [".mp4", ".mkv"])
+    assert mocked_winreg.list_keys("Software\\Classes\\ContextMenus") == [stores[".png"].split("\\")[1]]
+
+    # The store is kept while one of its types still refers to it
+    menus.removeMenu("Convert", ".png")
+    mocked_winreg.assert_context_command(f"Software\\Classes\\{stores['.jpg']}\\shell", "To webp", "echo To webp")
+    menus.removeMenu("Convert", ".jpg")
+    assert mocked_winreg.list_keys("Software\\Classes\\ContextMenus") == []
+
+
+def test_shared_submenus(windows_platform: None, mocked_winreg: MockedWinReg) -> None:
+    """Tests that identical submenus are written once."""
+    parent = "Software\\Classes\\*\\shell"
+
+    def build(copies: int) -> menus.ContextMenu:
+        cm = menus.ContextMenu("Test", "FILES")
+        for index in range(copies):
+            sub = menus.ContextMenu("Tools")
+            sub.add_items([menus.ContextCommand(f"Tool {tool}", command=f"echo {tool}") for tool in range(10)])
+            other = menus.ContextMenu(f"Menu {index}")
+            other.add_items([sub])
+            cm.add_items([other])
+        return cm
+
+    summary = build(3).compile(incremental=True)
+    # Every copy of Tools is a reference, the 20 keys of its commands are only written once
+    assert len(summary.created_keys) == 2 + 3 * 3 + 3 + 20
+    references = [key for key in summary.created_keys if key.endswith("\\Tools")]
+    assert len(references) == 3
+    store = mocked_winreg.get_key_value(references[0], "ExtendedSubCommandsKey")
+    assert {mocked_winreg.get_key_value(key, "ExtendedSubCommandsKey") for key in references} == {store}
+    mocked_winreg.assert_context_command(f"Software\\Classes\\{store}\\shell", "Tool 9", "echo 9")
+
+    # Without repeated submenus, the store isn't needed anymore
+    summary = build(1).compile(incremental=True)
+    assert summary.deleted_keys[-1] == windows_menus.store_path("Test", ["FILES"])
+    mocked_winreg.assert_context_command(f"{parent}\\Test\\shell\\Menu 0\\shell\\Tools\\shell", "Tool 9", "echo 9")
+    assert mocked_winreg.list_keys("Software\\Classes\\ContextMenus") == []
+
+
+def test_telemetry(windows_platform: None, mocked_winreg: MockedWinReg) -> None:
+    """Tests that the python commands of menus compiled with telemetry record their runs."""
+    cm = menus.ContextMenu("Test", "FILES", telemetry=True)
+    cm.add_items([menus.ContextCommand("Python", python=foo), menus.ContextCommand("Shell", command="echo hello")])
+    cm.compile()
+
+    parent = "Software\\Classes\\*\\shell\\Test\\shell"
+    command = mocked_winreg.get_key_value(f"{parent}\\Python\\command", "")
+    assert command.startswith(
+        f'''"{sys.executable}" -c "import sys; from context_menu import telemetry; telemetry.start('Test', 'Python', len(sys.argv[1:])); import sys;'''
+    )
+    # Explorer runs plain commands itself
+    mocked_winreg.assert_context_command(parent, "Shell", "echo hello")
+
+    menus.compile_menus([menus.FastCommand("Fast", "DIRECTORY_BACKGROUND", python=foo)], name="Bundle", telemetry=True)
+    command = mocked_winreg.get_key_value("Software\\Classes\\Directory\\Background\\shell\\Fast\\command", "")
+    assert "telemetry.start('Bundle', 'Fast', 1); import sys; import os;" in command
+
+
+def test_windowless_launch(windows_platform: None, mocked_winreg: MockedWinReg, tmp_path: Path) -> None:
+    """Tests that windowless commands start pythonw without site and with their module byte-compiled."""
+    import importlib.util
+    import subprocess
+
+    from context_menu import windows_menus
+
+    (tmp_path / "launched.py").write_text("def run(filenames, params):\n    print(filenames, params)\n")
+    sys.path.insert(0, str(tmp_path))
+    try:
+        import launched
+    finally:
+        sys.path.remove(str(tmp_path))
+    cached = importlib.util.cache_from_source(str(tmp_path / "launched.py"))
+    if os.path.exists(cached):
+        os.remove(cached)
+
+    fc = menus.FastCommand("Launch", "FILES", python=launched.run, params="x", launch="windowless")
+    fc.compile()
+    assert os.path.exists(cached)
+
+    command = mocked_winreg.get_key_value("Software\\Classes\\*\\shell\\Launch\\command", "")
+    pythonw = windows_menus.COMMAND_PRESETS["pythonw"]
+    assert command.startswith(f'"{pythonw}" -I -S -c "import sys; sys.path[:] = [')
+    assert not command.startswith(f'"{sys.executable}"')
+
+    # Runs the same with the interpreter of the tests instead of pythonw
+    argv = shlex.split(command.replace(pythonw, sys.executable).replace("%1", "a.txt"))
+    assert subprocess.run(argv, capture_output=True, text=True).stdout == "['a.txt'] x\n"
 
+    with pytest.raises(ValueError):
+        menus.FastCommand("Launch", "FILES", python=launched.run, launch="hidden")
@@ -0,0 +1,137 @@
+from __future__ import annotations
+import os
+import sys
+import threading
+import time
+import uuid
+import pytest
+
+from context_menu import worker
+
+
+calls = []
+called = threading.Event()
+
+
+def record(filenames, params):
+    calls.append((filenames, params))
+    called.set()
+
+
+@pytest.fixture
+def address(tmp_path, data_dirs):
+    if sys.platform == "win32":
+        return worker.default_address(f"test_{uuid.uuid4().hex}")
+    return str(tmp_path / "worker.sock")
+
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_worker_runs_calls(address):
+    server = worker.Worker(address, idle_timeout=30)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    wait_for(lambda: worker.is_running(address))
+
+    worker.call(os.path.dirname(__file__), __name__, "record", iter(["a", "b"]), "x", address=address)
+    assert called.wait(10)
+    assert calls == [(["a", "b"], "x")]
+
+    assert worker.stop(address)
+    thread.join(10)
+    assert not thread.is_alive()
+    assert not worker.is_running(address)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="named pipes are never stale")
+def test_workers_started_at_once(address):
+    # Left behind by a worker that crashed
+    open(address, "w").close()
+    servers = [worker.Worker(address, idle_timeout=30) for _ in range(4)]
+    threads = [threading.Thread(target=server.serve_forever, daemon=True) for server in servers]
+    for thread in threads:
+        thread.start()
+
+    # A single one binds the address, the others find it running and return without removing its socket
+    wait_for(lambda: sum(thread.is_alive() for thread in threads) == 1)
+    assert worker.is_running(address)
+    assert worker.stop(address)
+    for thread in threads:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_worker_idle_shutdown(address):
+    server = worker.Worker(address, idle_timeout=0.2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+
+
+def test_call_starts_worker(address, tmp_path):
+    output = tmp_path / "output.txt"
+    (tmp_path / "user_module.py").write_text(
+        "def run(filenames, params):\n"
+        f"    open({str(output)!r}, 'w').write(' '.join(filenames) + params)\n"
+    )
+
+    assert not worker.is_running(address)
+    worker.call(str(tmp_path), "user_module", "run", ["a", "b"], "!", address=address)
+    try:
+        wait_for(output.exists)
+        wait_for(lambda: output.read_text() == "a b!")
+    finally:
+        worker.stop(address)
+
+
+def test_call_during_shutdown(address, tmp_path):
+    output = tmp_path / "output.txt"
+    (tmp_path / "user_module.py").write_text(
+        "def run(filenames, params):\n"
+        f"    open({str(output)!r}, 'w').write(' '.join(filenames) + params)\n"
+    )
+    server = worker.Worker(address, idle_timeout=30)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    wait_for(lambda: worker.is_running(address))
+
+    # Closing but still on its address, the worker refuses the request instead of dropping it
+    server.closing = True
+    request = {"command": "run", "path": str(tmp_path), "module": "user_module", "function": "run", "filenames": [], "params": ""}
+    assert worker.send(address, worker.authkey(), request) == "closed"
+
+    # The client waits for it to exit and starts a new worker
+    threading.Timer(0.3, server.shutdown).start()
+    worker.call(str(tmp_path), "user_module", "run", ["a"], "!", address=address)
+    try:
+        thread.join(10)
+        assert not thread.is_alive()
+        wait_for(lambda: output.exists() and output.read_text() == "a!")
+    finally:
+        worker.stop(address)
+
+
+def test_concurrent_imports(tmp_path):
+    (tmp_path / "slowmod.py").write_text("import time\ntime.sleep(0.5)\n\ndef f():\n    return 1\n")
+    results = []
+
+    def load():
+        results.append(worker.load_function(str(tmp_path), "slowmod", "f")())
+
+    # The second thread waits for the module the first one is importing
+    threads = [threading.Thread(target=load) for _ in range(2)]
+    try:
+        threads[0].start()
+        time.sleep(0.1)
+        threads[1].start()
+        for thread in threads:
+            thread.join(10)
+    finally:
+        sys.modules.pop(worker.module_key(str(tmp_path), "slowmod"), None)
+    assert results == [1, 1]